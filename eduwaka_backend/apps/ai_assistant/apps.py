@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class AdmissionsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.ai_assistant'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,468 @@
+import asyncio
+import json
+import logging
+import math
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import classonlymethod
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from apps.ai_assistant.serializers import EligibilityCheckRequestSerializer, EligibilityBatchRequestSerializer, InstitutionRequestSerializer
+from .cache import eligibility_result_cache, institution_overview_cache
+from .models import ChatHistory, Conversation, EligibilityCheck
+from .history import history_page, summary_query
+from .singleflight import llm_singleflight, request_key
+from .llm import LLMResponse, check_finish_reason, estimate_tokens
+from .ratelimit import ai_rate_limiter
+from .resilience import LLMUnavailableError
+from .usage import usage_rollup
+from . import eligibility
+from .views import (
+  CHAT_HISTORY_BATCH_SIZE,
+  OVERVIEW_GENERATION_CONFIG,
+  OVERVIEW_UNAVAILABLE_DETAIL,
+  build_overview_prompt,
+  chat_error_message,
+  chat_history_window,
+  conversation_error,
+  degraded_reply,
+  extract_chat_message,
+  finish_turn,
+  format_chat_contents,
+  grounded_contents,
+  llm,
+  loads_model_json,
+  local_reply,
+  new_conversation_title,
+  remember_reply,
+  retry_after_headers,
+  sse_event,
+  sse_response,
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def agenerate_text_coalesced(contents: list, generation_config: dict, priority: str, endpoint: str | None = None) -> str:
+  """Async counterpart of views.generate_text_coalesced."""
+  key = request_key(llm.model_name, contents, generation_config)
+
+  async def call():
+    response = await llm.agenerate(contents, generation_config, priority=priority, endpoint=endpoint)
+    usage_rollup.record_llm_usage(response)
+    check_finish_reason(response)
+    return response.text
+
+  return await llm_singleflight.do_async(key, call)
+
+
+class AsyncAIView(View):
+  """
+  Base for the native async Gemini views served under ASGI (uvicorn).
+
+  DRF's APIView is sync-only, so this covers the part of it these endpoints
+  need: JWT authentication, rate limiting (AIRateThrottle's buckets), JSON
+  body parsing and DRF-shaped error bodies.
+  """
+  http_method_names = ["post", "options"]
+  requires_authentication = True
+
+  @classonlymethod
+  def as_view(cls, **initkwargs):
+    # Token-authenticated API, same CSRF stance as DRF's APIView
+    return csrf_exempt(super().as_view(**initkwargs))
+
+  async def dispatch(self, request, *args, **kwargs):
+    if request.method == "POST":
+      if self.requires_authentication:
+        try:
+          auth = await sync_to_async(JWTAuthentication().authenticate)(request)
+        except exceptions.AuthenticationFailed as e:
+          return JsonResponse({"detail": e.detail}, status=status.HTTP_401_UNAUTHORIZED)
+        if auth is None:
+          return JsonResponse(
+            {"detail": "Authentication credentials were not provided."},
+            status=status.HTTP_401_UNAUTHORIZED,
+          )
+        request.user = auth[0]
+
+      # check() also sets who this task's LLM calls are billed to; asgiref carries it back
+      wait = await sync_to_async(ai_rate_limiter.check)(request)
+      if wait:
+        return JsonResponse(
+          {"detail": f"Request was throttled. Expected available in {math.ceil(wait)} seconds."},
+          status=status.HTTP_429_TOO_MANY_REQUESTS,
+          headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+      try:
+        self.data = json.loads(request.body or b"{}")
+      except ValueError as e:
+        return JsonResponse({"detail": f"JSON parse error - {e}"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+      return await super().dispatch(request, *args, **kwargs)
+    except exceptions.ValidationError as e:
+      return JsonResponse(e.detail, status=status.HTTP_400_BAD_REQUEST, safe=False)
+
+
+# Institution Overview View (async)
+class AsyncInstitutionOverviewView(AsyncAIView):
+  requires_authentication = False
+
+  async def post(self, request, *args, **kwargs):
+    serializer = InstitutionRequestSerializer(data=self.data)
+    serializer.is_valid(raise_exception=True)
+    institution_name = serializer.validated_data['institution_name']
+
+    cached_data = await institution_overview_cache.aget(institution_name)
+    if cached_data is not None:
+      if "error" in cached_data:
+        return JsonResponse({"detail": cached_data["error"]}, status=status.HTTP_404_NOT_FOUND)
+      return JsonResponse(cached_data, status=status.HTTP_200_OK)
+
+    prompt = build_overview_prompt(institution_name)
+
+    try:
+      gemini_output_text = await agenerate_text_coalesced(
+        contents=[{"parts": [{"text": prompt}]}],
+        generation_config=OVERVIEW_GENERATION_CONFIG,
+        priority="overview",
+      )
+      institution_data = loads_model_json(gemini_output_text, "overview")
+
+      if "error" in institution_data:
+        await institution_overview_cache.aset_negative(institution_name, {"error": institution_data["error"]})
+        return JsonResponse({"detail": institution_data["error"]}, status=status.HTTP_404_NOT_FOUND)
+
+      await institution_overview_cache.aset(institution_name, institution_data)
+      return JsonResponse(institution_data, status=status.HTTP_200_OK)
+
+    except json.JSONDecodeError:
+      logger.warning(f"Error decoding JSON from Gemini API: {gemini_output_text}")
+      return JsonResponse(
+        {"detail": "An unexpected error occurred while parsing the AI response."},
+        status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+      )
+    except LLMUnavailableError as e:
+      logger.warning(f"Gemini unavailable for institution overview: {e}")
+      stale_data = await institution_overview_cache.aget_stale(institution_name)
+      if stale_data is not None:
+        return JsonResponse({**stale_data, "stale": True}, status=status.HTTP_200_OK)
+      return JsonResponse(
+        {"detail": OVERVIEW_UNAVAILABLE_DETAIL},
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers=retry_after_headers(e),
+      )
+    except Exception as e:
+      logger.exception(f"Error calling Gemini API for institution overview: {e}")
+      return JsonResponse(
+        {"detail": f"An unexpected error occurred: {str(e)}"},
+        status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+      )
+
+
+# Eligibility Check View (async)
+async def aevaluate_locally(prepared: dict) -> dict | None:
+  """Async counterpart of EligibilityCheckAPIView._evaluate_locally."""
+  if not prepared["needs_llm"]:
+    jamb_requirements = await eligibility.course_requirements_query(
+      prepared["institution_name"], prepared["desired_course"]
+    ).afirst()
+    return eligibility.build_local_result(prepared, jamb_requirements)
+
+  return await eligibility_result_cache.aget(prepared["cache_key"])
+
+
+async def aevaluate_eligibility(prepared: dict, endpoint: str = "eligibility") -> dict:
+  """Async counterpart of EligibilityCheckAPIView._evaluate; `endpoint` labels the metrics."""
+  result = await aevaluate_locally(prepared)
+  return result if result is not None else await aevaluate_with_llm(prepared, endpoint)
+
+
+async def aevaluate_with_llm(prepared: dict, endpoint: str = "eligibility") -> dict:
+  response_text = await agenerate_text_coalesced(
+    contents=[{"parts": [{"text": prepared["prompt"]}]}],
+    generation_config=eligibility.ELIGIBILITY_GENERATION_CONFIG,
+    priority="eligibility",
+    endpoint=endpoint,
+  )
+  result = loads_model_json(response_text, endpoint)
+
+  result = eligibility.enforce(result, prepared["credit_report"], prepared["jamb_score"])
+  await eligibility_result_cache.aset(prepared["cache_key"], prepared["course_key"], result)
+  return result
+
+
+# Evaluations that outlived their request; referenced so they aren't garbage-collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+class AsyncEligibilityCheckView(AsyncAIView):
+
+  DEADLINE = settings.ELIGIBILITY_DEADLINE  # seconds to wait for Gemini before answering partially
+
+  async def _finish_in_background(self, task: asyncio.Task, check_id, user_id: int) -> None:
+    try:
+      result, error = await task, None
+    except Exception as e:
+      result, error = None, e
+    await sync_to_async(eligibility.store_check)(check_id, user_id, result, error)
+
+  async def _aevaluate_within_deadline(self, user, prepared: dict) -> dict:
+    """Async counterpart of EligibilityCheckAPIView._evaluate_within_deadline."""
+    if self.DEADLINE <= 0:
+      return await aevaluate_with_llm(prepared)
+
+    task = asyncio.ensure_future(aevaluate_with_llm(prepared))
+    done, _ = await asyncio.wait({task}, timeout=self.DEADLINE)
+    if done:
+      return task.result()
+
+    check = await EligibilityCheck.objects.acreate(user=user)
+    finisher = asyncio.ensure_future(self._finish_in_background(task, check.pk, user.pk))
+    _background_tasks.add(finisher)
+    finisher.add_done_callback(_background_tasks.discard)
+    if task.done() and task.exception() is None:
+      return task.result()  # finished while the row was being written
+
+    jamb_requirements = await eligibility.course_requirements_query(
+      prepared["institution_name"], prepared["desired_course"]
+    ).afirst()
+    return eligibility.build_partial_result(prepared, check.pk, jamb_requirements)
+
+  async def post(self, request, *args, **kwargs):
+    serializer = EligibilityCheckRequestSerializer(data=self.data)
+    serializer.is_valid(raise_exception=True)
+    prepared = eligibility.prepare(serializer.validated_data)
+
+    try:
+      result = await aevaluate_locally(prepared)
+      if result is None:
+        result = await self._aevaluate_within_deadline(request.user, prepared)
+    except LLMUnavailableError as e:
+      logger.warning(f"Gemini unavailable for eligibility check: {e}")
+      jamb_requirements = await eligibility.course_requirements_query(
+        prepared["institution_name"], prepared["desired_course"]
+      ).afirst()
+      return JsonResponse(eligibility.build_partial_result(prepared, None, jamb_requirements), status=status.HTTP_200_OK)
+    except Exception as e:
+      return JsonResponse({"detail": eligibility.error_detail(e)}, status=status.HTTP_502_BAD_GATEWAY)
+
+    return JsonResponse(result, status=status.HTTP_200_OK)
+
+
+# Multi-target Eligibility Check View (async)
+class AsyncEligibilityBatchView(AsyncAIView):
+
+  async def post(self, request, *args, **kwargs):
+    serializer = EligibilityBatchRequestSerializer(data=self.data)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    profile = eligibility.analyse_profile(data)
+    targets = eligibility.dedupe_targets(data["targets"])
+    prepared = [eligibility.prepare_target(profile, t["institution_name"], t["desired_course"]) for t in targets]
+
+    semaphore = asyncio.Semaphore(settings.ELIGIBILITY_BATCH_MAX_WORKERS)
+
+    async def bounded(p):
+      async with semaphore:
+        return await aevaluate_eligibility(p, "eligibility_batch")
+
+    tasks = [asyncio.create_task(bounded(p)) for p in prepared]
+    done, pending = await asyncio.wait(tasks, timeout=settings.ELIGIBILITY_BATCH_DEADLINE)
+    for task in pending:
+      task.cancel()
+
+    results = []
+    for target, task in zip(targets, tasks):
+      if task not in done:
+        results.append(eligibility.target_result(target, "timeout", detail="Eligibility check did not finish before the batch deadline."))
+      elif task.exception() is not None:
+        results.append(eligibility.target_result(target, "error", detail=eligibility.error_detail(task.exception())))
+      else:
+        results.append(eligibility.target_result(target, "ok", result=task.result()))
+
+    return JsonResponse({"results": results, "deadline_exceeded": bool(pending)}, status=status.HTTP_200_OK)
+
+
+# Chatbot View (async)
+class AsyncChatbotView(AsyncAIView):
+
+  WRITE_BEHIND = settings.AI_CHAT_WRITE_BEHIND  # store the user message with the reply, in one insert
+
+  async def _resolve_conversation(self, user, conversation_id, message):
+    """Async counterpart of ChatbotAPIView._resolve_conversation."""
+    if conversation_id is not None:
+      conversation = await Conversation.objects.filter(pk=conversation_id, user=user).afirst()
+      error = conversation_error(conversation)
+      if error:
+        return None, JsonResponse({"detail": error[0]}, status=error[1])
+      return conversation, None
+
+    conversation = await Conversation.objects.filter(user=user, is_archived=False).afirst()
+    if conversation is None:
+      conversation = await Conversation.objects.acreate(user=user, title=new_conversation_title(message))
+    return conversation, None
+
+  async def _start_turn(self, request):
+    """
+    Async counterpart of ChatbotAPIView._start_turn.
+    Returns (user_message_obj, gemini_contents) or (None, error JsonResponse).
+    """
+    latest_user_message, conversation_id, error_detail = extract_chat_message(self.data)
+    if error_detail:
+      return None, JsonResponse({"detail": error_detail}, status=status.HTTP_400_BAD_REQUEST)
+
+    conversation, error_response = await self._resolve_conversation(request.user, conversation_id, latest_user_message)
+    if error_response:
+      return None, error_response
+
+    user_message_obj = ChatHistory(
+      user=request.user,
+      conversation=conversation,
+      role='user',
+      message=latest_user_message,
+    )
+    if not self.WRITE_BEHIND:
+      await user_message_obj.asave()
+
+    summary = await summary_query(conversation.id).afirst()
+    after = (summary[1], summary[2]) if summary else None
+
+    window = chat_history_window()
+    if user_message_obj.pk is None:
+      window.add_unsaved(user_message_obj.role, user_message_obj.message)
+    while window.wants_more():
+      window.feed([
+        row async for row in history_page(
+          conversation.id, batch_size=CHAT_HISTORY_BATCH_SIZE, before=window.before, after=after,
+        )
+      ])
+    return user_message_obj, format_chat_contents(window.history(), summary[0] if summary else None)
+
+  async def _abandon_turn(self, user_message_obj) -> None:
+    """Roll back the user message so history stays consistent (a no-op if it was never saved)."""
+    if user_message_obj.pk is not None:
+      await user_message_obj.adelete()
+
+  async def _agenerate_reply(self, full_contents: list[dict]) -> tuple[str, int]:
+    """Async counterpart of ChatbotAPIView._generate_reply."""
+    local = await sync_to_async(local_reply)(full_contents)
+    if local is not None:
+      return local, estimate_tokens(local)
+
+    # The index lives in this process; a rebuild is ORM work, so it runs in a thread
+    grounded = await sync_to_async(grounded_contents)(full_contents)
+    response = await llm.agenerate(grounded, priority="chat")
+    usage_rollup.record_llm_usage(response)
+    check_finish_reason(response)
+    remember_reply(full_contents, response.text)
+    return response.text, response.output_tokens
+
+  async def post(self, request, *args, **kwargs):
+    user_message_obj, full_contents = await self._start_turn(request)
+    if user_message_obj is None:
+      return full_contents
+
+    try:
+      bot_reply, output_tokens = await self._agenerate_reply(full_contents)
+
+      # One transaction for the whole turn; the async ORM has no atomic()
+      await sync_to_async(finish_turn)(user_message_obj, bot_reply, output_tokens)
+      return JsonResponse({"bot_reply": bot_reply, "conversation_id": user_message_obj.conversation_id}, status=status.HTTP_200_OK)
+
+    except Exception as e:
+      if isinstance(e, LLMUnavailableError):
+        logger.warning(f"Gemini unavailable for chatbot: {e}")
+        fallback = await sync_to_async(degraded_reply)(full_contents)
+        if fallback is not None:
+          await sync_to_async(finish_turn)(user_message_obj, fallback, estimate_tokens(fallback))
+          return JsonResponse(
+            {"bot_reply": fallback, "conversation_id": user_message_obj.conversation_id, "degraded": True},
+            status=status.HTTP_200_OK,
+          )
+
+      await self._abandon_turn(user_message_obj)
+
+      if isinstance(e, LLMUnavailableError):
+        return JsonResponse(
+          {"detail": chat_error_message(e)},
+          status=status.HTTP_503_SERVICE_UNAVAILABLE,
+          headers=retry_after_headers(e),
+        )
+      logger.exception(f"Error calling Gemini API for chatbot: {e}")
+      return JsonResponse(
+        {"detail": chat_error_message(e)},
+        status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+      )
+
+
+# Streaming chatbot view (async, Server-Sent Events)
+class AsyncChatbotStreamView(AsyncChatbotView):
+  """
+  Async counterpart of ChatbotStreamAPIView: the same SSE events, sent as
+  llm.astream yields them, with no worker thread held for the stream.
+  """
+
+  async def _astream_reply(self, user_message_obj, full_contents):
+    parts: list[str] = []
+    completed = False
+    try:
+      local = await sync_to_async(local_reply)(full_contents)
+      if local is not None:
+        last_chunk = LLMResponse(text=local, finish_reason="STOP", output_tokens=estimate_tokens(local))
+        parts.append(local)
+        yield sse_event("chunk", {"text": local})
+      else:
+        last_chunk = None
+        grounded = await sync_to_async(grounded_contents)(full_contents)
+        async for chunk in llm.astream(grounded, priority="chat", endpoint="chat_stream"):
+          last_chunk = chunk
+          if chunk.text:
+            parts.append(chunk.text)
+            yield sse_event("chunk", {"text": chunk.text})
+        if last_chunk is not None:
+          usage_rollup.record_llm_usage(last_chunk)  # Gemini's usage on the last chunk covers the stream
+
+      check_finish_reason(last_chunk or LLMResponse(text="", finish_reason="NO_CANDIDATE"))
+      if local is None:
+        remember_reply(full_contents, "".join(parts))
+
+      # Persist the full reply only once the stream has completed cleanly
+      await sync_to_async(finish_turn)(user_message_obj, "".join(parts), last_chunk.output_tokens)
+      completed = True
+      yield sse_event("done", {"conversation_id": user_message_obj.conversation_id})
+
+    except LLMUnavailableError as e:
+      logger.warning(f"Gemini unavailable for chatbot stream: {e}")
+      fallback = None if parts else await sync_to_async(degraded_reply)(full_contents)
+      if fallback is None:
+        yield sse_event("error", {"detail": chat_error_message(e)})
+      else:
+        await sync_to_async(finish_turn)(user_message_obj, fallback, estimate_tokens(fallback))
+        completed = True
+        yield sse_event("chunk", {"text": fallback})
+        yield sse_event("done", {"conversation_id": user_message_obj.conversation_id, "degraded": True})
+
+    except Exception as e:
+      logger.exception(f"Error streaming Gemini API response for chatbot: {e}")
+      yield sse_event("error", {"detail": chat_error_message(e)})
+
+    finally:
+      # Upstream failure or client disconnect (aclose()): roll the turn back
+      if not completed:
+        await self._abandon_turn(user_message_obj)
+
+  async def post(self, request, *args, **kwargs):
+    user_message_obj, full_contents = await self._start_turn(request)
+    if user_message_obj is None:
+      return full_contents
+
+    return sse_response(self._astream_reply(user_message_obj, full_contents))
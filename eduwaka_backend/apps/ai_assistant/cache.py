@@ -0,0 +1,362 @@
+import hashlib
+import json
+import logging
+import re
+import threading
+from datetime import timedelta
+
+from cachetools import LRUCache
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import Q
+from django.utils import timezone
+
+from . import metrics
+from .models import CachedEligibilityResult, CachedInstitutionOverview
+
+logger = logging.getLogger(__name__)
+
+# Well-known short names, resolved after punctuation/whitespace clean-up
+INSTITUTION_ABBREVIATIONS = {
+  "unilag": "university of lagos",
+  "ui": "university of ibadan",
+  "oau": "obafemi awolowo university",
+  "unn": "university of nigeria nsukka",
+  "abu": "ahmadu bello university",
+  "abu zaria": "ahmadu bello university",
+  "buk": "bayero university kano",
+  "uniben": "university of benin",
+  "unilorin": "university of ilorin",
+  "uniport": "university of port harcourt",
+  "unical": "university of calabar",
+  "uniuyo": "university of uyo",
+  "unijos": "university of jos",
+  "unimaid": "university of maiduguri",
+  "uniabuja": "university of abuja",
+  "lasu": "lagos state university",
+  "eksu": "ekiti state university",
+  "aaua": "adekunle ajasin university",
+  "nau": "nnamdi azikiwe university",
+  "unizik": "nnamdi azikiwe university",
+  "futa": "federal university of technology akure",
+  "futo": "federal university of technology owerri",
+  "futminna": "federal university of technology minna",
+  "funaab": "federal university of agriculture abeokuta",
+  "lautech": "ladoke akintola university of technology",
+  "yabatech": "yaba college of technology",
+  "laspotech": "lagos state polytechnic",
+}
+
+# Word-level expansions so "Fed. Univ. of Tech." and "Federal University of Technology" agree
+TOKEN_EXPANSIONS = {
+  "univ": "university",
+  "uni": "university",
+  "fed": "federal",
+  "tech": "technology",
+  "poly": "polytechnic",
+  "coll": "college",
+  "coe": "college of education",
+}
+
+_NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_institution_name(name: str) -> str:
+  """
+  Reduce an institution name to a stable cache key:
+  lower-case, punctuation stripped, whitespace collapsed, abbreviations expanded.
+  """
+  cleaned = _NON_ALNUM.sub(" ", name.lower().replace("&", " and ")).split()
+  if cleaned and cleaned[0] == "the":
+    cleaned = cleaned[1:]
+
+  key = " ".join(cleaned)
+  if key in INSTITUTION_ABBREVIATIONS:
+    return INSTITUTION_ABBREVIATIONS[key]
+
+  return " ".join(TOKEN_EXPANSIONS.get(token, token) for token in cleaned)
+
+
+def normalize_course_name(name: str) -> str:
+  """Lower-case, punctuation stripped, whitespace collapsed."""
+  return " ".join(_NON_ALNUM.sub(" ", name.lower()).split())[:255]
+
+
+def eligibility_cache_key(
+    *,
+    institution_name: str,
+    desired_course: str,
+    o_level_sittings: int,
+    credit_report: dict,
+    jamb_score: int,
+    jamb_subjects: list[str],
+) -> str:
+  """
+  Canonical hash of an eligibility submission. Uses the parsed sittings from the
+  credit report, so "Eng: A1" and "English Language - A1" land on the same key.
+  """
+  payload = {
+    "institution": normalize_institution_name(institution_name),
+    "course": normalize_course_name(desired_course),
+    "o_level_sittings": o_level_sittings,
+    "sitting1": sorted(credit_report["sitting1"].items()),
+    "sitting2": sorted(credit_report["sitting2"].items()),
+    "jamb_score": jamb_score,
+    "jamb_subjects": sorted(set(jamb_subjects)),
+  }
+  return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class InstitutionOverviewCache:
+  """
+  Read-through cache for parsed institution overviews.
+
+  A small in-process LRU sits in front of the CachedInstitutionOverview table,
+  so warm lookups never touch the DB and entries survive restarts.
+  Negative answers ({"error": ...}) are cached too, with their own shorter TTL,
+  so repeated typos and bot traffic never reach Gemini twice. Expired positive
+  rows are kept for another `stale_ttl` seconds, to be served while Gemini is down.
+  """
+
+  def __init__(self, ttl: int, negative_ttl: int, lru_size: int, stale_ttl: int = 0):
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.stale_ttl = stale_ttl
+    self._lru = LRUCache(maxsize=lru_size)
+    self._lock = threading.Lock()
+    self._stats = {"hits": 0, "negative_hits": 0, "misses": 0}
+
+  METRIC_RESULTS = {"hits": "hit", "negative_hits": "negative_hit", "misses": "miss"}
+
+  def _key(self, institution_name: str) -> str:
+    return normalize_institution_name(institution_name)[:255]
+
+  def _record(self, outcome: str) -> None:
+    with self._lock:
+      self._stats[outcome] += 1
+    metrics.cache_lookups.labels("institution_overview", self.METRIC_RESULTS[outcome]).inc()
+
+  def _lru_lookup(self, key: str) -> tuple[bool, dict] | None:
+    with self._lock:
+      entry = self._lru.get(key)
+    if entry is None:
+      return None
+
+    expires_at, is_negative, data = entry
+    if expires_at > timezone.now():
+      return is_negative, data
+    with self._lock:
+      self._lru.pop(key, None)
+    return None
+
+  def _lru_store(self, key: str, expires_at, is_negative: bool, data: dict) -> None:
+    with self._lock:
+      self._lru[key] = (expires_at, is_negative, data)
+
+  def _lookup(self, key: str) -> tuple[bool, dict] | None:
+    found = self._lru_lookup(key)
+    if found is not None:
+      return found
+
+    try:
+      row = CachedInstitutionOverview.objects.filter(key=key, expires_at__gt=timezone.now()).first()
+    except DatabaseError as e:
+      logger.warning(f"Institution overview cache lookup failed: {e}")
+      return None
+    if row is None:
+      return None
+
+    self._lru_store(key, row.expires_at, row.is_negative, row.data)
+    return row.is_negative, row.data
+
+  async def _alookup(self, key: str) -> tuple[bool, dict] | None:
+    found = self._lru_lookup(key)
+    if found is not None:
+      return found
+
+    try:
+      row = await CachedInstitutionOverview.objects.filter(key=key, expires_at__gt=timezone.now()).afirst()
+    except DatabaseError as e:
+      logger.warning(f"Institution overview cache lookup failed: {e}")
+      return None
+    if row is None:
+      return None
+
+    self._lru_store(key, row.expires_at, row.is_negative, row.data)
+    return row.is_negative, row.data
+
+  def _count(self, found: tuple[bool, dict] | None) -> dict | None:
+    if found is None:
+      self._record("misses")
+      return None
+
+    is_negative, data = found
+    self._record("negative_hits" if is_negative else "hits")
+    return data
+
+  def get(self, institution_name: str) -> dict | None:
+    """
+    Return the cached overview, or the cached {"error": ...} payload for a
+    known-bad name. None means the caller has to ask the model.
+    """
+    return self._count(self._lookup(self._key(institution_name)))
+
+  async def aget(self, institution_name: str) -> dict | None:
+    return self._count(await self._alookup(self._key(institution_name)))
+
+  def _stale_query(self, institution_name: str):
+    return CachedInstitutionOverview.objects.filter(
+      key=self._key(institution_name),
+      is_negative=False,
+      expires_at__gt=timezone.now() - timedelta(seconds=self.stale_ttl),
+    ).values_list("data", flat=True)
+
+  def get_stale(self, institution_name: str) -> dict | None:
+    """The stored overview even if it has expired; served while Gemini is unavailable."""
+    try:
+      return self._stale_query(institution_name).first()
+    except DatabaseError as e:
+      logger.warning(f"Institution overview cache lookup failed: {e}")
+      return None
+
+  async def aget_stale(self, institution_name: str) -> dict | None:
+    try:
+      return await self._stale_query(institution_name).afirst()
+    except DatabaseError as e:
+      logger.warning(f"Institution overview cache lookup failed: {e}")
+      return None
+
+  def _prepare_store(self, institution_name: str, data: dict, is_negative: bool) -> tuple[str, dict]:
+    key = self._key(institution_name)
+    ttl = self.negative_ttl if is_negative else self.ttl
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+    self._lru_store(key, expires_at, is_negative, data)
+    return key, {
+      "institution_name": institution_name,
+      "data": data,
+      "is_negative": is_negative,
+      "expires_at": expires_at,
+    }
+
+  def _store(self, institution_name: str, data: dict, is_negative: bool) -> None:
+    key, defaults = self._prepare_store(institution_name, data, is_negative)
+    try:
+      CachedInstitutionOverview.objects.update_or_create(key=key, defaults=defaults)
+    except DatabaseError as e:
+      logger.warning(f"Institution overview cache write failed: {e}")
+
+  async def _astore(self, institution_name: str, data: dict, is_negative: bool) -> None:
+    key, defaults = self._prepare_store(institution_name, data, is_negative)
+    try:
+      await CachedInstitutionOverview.objects.aupdate_or_create(key=key, defaults=defaults)
+    except DatabaseError as e:
+      logger.warning(f"Institution overview cache write failed: {e}")
+
+  def set(self, institution_name: str, data: dict) -> None:
+    self._store(institution_name, data, is_negative=False)
+
+  def set_negative(self, institution_name: str, data: dict) -> None:
+    self._store(institution_name, data, is_negative=True)
+
+  async def aset(self, institution_name: str, data: dict) -> None:
+    await self._astore(institution_name, data, is_negative=False)
+
+  async def aset_negative(self, institution_name: str, data: dict) -> None:
+    await self._astore(institution_name, data, is_negative=True)
+
+  def stats(self) -> dict:
+    """Hit/miss counters for this process; every hit is one Gemini call saved."""
+    with self._lock:
+      stats = dict(self._stats)
+    lookups = sum(stats.values())
+    stats["lookups"] = lookups
+    stats["hit_rate"] = round((stats["hits"] + stats["negative_hits"]) / lookups, 4) if lookups else 0.0
+    return stats
+
+  def clear(self) -> None:
+    """Drop the in-process layer only; DB rows expire on their own."""
+    with self._lock:
+      self._lru.clear()
+
+  def prune(self) -> int:
+    """
+    Delete expired negative rows, and positive rows past the stale window,
+    from the DB table. Returns the number removed.
+    """
+    now = timezone.now()
+    deleted, _ = CachedInstitutionOverview.objects.filter(
+      Q(is_negative=True, expires_at__lte=now) | Q(expires_at__lte=now - timedelta(seconds=self.stale_ttl))
+    ).delete()
+    return deleted
+
+
+class EligibilityResultCache:
+  """
+  DB-backed cache of final eligibility results. There is no in-process layer:
+  entries are invalidated when a Course changes, and every worker must see that.
+  """
+
+  def __init__(self, ttl: int):
+    self.ttl = ttl
+
+  def _count(self, row) -> dict | None:
+    metrics.cache_lookups.labels("eligibility", "hit" if row else "miss").inc()
+    return row.data if row else None
+
+  def get(self, key: str) -> dict | None:
+    try:
+      row = CachedEligibilityResult.objects.filter(key=key, expires_at__gt=timezone.now()).only("data").first()
+    except DatabaseError as e:
+      logger.warning(f"Eligibility cache lookup failed: {e}")
+      return None
+    return self._count(row)
+
+  async def aget(self, key: str) -> dict | None:
+    try:
+      row = await CachedEligibilityResult.objects.filter(key=key, expires_at__gt=timezone.now()).only("data").afirst()
+    except DatabaseError as e:
+      logger.warning(f"Eligibility cache lookup failed: {e}")
+      return None
+    return self._count(row)
+
+  def _defaults(self, course_key: str, data: dict) -> dict:
+    return {
+      "course_key": course_key,
+      "data": data,
+      "expires_at": timezone.now() + timedelta(seconds=self.ttl),
+    }
+
+  def set(self, key: str, course_key: str, data: dict) -> None:
+    try:
+      CachedEligibilityResult.objects.update_or_create(key=key, defaults=self._defaults(course_key, data))
+    except DatabaseError as e:
+      logger.warning(f"Eligibility cache write failed: {e}")
+
+  async def aset(self, key: str, course_key: str, data: dict) -> None:
+    try:
+      await CachedEligibilityResult.objects.aupdate_or_create(key=key, defaults=self._defaults(course_key, data))
+    except DatabaseError as e:
+      logger.warning(f"Eligibility cache write failed: {e}")
+
+  def invalidate_course(self, course_name: str) -> int:
+    """
+    Drop every cached result for a course name, at any institution. Institution
+    names are free text in requests, so matching on the course alone is the
+    safe (over-)approximation.
+    """
+    deleted, _ = CachedEligibilityResult.objects.filter(course_key=normalize_course_name(course_name)).delete()
+    return deleted
+
+  def prune(self) -> int:
+    deleted, _ = CachedEligibilityResult.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
+
+
+institution_overview_cache = InstitutionOverviewCache(
+  ttl=settings.INSTITUTION_OVERVIEW_CACHE_TTL,
+  negative_ttl=settings.INSTITUTION_OVERVIEW_NEGATIVE_CACHE_TTL,
+  lru_size=settings.INSTITUTION_OVERVIEW_CACHE_LRU_SIZE,
+  stale_ttl=settings.INSTITUTION_OVERVIEW_STALE_TTL,
+)
+
+eligibility_result_cache = EligibilityResultCache(ttl=settings.ELIGIBILITY_CACHE_TTL)
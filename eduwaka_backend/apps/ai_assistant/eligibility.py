@@ -0,0 +1,525 @@
+"""
+The deterministic side of eligibility checks: credit analysis, the Gemini
+prompt, rule enforcement and the results built without Gemini. Shared by the
+sync views (views.py) and the native async ones (async_views.py).
+"""
+import json
+import logging
+import re
+
+from django.db import DatabaseError
+from django.db.models import Q
+
+from apps.courses.models import Course
+from .cache import eligibility_cache_key, normalize_course_name, normalize_institution_name
+from .models import EligibilityCheck
+from .olevel import (
+  COMPULSORY_SUBJECTS,
+  CREDIT_GRADES,
+  combine_sittings,
+  normalise_jamb_subject,
+  parse_sitting,
+)
+from .resilience import LLMUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# Structured output contract for eligibility checks
+ELIGIBILITY_GENERATION_CONFIG = {
+  "response_mime_type": "application/json",
+  "response_schema": {
+    "type": "OBJECT",
+    "properties": {
+      "eligibility_status":       {"type": "STRING"},
+      "is_eligible":              {"type": "BOOLEAN"},
+      "reasons":                  {"type": "ARRAY", "items": {"type": "STRING"}},
+      "missing_requirements":     {"type": "ARRAY", "items": {"type": "STRING"}},
+      "recommended_actions":      {"type": "ARRAY", "items": {"type": "STRING"}},
+      "suggested_courses":        {"type": "ARRAY", "items": {"type": "STRING"}},
+      "o_level_credits_required": {"type": "NUMBER"},
+      "o_level_sittings_accepted":{"type": "NUMBER"},
+      "jamb_subject_match":       {"type": "BOOLEAN"},
+      "jamb_subject_issues":      {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": [
+      "eligibility_status", "is_eligible", "reasons",
+      "missing_requirements", "recommended_actions",
+      "suggested_courses", "jamb_subject_match", "jamb_subject_issues",
+    ],
+  },
+}
+
+
+def analyse_credits(
+  sitting1_text: str,
+  sitting2_text: str,
+  use_two_sittings: bool,
+) -> dict:
+  """
+  Returns a structured credit report:
+  {
+    "sitting1": {subject: grade},
+    "sitting2": {subject: grade},
+    "combined": {subject: grade},
+    "credit_subjects": [subject],       # subjects with credit grades
+    "total_credits": int,
+    "has_english": bool,
+    "has_mathematics": bool,
+    "has_compulsory": bool,
+    "has_min_credits": bool,            # ≥ 5 credits incl. English & Maths
+    "missing_compulsory": [subject],
+  }
+  """
+  s1 = parse_sitting(sitting1_text)
+  s2 = parse_sitting(sitting2_text) if use_two_sittings else {}
+  combined = combine_sittings(s1, s2)
+
+  credit_subjects = [subj for subj, grade in combined.items() if grade.lower() in CREDIT_GRADES]
+
+  has_english = "english" in credit_subjects
+  has_mathematics = "mathematics" in credit_subjects
+  missing_compulsory = [s for s in COMPULSORY_SUBJECTS if s not in credit_subjects]
+
+  total_credits = len(credit_subjects)
+  has_min_credits = total_credits >= 5 and has_english and has_mathematics
+
+  return {
+    "sitting1": s1,
+    "sitting2": s2,
+    "combined": combined,
+    "credit_subjects": credit_subjects,
+    "total_credits": total_credits,
+    "has_english": has_english,
+    "has_mathematics": has_mathematics,
+    "has_compulsory": has_english and has_mathematics,
+    "has_min_credits": has_min_credits,
+    "missing_compulsory": missing_compulsory,
+  }
+
+
+#  Prompt builder
+def build_prompt(
+  *,
+  institution_name: str,
+  desired_course: str,
+  o_level_sittings: int,
+  o_level_results_combined: str,
+  jamb_score: int,
+  jamb_subjects: str,
+  credit_report: dict,
+) -> str:
+  # Pre-compute human-readable summaries so the model has less to infer
+  credit_list = ", ".join(credit_report["credit_subjects"]) or "None detected"
+  missing_compulsory = (
+    ", ".join(credit_report["missing_compulsory"]).title()
+    if credit_report["missing_compulsory"]
+    else "None"
+  )
+  flags = []
+  if not credit_report["has_min_credits"]:
+    flags.append(
+      f"INSUFFICIENT O'LEVEL CREDITS: student has {credit_report['total_credits']} credit(s) "
+      f"(need ≥5 including English and Mathematics). "
+      f"Missing compulsory subjects with credit grade: {missing_compulsory}."
+    )
+  if jamb_score < 180:
+    flags.append(
+      f"INSUFFICIENT JAMB SCORE: {jamb_score} is below the 180 minimum. "
+      "Status must be 'fixable' and suggested_courses must be empty."
+    )
+  flags_block = "\n".join(f"  ⚠ {f}" for f in flags) if flags else "  ✓ O'Level credits and JAMB score meet baseline requirements."
+
+  return f"""
+        You are a Nigerian university admissions eligibility advisor (JAMB/WAEC system).
+        Your job is to evaluate whether a student can gain admission to their desired course
+        and institution, and to give actionable, specific guidance.
+
+        ================
+        ADMISSION RULES
+        ================
+        1. O'Level: minimum 5 credits (A1–C6), MUST include English Language and Mathematics.
+        2. O'Level sittings: maximum {o_level_sittings} sitting(s) are accepted by this institution.
+        3. JAMB: minimum score of 180; competitive courses (Medicine, Law, Engineering) typically
+          require 200+.
+        4. JAMB subjects must match the standard combination for the desired course.
+        5. If a subject appears in both sittings, only the BEST grade counts (no double-counting).
+
+        ================
+        PRE-COMPUTED FLAGS (treat these as ground truth)
+        ================
+        {flags_block}
+
+        Detected credit subjects: {credit_list}
+        Total unique credits: {credit_report['total_credits']}
+
+        ================
+        STUDENT PROFILE
+        ================
+        Institution  : {institution_name}
+        Desired Course: {desired_course}
+
+        O'Level Results ({o_level_sittings} sitting(s)):
+        {o_level_results_combined}
+
+        JAMB Score   : {jamb_score}
+        JAMB Subjects: {jamb_subjects}
+
+        ================
+        EVALUATION INSTRUCTIONS
+        ================
+        Step 1 — Determine eligibility_status:
+          • "eligible"   → credits ≥ 5 (incl. English & Maths) AND JAMB ≥ 180
+                          AND JAMB subjects match the course.
+          • "fixable"    → one or more issues exist but can be resolved by retaking
+                          exams or adjusting subjects.
+          • "not_viable" → issues that cannot realistically be fixed (e.g., age limit,
+                          course not offered at institution).
+
+        Step 2 — Populate reasons[]:
+          List every specific reason the student is or isn't eligible.
+          Reference actual subjects and scores. Be concrete, not generic.
+
+        Step 3 — Populate missing_requirements[]:
+          List only items the student still needs (e.g., "Credit in Mathematics",
+          "JAMB score of at least 180"). Leave empty if fully eligible.
+
+        Step 4 — Populate recommended_actions[]:
+          Give specific, numbered, actionable steps the student should take.
+          Always present even if eligible (e.g., "Apply before deadline", "Check
+          post-UTME cut-off for {institution_name}").
+
+        Step 5 — Populate suggested_courses[]:
+          ONLY populate if credits ≥ 5 AND JAMB ≥ 180.
+          Suggest 2–4 related courses at the same institution that the student's
+          current profile supports. Leave as [] otherwise.
+
+        Step 6 — JAMB subject check:
+          Compare the student's JAMB subjects against the standard Nigerian JAMB
+          combination for "{desired_course}". Flag any mismatch clearly in reasons[].
+
+        ================
+        HARD CONSTRAINTS (never violate these)
+        ================
+        - If pre-computed flags show INSUFFICIENT credits or INSUFFICIENT JAMB:
+            - eligibility_status MUST be "fixable"
+            - is_eligible MUST be false
+            - suggested_courses MUST be []
+        - Never invent grades or subjects not present in the student's data.
+        - Do not use generic advice — reference the student's actual subjects and score.
+
+        ================
+        OUTPUT — return ONLY valid JSON, no markdown, no explanation
+        ================
+        {{
+          "eligibility_status": "eligible" | "fixable" | "not_viable",
+          "is_eligible": boolean,
+          "reasons": string[],
+          "missing_requirements": string[],
+          "recommended_actions": string[],
+          "suggested_courses": string[],
+          "o_level_credits_required": 5,
+          "o_level_sittings_accepted": {o_level_sittings},
+          "jamb_subject_match": boolean,
+          "jamb_subject_issues": string[]
+        }}
+      """
+
+
+def analyse_profile(data: dict) -> dict:
+  """
+  Normalise the student's results and run the deterministic credit analysis.
+  Independent of the target, so a multi-target check does this once.
+  """
+  o_level_sittings  = int(data["o_level_sittings"])   # normalise to int
+  sitting1_text     = data["o_level_sitting_1"]
+  sitting2_text     = data.get("o_level_sitting_2", "") or ""
+  jamb_score        = int(data["jamb_score"])
+  raw_jamb_subjects = data["jamb_subjects"]
+
+  # Normalise JAMB subjects to clean comma-separated string
+  if isinstance(raw_jamb_subjects, list):
+    jamb_subjects = ", ".join(s.strip() for s in raw_jamb_subjects if s.strip())
+  else:
+    jamb_subjects = ", ".join(s.strip() for s in raw_jamb_subjects.split(",") if s.strip())
+
+  use_two_sittings = o_level_sittings == 2 and bool(sitting2_text)
+
+  #  Deterministic credit analysis (source of truth) ─
+  credit_report = analyse_credits(sitting1_text, sitting2_text, use_two_sittings)
+
+  #  Build O'Level display block for prompt 
+  o_level_display = f"1st Sitting: {sitting1_text}"
+  if use_two_sittings:
+    o_level_display += f"\n2nd Sitting: {sitting2_text}"
+
+  return {
+    "o_level_sittings": o_level_sittings,
+    "o_level_display": o_level_display,
+    "credit_report": credit_report,
+    "jamb_score": jamb_score,
+    "jamb_subjects": jamb_subjects,
+    "jamb_subject_list": [normalise_jamb_subject(s) for s in jamb_subjects.split(",") if s.strip()],
+  }
+
+
+def prepare_target(profile: dict, institution_name: str, desired_course: str) -> dict:
+  """Build the prompt and cache key for one institution/course on top of an analysed profile."""
+  credit_report = profile["credit_report"]
+  jamb_score = profile["jamb_score"]
+
+  #  Build prompt 
+  prompt = build_prompt(
+    institution_name=institution_name,
+    desired_course=desired_course,
+    o_level_sittings=profile["o_level_sittings"],
+    o_level_results_combined=profile["o_level_display"],
+    jamb_score=jamb_score,
+    jamb_subjects=profile["jamb_subjects"],
+    credit_report=credit_report,
+  )
+
+  cache_key = eligibility_cache_key(
+    institution_name=institution_name,
+    desired_course=desired_course,
+    o_level_sittings=profile["o_level_sittings"],
+    credit_report=credit_report,
+    jamb_score=jamb_score,
+    jamb_subjects=profile["jamb_subject_list"],
+  )
+
+  return {
+    "prompt": prompt,
+    "credit_report": credit_report,
+    "jamb_score": jamb_score,
+    "cache_key": cache_key,
+    "course_key": normalize_course_name(desired_course),
+    "institution_name": institution_name,
+    "desired_course": desired_course,
+    "o_level_sittings": profile["o_level_sittings"],
+    "jamb_subject_list": profile["jamb_subject_list"],
+    # Baseline failures are fully decided by rules; no LLM judgement needed
+    "needs_llm": credit_report["has_min_credits"] and jamb_score >= 180,
+  }
+
+
+def prepare(data: dict) -> dict:
+  """
+  Normalise validated input, run the deterministic credit analysis and build
+  the prompt. Returns {"prompt", "credit_report", "jamb_score", "cache_key", "course_key", ...}.
+  """
+  profile = analyse_profile(data)
+  return prepare_target(profile, data["institution_name"], data["desired_course"])
+
+
+#  Rules-only fast path
+def course_requirements_query(institution_name: str, desired_course: str):
+  return (
+    Course.objects
+    .filter(name__iexact=desired_course.strip())
+    .filter(Q(institution__name__iexact=institution_name.strip()) | Q(institution__abbreviation__iexact=institution_name.strip()))
+    .exclude(jamb_requirements__isnull=True)
+    .values_list("jamb_requirements", flat=True)
+  )
+
+
+def check_jamb_subjects(
+  desired_course: str,
+  jamb_subjects: list[str],
+  jamb_requirements: str | None,
+) -> list[str]:
+  """
+  Deterministic JAMB combination check. Returns issues ([] if none found).
+  Course-specific checks only run when the catalog has the course's requirements.
+  """
+  issues: list[str] = []
+  if "english" not in jamb_subjects:
+    issues.append("Use of English is compulsory in UTME but is missing from your JAMB subjects.")
+  if len(jamb_subjects) != 4:
+    issues.append(f"UTME is written in exactly 4 subjects; you listed {len(jamb_subjects)}.")
+
+  if jamb_requirements:
+    for item in re.split(r'[,;]|\band\b', jamb_requirements, flags=re.IGNORECASE):
+      item = item.strip(" .")
+      if not item or item.lower().startswith("any"):
+        continue
+      alternatives = [normalise_jamb_subject(a) for a in re.split(r'/|\bor\b', item, flags=re.IGNORECASE) if a.strip()]
+      if alternatives and not any(a in jamb_subjects for a in alternatives):
+        issues.append(f"{desired_course} requires {item} in UTME, which is not among your JAMB subjects.")
+
+  return list(dict.fromkeys(issues))
+
+
+def build_local_result(prepared: dict, jamb_requirements: str | None) -> dict:
+  """
+  Complete response for students who fail the baseline (credits or JAMB
+  score), built from templates. enforce() adds the missing requirements and
+  retake actions, exactly as it would on top of a model answer.
+  """
+  credit_report = prepared["credit_report"]
+  jamb_score = prepared["jamb_score"]
+  institution_name = prepared["institution_name"]
+  desired_course = prepared["desired_course"]
+
+  reasons: list[str] = []
+  actions: list[str] = []
+
+  if not credit_report["has_min_credits"]:
+    credit_list = ", ".join(s.title() for s in credit_report["credit_subjects"]) or "none detected"
+    reasons.append(
+      f"You have {credit_report['total_credits']} O'Level credit(s) (A1–C6): {credit_list}. "
+      f"At least 5 credits, including English Language and Mathematics, are required."
+    )
+    if credit_report["missing_compulsory"]:
+      reasons.append(
+        f"No credit grade was found in: {', '.join(s.title() for s in credit_report['missing_compulsory'])}."
+      )
+
+  if jamb_score < 180:
+    reasons.append(f"Your JAMB score of {jamb_score} is below the 180 minimum required for admission.")
+
+  jamb_issues = check_jamb_subjects(desired_course, prepared["jamb_subject_list"], jamb_requirements)
+  reasons.extend(jamb_issues)
+  if jamb_issues:
+    actions.append(f"Register the correct UTME subject combination for {desired_course} when you next sit JAMB.")
+  actions.append(f"Check the {institution_name} admission requirements for {desired_course} before your next attempt.")
+
+  result = {
+    "eligibility_status": "fixable",
+    "is_eligible": False,
+    "reasons": reasons,
+    "missing_requirements": [],
+    "recommended_actions": actions,
+    "suggested_courses": [],
+    "o_level_credits_required": 5,
+    "o_level_sittings_accepted": prepared["o_level_sittings"],
+    "jamb_subject_match": not jamb_issues,
+    "jamb_subject_issues": jamb_issues,
+  }
+  return enforce(result, credit_report, jamb_score)
+
+
+def enforce(result: dict, credit_report: dict, jamb_score: int) -> dict:
+  """Hard enforcement — override anything the AI got wrong."""
+  has_min_credits = credit_report["has_min_credits"]
+  has_valid_jamb  = jamb_score >= 180
+
+  actions: list[str] = list(result.get("recommended_actions") or [])
+  missing: list[str] = list(result.get("missing_requirements") or [])
+
+  if not has_min_credits:
+    credits_have = credit_report["total_credits"]
+    missing_comp = credit_report["missing_compulsory"]
+
+    missing_items = [f"At least 5 O'Level credits including English and Mathematics (you have {credits_have})"]
+    if missing_comp:
+      missing_items.append(f"Credit grade in: {', '.join(s.title() for s in missing_comp)}")
+
+    missing = list(set(missing + missing_items))
+    actions.append(
+      f"Retake WAEC/NECO to obtain at least 5 credits (A1–C6) including English and Mathematics. "
+      f"You currently have {credits_have} valid credit(s)."
+      + (f" You are missing a credit in: {', '.join(s.title() for s in missing_comp)}." if missing_comp else "")
+    )
+
+  if not has_valid_jamb:
+    missing.append(f"JAMB score of at least 180 (you scored {jamb_score})")
+    actions.append(
+      f"Rewrite JAMB. Your current score of {jamb_score} is below the minimum of 180. "
+      "Competitive courses like Medicine or Engineering require 200+."
+    )
+
+  if not (has_min_credits and has_valid_jamb):
+    result["eligibility_status"] = "fixable"
+    result["is_eligible"]        = False
+    result["suggested_courses"]  = []   # final hard clear — no courses if not qualified
+
+  # Deduplicate & write back
+  result["recommended_actions"]  = list(dict.fromkeys(actions))   # preserves order, removes dupes
+  result["missing_requirements"] = list(dict.fromkeys(missing))
+
+  # Guarantee all array fields exist
+  for field in ("reasons", "jamb_subject_issues"):
+    result.setdefault(field, [])
+
+  return result
+
+
+def build_partial_result(prepared: dict, check_id, jamb_requirements: str | None) -> dict:
+  """
+  What the rules decide without Gemini, for a check that missed the deadline
+  (check_id: where the full result will be stored) or that Gemini can't answer
+  right now (check_id None): credit report, UTME subject check and the enforced
+  status. Only qualified students get here (see needs_llm), so the verdict
+  itself is left pending.
+  """
+  credit_report = prepared["credit_report"]
+  desired_course = prepared["desired_course"]
+  jamb_issues = check_jamb_subjects(desired_course, prepared["jamb_subject_list"], jamb_requirements)
+
+  credit_list = ", ".join(s.title() for s in credit_report["credit_subjects"])
+  reasons = [
+    f"You have {credit_report['total_credits']} O'Level credit(s) (A1–C6), including English Language and Mathematics: {credit_list}.",
+    f"Your JAMB score of {prepared['jamb_score']} meets the 180 minimum.",
+  ] + jamb_issues
+  actions = [f"Register the correct UTME subject combination for {desired_course} when you next sit JAMB."] if jamb_issues else []
+  if check_id is None:
+    actions.append("Our AI assistant is unavailable right now. Submit this check again in a few minutes for the full assessment.")
+
+  result = {
+    "eligibility_status": "pending",
+    "is_eligible": None,
+    "reasons": reasons,
+    "missing_requirements": [],
+    "recommended_actions": actions,
+    "suggested_courses": [],
+    "o_level_credits_required": 5,
+    "o_level_sittings_accepted": prepared["o_level_sittings"],
+    "jamb_subject_match": not jamb_issues,
+    "jamb_subject_issues": jamb_issues,
+    "credit_report": {
+      key: credit_report[key]
+      for key in ("total_credits", "credit_subjects", "missing_compulsory", "has_min_credits")
+    },
+  }
+  result = enforce(result, credit_report, prepared["jamb_score"])
+  result["partial"] = True
+  if check_id is not None:
+    result["result_id"] = str(check_id)
+  return result
+
+
+#  Outcomes
+def error_detail(error: Exception) -> str:
+  if isinstance(error, json.JSONDecodeError):
+    return f"AI returned malformed JSON: {error}"
+  if isinstance(error, LLMUnavailableError):
+    return "The AI service is temporarily unavailable. Please try again shortly."
+  return f"AI service error: {error}"
+
+
+def store_check(check_id, user_id: int, result: dict | None, error: Exception | None) -> None:
+  fields = {"status": "complete", "result": result} if error is None else {"status": "failed", "error": error_detail(error)}
+  try:
+    EligibilityCheck.objects.update_or_create(pk=check_id, defaults={"user_id": user_id, **fields})
+  except DatabaseError as e:
+    logger.warning(f"Could not store eligibility check {check_id}: {e}")
+
+
+def dedupe_targets(targets: list[dict]) -> list[dict]:
+  unique = {}
+  for target in targets:
+    key = (
+      normalize_institution_name(target["institution_name"]),
+      normalize_course_name(target["desired_course"]),
+    )
+    unique.setdefault(key, target)
+  return list(unique.values())
+
+
+def target_result(target: dict, outcome: str, **extra) -> dict:
+  return {
+    "institution_name": target["institution_name"],
+    "desired_course": target["desired_course"],
+    "status": outcome,
+    **extra,
+  }
@@ -0,0 +1,247 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import IntegrityError, connections
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from .llm import LLMClient, check_finish_reason, estimate_tokens
+from .models import ChatHistory, ConversationSummary
+
+logger = logging.getLogger(__name__)
+
+
+#  Keyset helpers over (timestamp, id)
+def after_position(position: tuple) -> Q:
+  timestamp, pk = position
+  return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+
+
+def before_position(position: tuple) -> Q:
+  timestamp, pk = position
+  return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+
+
+def history_page(conversation_id: int, *, batch_size: int, before: tuple | None = None, after: tuple | None = None):
+  """
+  One batch of (id, timestamp, role, message, token_count) rows, newest first.
+  A LIMITed backward scan of the (conversation, timestamp) index, so the cost
+  does not grow with the size of the thread.
+  """
+  history = ChatHistory.objects.filter(conversation_id=conversation_id)
+  if before:
+    history = history.filter(before_position(before))
+  if after:
+    history = history.filter(after_position(after))
+  return (
+    history.order_by('-timestamp', '-id')  # id breaks same-microsecond ties
+    .values_list('id', 'timestamp', 'role', 'message', 'token_count')[:batch_size]
+  )
+
+
+def summary_query(conversation_id: int):
+  """(summary, summarized_until, summarized_until_id) for the conversation, if any."""
+  return (
+    ConversationSummary.objects.filter(conversation_id=conversation_id)
+    .values_list('summary', 'summarized_until', 'summarized_until_id')
+  )
+
+
+class HistoryWindow:
+  """
+  Chooses which past messages go into the chatbot context. Fed batches of
+  history rows newest first; keeps whole turns (a user message plus the
+  replies that followed it) while they fit the token budget. The newest turn
+  (the message being answered) is always kept.
+  """
+
+  def __init__(self, token_budget: int, max_messages: int, batch_size: int):
+    self.token_budget = token_budget
+    self.max_messages = max_messages
+    self.batch_size = batch_size
+    self.before = None            # keyset position of the oldest row seen
+    self.oldest_kept = None       # keyset position of the oldest row selected
+    self.tokens_used = 0
+    self._selected: list[tuple[str, str]] = []
+    self._turn: list[tuple[str, str]] = []
+    self._turn_tokens = 0
+    self._done = False
+
+  def wants_more(self) -> bool:
+    return not self._done
+
+  def _take(self, role: str, message: str, tokens: int) -> bool:
+    """Adds one message (reading backwards); False once the window is full."""
+    self._turn.append((role, message))
+    self._turn_tokens += tokens
+    if len(self._selected) + len(self._turn) > self.max_messages:
+      self._done = True
+      return False
+
+    if role == "user":
+      # A turn starts here (reading backwards): keep it whole or stop
+      if self._selected and self.tokens_used + self._turn_tokens > self.token_budget:
+        self._done = True
+        return False
+      self._selected.extend(self._turn)
+      self.tokens_used += self._turn_tokens
+      self._turn, self._turn_tokens = [], 0
+    return True
+
+  def add_unsaved(self, role: str, message: str) -> None:
+    """A message not written to the database yet; newer than every stored row."""
+    self._take(role, message, estimate_tokens(message))
+
+  def feed(self, rows: list) -> None:
+    for pk, timestamp, role, message, token_count in rows:
+      if not self._take(role, message, token_count or estimate_tokens(message)):
+        return
+      if role == "user":
+        self.oldest_kept = (timestamp, pk)
+      self.before = (timestamp, pk)
+
+    if len(rows) < self.batch_size:
+      self._done = True   # reached the start of the history
+
+  def history(self) -> list[tuple[str, str]]:
+    """Selected (role, message) rows, newest first."""
+    return list(self._selected)
+
+
+class HistoryCompactor:
+  """
+  Rolling summarisation of long conversations, run off the request path.
+
+  Once the messages not yet covered by a thread's summary add up to more than
+  trigger_tokens, everything but the newest keep_tokens worth of whole turns
+  is folded, together with the previous summary, into a new summary. The
+  chatbot then sends that summary instead of the raw older messages.
+
+  schedule() hands the work to a single background thread per process and
+  ignores conversations that already have a compaction queued.
+  """
+
+  SUMMARY_PROMPT = (
+    "You maintain the memory of a conversation between a student and EduWaka, an assistant "
+    "for Nigerian university admissions. Rewrite the existing summary so it also covers the "
+    "new messages. Keep what the assistant will need later: the student's target institutions "
+    "and courses, O'Level results, JAMB score and subjects, deadlines, decisions made and open "
+    "questions. Drop greetings and small talk. Plain text, at most {words} words.\n\n"
+    "Existing summary:\n{previous}\n\n"
+    "New messages:\n{transcript}"
+  )
+
+  def __init__(
+      self,
+      llm: LLMClient,
+      trigger_tokens: int,
+      keep_tokens: int,
+      summary_max_tokens: int,
+      max_messages: int = 100,
+      batch_size: int = 20,
+  ):
+    self.llm = llm
+    self.trigger_tokens = trigger_tokens
+    self.keep_tokens = keep_tokens
+    self.summary_max_tokens = summary_max_tokens
+    self.max_messages = max_messages
+    self.batch_size = batch_size
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-compaction")
+    self._pending: set[int] = set()
+    self._lock = threading.Lock()
+
+  @property
+  def enabled(self) -> bool:
+    return self.trigger_tokens > 0
+
+  def schedule(self, conversation_id: int) -> None:
+    if not self.enabled:
+      return
+    with self._lock:
+      if conversation_id in self._pending:
+        return
+      self._pending.add(conversation_id)
+    self._executor.submit(self._run, conversation_id)
+
+  def _run(self, conversation_id: int) -> None:
+    try:
+      self.compact(conversation_id)
+    except Exception as e:
+      # The raw history is untouched; the next turn schedules another attempt
+      logger.warning(f"Chat history compaction failed for conversation {conversation_id}: {e}")
+    finally:
+      with self._lock:
+        self._pending.discard(conversation_id)
+      connections.close_all()
+
+  def compact(self, conversation_id: int) -> bool:
+    """Summarise the thread's older turns if the tail is over the threshold. Returns True if it did."""
+    summary = ConversationSummary.objects.filter(conversation_id=conversation_id).first()
+    boundary = (summary.summarized_until, summary.summarized_until_id) if summary else None
+
+    tail = ChatHistory.objects.filter(conversation_id=conversation_id)
+    if boundary:
+      tail = tail.filter(after_position(boundary))
+    tail_tokens = tail.aggregate(total=Sum('token_count'))['total'] or 0
+    if tail_tokens <= self.trigger_tokens:
+      return False
+
+    # The newest turns stay verbatim; the rest of the tail goes into the summary
+    window = HistoryWindow(self.keep_tokens, self.max_messages, self.batch_size)
+    while window.wants_more():
+      window.feed(list(history_page(conversation_id, batch_size=self.batch_size, before=window.before, after=boundary)))
+    if window.oldest_kept is None:
+      return False
+
+    older = list(
+      tail.filter(before_position(window.oldest_kept))
+      .order_by('timestamp', 'id')
+      .values_list('id', 'timestamp', 'role', 'message')
+    )
+    if not older:
+      return False
+
+    text = self._summarise(summary.summary if summary else "", older)
+    last_id, last_timestamp = older[-1][0], older[-1][1]
+    self._store(conversation_id, summary, text, last_timestamp, last_id)
+    return True
+
+  def _summarise(self, previous: str, rows: list) -> str:
+    transcript = "\n\n".join(
+      f"{'Student' if role == 'user' else 'Assistant'}: {message}"
+      for _, _, role, message in rows
+    )
+    prompt = self.SUMMARY_PROMPT.format(
+      words=self.summary_max_tokens // 2,   # leave headroom under max_output_tokens
+      previous=previous or "(none yet)",
+      transcript=transcript,
+    )
+    response = self.llm.generate(
+      [{"role": "user", "parts": [{"text": prompt}]}],
+      {"max_output_tokens": self.summary_max_tokens},
+    )
+    # A summary cut at the token limit is still better than none
+    if response.finish_reason != "MAX_TOKENS":
+      check_finish_reason(response)
+    return response.text.strip()
+
+  def _store(self, conversation_id: int, summary, text: str, summarized_until, summarized_until_id: int) -> None:
+    fields = {
+      "summary": text,
+      "token_count": estimate_tokens(text),
+      "summarized_until": summarized_until,
+      "summarized_until_id": summarized_until_id,
+    }
+    if summary is None:
+      try:
+        ConversationSummary.objects.create(conversation_id=conversation_id, **fields)
+      except IntegrityError:
+        pass  # another worker summarised first; its summary stands
+      return
+
+    # Only advance from the boundary this run read; a concurrent compaction wins otherwise
+    ConversationSummary.objects.filter(
+      pk=summary.pk,
+      summarized_until_id=summary.summarized_until_id,
+    ).update(updated_at=timezone.now(), **fields)
@@ -0,0 +1,215 @@
+import re
+import threading
+
+from django.db.models import Q
+
+from apps.courses.models import Course
+from apps.institutions.models import Institution
+from . import metrics
+from .cache import TOKEN_EXPANSIONS, normalize_course_name, normalize_institution_name
+from .retrieval import PLACEHOLDER_VALUES
+
+MAX_LISTED = 25
+SOURCE_NOTE = "_From the EduWaka catalog. Please confirm on the institution's website before you apply._"
+
+# Applied before matching, so the patterns only see one spelling of each term
+_SPELLINGS = [
+  (re.compile(r"\bo[\s'’\-]?levels?\b"), "olevel"),
+  (re.compile(r"\bpost[\s\-]?utme\b"), "post utme"),
+  (re.compile(r"[?!.]+$"), ""),
+  (re.compile(r"^(?:hi|hello|hey|good (?:morning|afternoon|evening))\b[,!.]?\s*"), ""),
+  (re.compile(r"^(?:please|pls|kindly)\s+|\s+(?:please|pls)$"), ""),
+  (re.compile(r"^(?:can|could) you (?:tell me|show me|list)\s+"), "list "),
+]
+
+# Words normalisation may have spelled out; the row itself can still say "Univ." or "Tech"
+_EXPANDED_WORDS = {word for expansion in TOKEN_EXPANSIONS.values() for word in expansion.split()}
+
+_KINDS = {
+  "universities": "university",
+  "polytechnics": "polytechnic",
+  "colleges of education": "college_of_education",
+}
+
+_INSTITUTIONS_BY_FILTER = re.compile(
+  r"^(?:which|what|list|show(?: me)?|name)(?: all)?(?: the)?(?: are the)?\s+"
+  r"(?P<ownership>federal|state|private)?\s*(?P<kind>universities|polytechnics|colleges of education)"
+  r"(?:\s+(?:are )?(?:there )?(?:located )?in\s+(?P<place>[a-z][a-z .'\-]*?)(?: state)?)?"
+  r"(?: nigeria)?$"
+)
+
+_REQUIREMENT_FIELDS = {
+  "jamb": ["jamb subjects", "jamb subject combination", "utme subjects", "subject combination",
+           "jamb requirements", "utme requirements", "jamb combination"],
+  "olevel": ["olevel requirements", "olevel subjects", "waec requirements", "olevel requirement"],
+  "post_utme": ["post utme details", "post utme requirements", "post utme"],
+  "all": ["requirements", "admission requirements", "entry requirements", "requirement"],
+}
+_FIELD_BY_PHRASE = {phrase: field for field, phrases in _REQUIREMENT_FIELDS.items() for phrase in phrases}
+
+_COURSE_REQUIREMENT = re.compile(
+  r"^(?:what (?:is|are) )?(?:the )?(?P<field>" + "|".join(sorted(_FIELD_BY_PHRASE, key=len, reverse=True)) + r")"
+  r" (?:for|of|to study) (?P<course>[a-z][a-z &,'\-]*?) (?:at|in) (?P<institution>[a-z][a-z .,&'\-]*)$"
+)
+_COURSE_DURATION = re.compile(
+  r"^how (?:many years|long) (?:is|does|will) (?P<course>[a-z][a-z &,'\-]*?) (?:at|in) (?P<institution>[a-z][a-z .,&'\-]*?)(?: take)?$"
+)
+_COURSES_OFFERED = re.compile(
+  r"^(?:(?:what|which) courses (?:does|do|are) (?P<institution>[a-z][a-z .,&'\-]*?) (?:offer|have|offered)"
+  r"|(?:list|show(?: me)?)(?: all)?(?: the)? courses (?:offered )?(?:at|in|by) (?P<institution2>[a-z][a-z .,&'\-]*))$"
+)
+
+
+def normalise_message(message: str) -> str:
+  text = " ".join(message.lower().split())
+  for pattern, replacement in _SPELLINGS:
+    text = pattern.sub(replacement, text).strip()
+  return text
+
+
+class IntentRouter:
+  """
+  Answers structured catalog questions straight from Institution/Course, without
+  Gemini. Each intent is one anchored pattern over the whole (normalised) message,
+  so anything with extra clauses, or naming something not in the catalog, falls
+  through to the model. answer() returns Markdown or None.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._stats = {"institutions_by_filter": 0, "course_requirements": 0, "courses_offered": 0, "fell_through": 0}
+
+  def answer(self, message: str) -> str | None:
+    text = normalise_message(message)
+    for intent, handler in (
+        ("institutions_by_filter", self._institutions_by_filter),
+        ("course_requirements", self._course_requirements),
+        ("courses_offered", self._courses_offered),
+    ):
+      reply = handler(text)
+      if reply is not None:
+        self._record(intent)
+        return reply
+    self._record("fell_through")
+    return None
+
+  def _record(self, outcome: str) -> None:
+    with self._lock:
+      self._stats[outcome] += 1
+    metrics.cache_lookups.labels("catalog_intents", "miss" if outcome == "fell_through" else "hit").inc()
+
+  def stats(self) -> dict:
+    with self._lock:
+      stats = dict(self._stats)
+    answered = sum(v for k, v in stats.items() if k != "fell_through")
+    total = answered + stats["fell_through"]
+    stats["answered_locally_rate"] = round(answered / total, 4) if total else 0.0
+    return stats
+
+  #  Lookups
+  def _find_institution(self, text: str):
+    """The institution named by an abbreviation or (normalised) full name, or None."""
+    wanted = normalize_institution_name(text)
+    if not wanted:
+      return None
+    # Narrow in the database on the most distinctive word, then compare normalised names
+    words = wanted.split()
+    keyword = max([word for word in words if word not in _EXPANDED_WORDS] or words, key=len)
+    candidates = Institution.objects.filter(Q(abbreviation__iexact=text.strip()) | Q(name__icontains=keyword))
+    for institution in candidates.only("pk", "name", "abbreviation"):
+      abbreviation = (institution.abbreviation or "").strip().lower()
+      if wanted == normalize_institution_name(institution.name) or text.strip() == abbreviation:
+        return institution
+    return None
+
+  def _find_course(self, institution, text: str):
+    """Exact (normalised) course name, else the only course whose name starts with it."""
+    wanted = normalize_course_name(text)
+    courses = list(Course.objects.filter(institution=institution))
+    exact = [c for c in courses if normalize_course_name(c.name) == wanted]
+    if exact:
+      return exact[0]
+    prefixed = [c for c in courses if normalize_course_name(c.name).startswith(wanted + " ")]
+    return prefixed[0] if len(prefixed) == 1 else None
+
+  def _label(self, institution) -> str:
+    abbreviation = (institution.abbreviation or "").strip()
+    known = abbreviation and abbreviation.lower() not in PLACEHOLDER_VALUES
+    return f"{institution.name} ({abbreviation})" if known else institution.name
+
+  #  Intents
+  def _institutions_by_filter(self, text: str) -> str | None:
+    match = _INSTITUTIONS_BY_FILTER.match(text)
+    if not match or not (match["ownership"] or match["place"]):
+      return None  # "which universities?" alone is a conversation, not a lookup
+
+    institutions = Institution.objects.filter(institution_type=_KINDS[match["kind"]])
+    if match["ownership"]:
+      institutions = institutions.filter(ownership_type=match["ownership"])
+    place = match["place"]
+    if place:
+      in_place = Q(state__iexact=place) | Q(city__iexact=place)
+      if not Institution.objects.filter(in_place).exists():
+        return None  # not a place the catalog knows; let the model handle it
+      institutions = institutions.filter(in_place)
+
+    title = " ".join(filter(None, [match["ownership"], match["kind"]])).capitalize()
+    if place:
+      title += f" in {place.title()}"
+    rows = list(institutions.only("name", "abbreviation", "city", "state")[:MAX_LISTED + 1])
+    if not rows:
+      return f"I couldn't find any {title[0].lower() + title[1:]} in the EduWaka catalog.\n\n{SOURCE_NOTE}"
+
+    lines = [f"**{title}**", ""]
+    for institution in rows[:MAX_LISTED]:
+      where = ", ".join(filter(None, [institution.city, institution.state]))
+      lines.append(f"- {self._label(institution)}" + (f" — {where}" if where else ""))
+    if len(rows) > MAX_LISTED:
+      lines.append(f"- …and {institutions.count() - MAX_LISTED} more")
+    return "\n".join(lines + ["", SOURCE_NOTE])
+
+  def _course_requirements(self, text: str) -> str | None:
+    match = _COURSE_REQUIREMENT.match(text)
+    field = _FIELD_BY_PHRASE[match["field"]] if match else None
+    if not match:
+      match = _COURSE_DURATION.match(text)
+      field = "duration"
+    if not match:
+      return None
+
+    institution = self._find_institution(match["institution"])
+    course = self._find_course(institution, match["course"]) if institution else None
+    if course is None:
+      return None
+
+    details = {
+      "duration": ("Duration", f"{course.duration_years} years" if course.duration_years else ""),
+      "olevel": ("O'Level", course.olevel_requirements),
+      "jamb": ("UTME subjects", course.jamb_requirements),
+      "post_utme": ("Post-UTME", course.post_utme_details),
+    }
+    wanted = ["duration", "olevel", "jamb", "post_utme"] if field == "all" else [field]
+    lines = [f"- **{details[key][0]}:** {details[key][1].strip()}" for key in wanted if (details[key][1] or "").strip()]
+    if not lines:
+      return None  # the catalog has no answer; the model may
+
+    return "\n".join([f"**{course.name} at {self._label(institution)}**", ""] + lines + ["", SOURCE_NOTE])
+
+  def _courses_offered(self, text: str) -> str | None:
+    match = _COURSES_OFFERED.match(text)
+    if not match:
+      return None
+    institution = self._find_institution(match["institution"] or match["institution2"])
+    if institution is None:
+      return None
+
+    names = list(Course.objects.filter(institution=institution).values_list("name", flat=True)[:MAX_LISTED + 1])
+    if not names:
+      return None
+    lines = [f"**Courses at {self._label(institution)}**", ""] + [f"- {name}" for name in names[:MAX_LISTED]]
+    if len(names) > MAX_LISTED:
+      lines.append(f"- …and {Course.objects.filter(institution=institution).count() - MAX_LISTED} more")
+    return "\n".join(lines + ["", SOURCE_NOTE])
+
+
+intent_router = IntentRouter()
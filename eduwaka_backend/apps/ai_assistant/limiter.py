@@ -0,0 +1,256 @@
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from .resilience import LLMUnavailableError
+
+try:
+  import fcntl
+except ImportError:  # Windows dev machines: process-wide limit only
+  fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Lower goes first. Summaries run off the request path, so they can wait
+PRIORITIES = {"eligibility": 0, "chat": 1, "overview": 2, "background": 3}
+DEFAULT_PRIORITY = "chat"
+
+
+class LLMOverloadedError(LLMUnavailableError):
+  """No LLM slot within the queue timeout, or the queue was full. Served as a 503."""
+  outcome = "overloaded"  # metrics label
+
+  def __init__(self, message: str, retry_after: int = 1):
+    self.retry_after = retry_after
+    super().__init__(f"AI service temporarily unavailable: {message}")
+
+
+class _Waiter:
+  __slots__ = ("rank", "seq", "granted", "shed", "event", "loop", "future")
+
+  def __init__(self, rank: int, seq: int):
+    self.rank = rank
+    self.seq = seq
+    self.granted = False
+    self.shed = False
+    self.event = None   # sync waiters
+    self.loop = None    # async waiters
+    self.future = None
+
+  def wake(self) -> None:
+    if self.event is not None:
+      self.event.set()
+    else:
+      self.loop.call_soon_threadsafe(lambda: self.future.done() or self.future.set_result(None))
+
+
+class HostSlots:
+  """
+  Host-wide cap shared by every worker process: `count` lock files, each held
+  with flock while a call is in flight. The OS releases them if a worker dies.
+  """
+
+  POLL_INTERVAL = 0.02
+
+  def __init__(self, lock_dir: str, count: int):
+    self.lock_dir = lock_dir
+    self.count = count
+    os.makedirs(lock_dir, exist_ok=True)
+
+  def _try_acquire(self):
+    for i in range(self.count):
+      fd = os.open(os.path.join(self.lock_dir, f"slot-{i}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+      try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fd
+      except BlockingIOError:
+        os.close(fd)
+    return None
+
+  def acquire(self, timeout: float):
+    """A held slot (pass it to release()), or None after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while True:
+      fd = self._try_acquire()
+      if fd is not None or time.monotonic() >= deadline:
+        return fd
+      time.sleep(self.POLL_INTERVAL)
+
+  async def aacquire(self, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+      fd = self._try_acquire()
+      if fd is not None or time.monotonic() >= deadline:
+        return fd
+      await asyncio.sleep(self.POLL_INTERVAL)
+
+  def release(self, fd) -> None:
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+class ConcurrencyLimiter:
+  """
+  Caps outbound LLM calls in flight in this process at `max_concurrent`.
+
+  Callers past the cap wait in a queue ordered by priority class (PRIORITIES),
+  first come first served within a class. A caller waiting longer than
+  `queue_timeout` seconds gets LLMOverloadedError. So does a new caller when
+  `max_queue` are already waiting, unless it outranks the lowest waiter, which
+  is shed instead. With `host_slots` each call also needs one of the host-wide
+  slots, polled for within the same timeout.
+
+  Works for threads and event-loop tasks alike; use slot() / aslot().
+  """
+
+  def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float, host_slots: HostSlots | None = None):
+    self.max_concurrent = max_concurrent
+    self.max_queue = max_queue
+    self.queue_timeout = queue_timeout
+    self.host_slots = host_slots
+    self._lock = threading.Lock()
+    self._in_flight = 0
+    self._queue: list[_Waiter] = []
+    self._seq = itertools.count()
+    self._stats = {name: {"admitted": 0, "queued": 0, "shed": 0, "timed_out": 0} for name in PRIORITIES}
+
+  @property
+  def enabled(self) -> bool:
+    return self.max_concurrent > 0
+
+  def has_capacity(self) -> bool:
+    """A slot is free right now; hedged requests only go out then."""
+    return not self.enabled or (self._in_flight < self.max_concurrent and not self._queue)
+
+  def _count(self, priority: str, outcome: str) -> None:
+    self._stats[priority][outcome] += 1
+
+  #  Queue
+  def _admit_or_enqueue(self, priority: str, waiter: _Waiter) -> bool:
+    """True if admitted at once; otherwise queues the waiter, or raises when the queue is full."""
+    if priority not in PRIORITIES:
+      raise ValueError(f"unknown LLM priority {priority!r}")
+    with self._lock:
+      if self._in_flight < self.max_concurrent and not self._queue:
+        self._in_flight += 1
+        self._count(priority, "admitted")
+        return True
+
+      if len(self._queue) >= self.max_queue:
+        lowest = max(self._queue, key=lambda w: (w.rank, w.seq), default=None)
+        if lowest is None or lowest.rank <= waiter.rank:
+          self._count(priority, "shed")
+          raise LLMOverloadedError("too many requests queued")
+        self._queue.remove(lowest)
+        lowest.shed = True
+        lowest.wake()
+
+      self._queue.append(waiter)
+      self._count(priority, "queued")
+      return False
+
+  def _give_up_waiting(self, priority: str, waiter: _Waiter) -> bool:
+    """After a timeout: True if the slot was granted meanwhile, else leaves the queue."""
+    with self._lock:
+      if waiter.granted:
+        return True
+      if waiter in self._queue:
+        self._queue.remove(waiter)
+      self._count(priority, "timed_out")
+      return False
+
+  def _check_granted(self, priority: str, waiter: _Waiter) -> None:
+    with self._lock:
+      self._count(priority, "shed" if waiter.shed else "admitted")
+    if waiter.shed:
+      raise LLMOverloadedError("displaced by higher-priority requests")
+
+  def _release_local(self) -> None:
+    with self._lock:
+      if self._queue:
+        # Hand the slot straight to the most important waiter
+        waiter = min(self._queue, key=lambda w: (w.rank, w.seq))
+        self._queue.remove(waiter)
+        waiter.granted = True
+        waiter.wake()
+      else:
+        self._in_flight -= 1
+
+  #  Sync
+  def _acquire_local(self, priority: str) -> None:
+    waiter = _Waiter(PRIORITIES.get(priority, 0), next(self._seq))
+    waiter.event = threading.Event()
+    if self._admit_or_enqueue(priority, waiter):
+      return
+    if not waiter.event.wait(self.queue_timeout) and not self._give_up_waiting(priority, waiter):
+      raise LLMOverloadedError(f"no capacity within {self.queue_timeout:g}s")
+    self._check_granted(priority, waiter)
+
+  @contextmanager
+  def slot(self, priority: str = DEFAULT_PRIORITY):
+    if not self.enabled:
+      yield
+      return
+    started = time.monotonic()
+    self._acquire_local(priority)
+    host_slot = None
+    try:
+      if self.host_slots is not None:
+        host_slot = self.host_slots.acquire(max(0.0, self.queue_timeout - (time.monotonic() - started)))
+        if host_slot is None:
+          raise LLMOverloadedError("no host-wide capacity")
+      yield
+    finally:
+      if host_slot is not None:
+        self.host_slots.release(host_slot)
+      self._release_local()
+
+  #  Async
+  async def _aacquire_local(self, priority: str) -> None:
+    waiter = _Waiter(PRIORITIES.get(priority, 0), next(self._seq))
+    waiter.loop = asyncio.get_running_loop()
+    waiter.future = waiter.loop.create_future()
+    if self._admit_or_enqueue(priority, waiter):
+      return
+    try:
+      await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+    except asyncio.TimeoutError:
+      if not self._give_up_waiting(priority, waiter):
+        raise LLMOverloadedError(f"no capacity within {self.queue_timeout:g}s")
+    except asyncio.CancelledError:
+      # Client went away while queued; pass on a slot that was already granted
+      if self._give_up_waiting(priority, waiter) and not waiter.shed:
+        self._release_local()
+      raise
+    self._check_granted(priority, waiter)
+
+  @asynccontextmanager
+  async def aslot(self, priority: str = DEFAULT_PRIORITY):
+    if not self.enabled:
+      yield
+      return
+    started = time.monotonic()
+    await self._aacquire_local(priority)
+    host_slot = None
+    try:
+      if self.host_slots is not None:
+        host_slot = await self.host_slots.aacquire(max(0.0, self.queue_timeout - (time.monotonic() - started)))
+        if host_slot is None:
+          raise LLMOverloadedError("no host-wide capacity")
+      yield
+    finally:
+      if host_slot is not None:
+        self.host_slots.release(host_slot)
+      self._release_local()
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+        "in_flight": self._in_flight,
+        "queued": len(self._queue),
+        "by_priority": {name: dict(counts) for name, counts in self._stats.items()},
+      }
@@ -0,0 +1,332 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+from dataclasses import dataclass
+from string import Template
+from typing import AsyncIterator, Iterator
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LLMResponse:
+  """Backend-neutral result of one generation call (or one streamed chunk)."""
+  text: str
+  finish_reason: str | None = "STOP"   # None on intermediate stream chunks
+  prompt_tokens: int = 0
+  output_tokens: int = 0
+
+
+def estimate_tokens(text: str) -> int:
+  """
+  Local token estimate (~4 characters per token for Gemini on English text).
+  Good enough for budgeting prompt size without a tokenizer round trip.
+  """
+  return max(1, (len(text) + 3) // 4) if text else 0
+
+
+def check_finish_reason(response: LLMResponse) -> None:
+  """Explicit check for blocked / incomplete responses before trusting the text."""
+  if response.finish_reason != "STOP":
+    raise ValueError(f"response was blocked or incomplete (finish_reason={response.finish_reason})")
+
+
+class LLMClient:
+  """
+  Interface every LLM backend implements. Select one with settings.AI_LLM_BACKEND
+  (dotted path); settings.AI_LLM_OPTIONS is passed to its constructor.
+  """
+  model_name = ""
+
+  def generate(self, contents: list, generation_config: dict | None = None) -> LLMResponse:
+    raise NotImplementedError
+
+  async def agenerate(self, contents: list, generation_config: dict | None = None) -> LLMResponse:
+    raise NotImplementedError
+
+  def stream(self, contents: list, generation_config: dict | None = None) -> Iterator[LLMResponse]:
+    """Yields text chunks; the last one carries the finish_reason."""
+    raise NotImplementedError
+
+  def astream(self, contents: list, generation_config: dict | None = None) -> AsyncIterator[LLMResponse]:
+    """Async counterpart of stream()."""
+    raise NotImplementedError
+
+
+# Gemini
+class GeminiClient(LLMClient):
+
+  def __init__(self, model_name: str | None = None, api_key: str | None = None):
+    import google.generativeai as genai
+    from google.generativeai import protos
+
+    genai.configure(api_key=api_key or settings.GEMINI_API_KEY)
+    self.model_name = model_name or settings.GEMINI_MODEL_NAME
+    self.model = genai.GenerativeModel(self.model_name)
+    self._finish_reasons = protos.Candidate.FinishReason
+
+  def _to_response(self, response, final: bool = True) -> LLMResponse:
+    candidate = response.candidates[0] if response.candidates else None
+    parts = candidate.content.parts if candidate else []
+    text = "".join(part.text for part in parts)
+
+    if candidate is None:
+      finish_reason = "NO_CANDIDATE" if final else None
+    elif candidate.finish_reason:
+      finish_reason = self._finish_reasons(candidate.finish_reason).name
+    else:
+      finish_reason = None
+
+    usage = response.usage_metadata
+    return LLMResponse(
+      text=text,
+      finish_reason=finish_reason,
+      prompt_tokens=usage.prompt_token_count if usage else 0,
+      output_tokens=usage.candidates_token_count if usage else 0,
+    )
+
+  def generate(self, contents, generation_config=None):
+    response = self.model.generate_content(contents=contents, generation_config=generation_config)
+    return self._to_response(response)
+
+  async def agenerate(self, contents, generation_config=None):
+    response = await self.model.generate_content_async(contents=contents, generation_config=generation_config)
+    return self._to_response(response)
+
+  def stream(self, contents, generation_config=None):
+    response = self.model.generate_content(contents=contents, generation_config=generation_config, stream=True)
+    for chunk in response:
+      yield self._to_response(chunk, final=False)
+
+  async def astream(self, contents, generation_config=None):
+    response = await self.model.generate_content_async(contents=contents, generation_config=generation_config, stream=True)
+    async for chunk in response:
+      yield self._to_response(chunk, final=False)
+
+
+# Local stub for load testing and offline development
+class StubLLMError(Exception):
+  pass
+
+
+class StubClient(LLMClient):
+  """
+  Deterministic (seeded) stand-in for Gemini. Nothing leaves the box.
+
+  Options (settings.AI_LLM_OPTIONS, or AI_LLM_OPTIONS env var as JSON):
+    latency:        {"distribution": "fixed", "ms": 800}
+                    {"distribution": "uniform", "min_ms": 300, "max_ms": 2000}
+                    {"distribution": "normal", "mean_ms": 900, "stddev_ms": 250}
+                    {"distribution": "lognormal", "median_ms": 900, "sigma": 0.6}
+                    {"distribution": "exponential", "mean_ms": 900}
+    failure_rate:   probability a call raises StubLLMError (0.0 - 1.0)
+    failure_message: text of that error, e.g. "503 Service Unavailable"
+    fail_first:     the first N calls fail regardless of failure_rate (outage, then recovery)
+    finish_reasons: weights, e.g. {"STOP": 0.97, "SAFETY": 0.02, "MAX_TOKENS": 0.01}
+    responses:      [{"match": <regex on the last message>, "text": <string.Template>}]
+                    first match wins; named groups and $last_message are substituted
+    stream_chunk_words: words per streamed chunk
+    seed:           RNG seed for reproducible runs
+  """
+
+  DEFAULT_RESPONSES = [
+    {
+      "match": r'overview of the Nigerian institution named "(?P<name>[^"]+)"',
+      "text": json.dumps({
+        "name": "$name",
+        "type": "Federal University",
+        "location": "Lagos, Lagos State",
+        "established_year": 1962,
+        "overview": "Stub overview for $name.",
+        "relevance": "Stub relevance for $name.",
+      }),
+    },
+  ]
+  DEFAULT_CHAT_REPLY = "**Stub reply.** This response was generated locally by the LLM stub."
+
+  def __init__(
+      self,
+      model_name: str = "stub",
+      latency: dict | None = None,
+      failure_rate: float = 0.0,
+      failure_message: str = "503 Service Unavailable (stub)",
+      fail_first: int = 0,
+      finish_reasons: dict | None = None,
+      responses: list | None = None,
+      stream_chunk_words: int = 8,
+      seed: int | None = None,
+  ):
+    self.model_name = model_name
+    self.latency = latency or {"distribution": "fixed", "ms": 0}
+    self.failure_rate = failure_rate
+    self.failure_message = failure_message
+    self.fail_first = fail_first
+    self.finish_reasons = finish_reasons or {"STOP": 1.0}
+    self.responses = [
+      (re.compile(rule["match"], re.IGNORECASE | re.DOTALL), rule["text"])
+      for rule in (responses or []) + self.DEFAULT_RESPONSES
+    ]
+    self.stream_chunk_words = stream_chunk_words
+    self._random = random.Random(seed)
+
+  #  Sampling
+
+  def _sample_latency(self) -> float:
+    """Seconds to wait for this call."""
+    cfg = self.latency
+    rng = self._random
+    distribution = cfg.get("distribution", "fixed")
+    if distribution == "uniform":
+      ms = rng.uniform(cfg.get("min_ms", 0), cfg.get("max_ms", 0))
+    elif distribution == "normal":
+      ms = rng.gauss(cfg.get("mean_ms", 0), cfg.get("stddev_ms", 0))
+    elif distribution == "lognormal":
+      ms = cfg.get("median_ms", 0) * rng.lognormvariate(0, cfg.get("sigma", 0.5))
+    elif distribution == "exponential":
+      mean = cfg.get("mean_ms", 0)
+      ms = rng.expovariate(1 / mean) if mean else 0
+    else:
+      ms = cfg.get("ms", 0)
+    return max(ms, 0) / 1000
+
+  def _sample_finish_reason(self) -> str:
+    reasons = list(self.finish_reasons)
+    return self._random.choices(reasons, weights=[self.finish_reasons[r] for r in reasons])[0]
+
+  def _should_fail(self) -> bool:
+    if self.fail_first > 0:
+      self.fail_first -= 1
+      return True
+    return self.failure_rate > 0 and self._random.random() < self.failure_rate
+
+  #  Response building
+
+  def _last_message(self, contents: list) -> str:
+    last = contents[-1] if contents else {}
+    return " ".join(part.get("text", "") for part in last.get("parts", []))
+
+  def _from_schema(self, schema: dict):
+    kind = schema.get("type", "STRING").upper()
+    if kind == "OBJECT":
+      return {name: self._from_schema(sub) for name, sub in schema.get("properties", {}).items()}
+    if kind == "ARRAY":
+      return [self._from_schema(schema.get("items", {}))]
+    if kind == "BOOLEAN":
+      return True
+    if kind in ("NUMBER", "INTEGER"):
+      return 0
+    return "stub"
+
+  def _build_text(self, contents: list, generation_config: dict | None) -> str:
+    last_message = self._last_message(contents)
+    for pattern, template in self.responses:
+      match = pattern.search(last_message)
+      if match:
+        return Template(template).safe_substitute(last_message=last_message, **match.groupdict())
+
+    generation_config = generation_config or {}
+    if "response_schema" in generation_config:
+      return json.dumps(self._from_schema(generation_config["response_schema"]))
+    if generation_config.get("response_mime_type") == "application/json":
+      return "{}"
+    return self.DEFAULT_CHAT_REPLY
+
+  def _respond(self, contents, generation_config) -> tuple[float, LLMResponse]:
+    delay = self._sample_latency()
+    if self._should_fail():
+      raise StubLLMError(self.failure_message)
+
+    finish_reason = self._sample_finish_reason()
+    text = self._build_text(contents, generation_config) if finish_reason == "STOP" else ""
+    return delay, LLMResponse(
+      text=text,
+      finish_reason=finish_reason,
+      prompt_tokens=sum(estimate_tokens(part.get("text", "")) for item in contents for part in item.get("parts", [])),
+      output_tokens=estimate_tokens(text),
+    )
+
+  def generate(self, contents, generation_config=None):
+    delay, response = self._respond(contents, generation_config)
+    time.sleep(delay)
+    return response
+
+  async def agenerate(self, contents, generation_config=None):
+    delay, response = self._respond(contents, generation_config)
+    await asyncio.sleep(delay)
+    return response
+
+  def _stream_chunks(self, contents, generation_config) -> list[tuple[float, LLMResponse]]:
+    """(seconds to wait first, chunk) pairs for one streamed reply."""
+    delay, response = self._respond(contents, generation_config)
+    words = response.text.split(" ")
+    chunks = [
+      " ".join(words[i:i + self.stream_chunk_words])
+      for i in range(0, len(words), self.stream_chunk_words)
+    ] or [""]
+
+    # Spend the sampled latency across the stream, front-loaded like a real first token
+    timed_chunks = []
+    for i, chunk in enumerate(chunks):
+      is_last = i == len(chunks) - 1
+      timed_chunks.append((delay / 2 / len(chunks) if i else delay / 2, LLMResponse(
+        text=chunk if is_last else chunk + " ",
+        finish_reason=response.finish_reason if is_last else None,
+        prompt_tokens=response.prompt_tokens,
+        output_tokens=response.output_tokens if is_last else 0,
+      )))
+    return timed_chunks
+
+  def stream(self, contents, generation_config=None):
+    for delay, chunk in self._stream_chunks(contents, generation_config):
+      time.sleep(delay)
+      yield chunk
+
+  async def astream(self, contents, generation_config=None):
+    for delay, chunk in self._stream_chunks(contents, generation_config):
+      await asyncio.sleep(delay)
+      yield chunk
+
+
+def get_llm_client() -> LLMClient:
+  """
+  The configured backend, wrapped in timeouts, retries and a circuit breaker
+  (see resilience.py) behind a prioritised concurrency limit (see limiter.py).
+  """
+  from .limiter import ConcurrencyLimiter, HostSlots, fcntl
+  from .resilience import CircuitBreaker, ResilientClient
+
+  host_slots = None
+  if settings.AI_LLM_HOST_MAX_CONCURRENCY:
+    if fcntl is None:
+      logger.warning("AI_LLM_HOST_MAX_CONCURRENCY needs fcntl; only the per-process limit applies")
+    else:
+      host_slots = HostSlots(settings.AI_LLM_HOST_SLOT_DIR, settings.AI_LLM_HOST_MAX_CONCURRENCY)
+
+  backend = import_string(settings.AI_LLM_BACKEND)
+  return ResilientClient(
+    backend(**settings.AI_LLM_OPTIONS),
+    timeout=settings.AI_LLM_TIMEOUT,
+    deadline=settings.AI_LLM_DEADLINE,
+    max_retries=settings.AI_LLM_MAX_RETRIES,
+    backoff_base=settings.AI_LLM_RETRY_BACKOFF,
+    backoff_max=settings.AI_LLM_RETRY_BACKOFF_MAX,
+    hedge=settings.AI_LLM_HEDGE,
+    breaker=CircuitBreaker(
+      failure_rate=settings.AI_LLM_BREAKER_FAILURE_RATE,
+      min_calls=settings.AI_LLM_BREAKER_MIN_CALLS,
+      window=settings.AI_LLM_BREAKER_WINDOW,
+      open_seconds=settings.AI_LLM_BREAKER_OPEN_SECONDS,
+    ),
+    limiter=ConcurrencyLimiter(
+      max_concurrent=settings.AI_LLM_MAX_CONCURRENCY,
+      max_queue=settings.AI_LLM_MAX_QUEUE,
+      queue_timeout=settings.AI_LLM_QUEUE_TIMEOUT,
+      host_slots=host_slots,
+    ),
+  )
@@ -0,0 +1,81 @@
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from apps.ai_assistant.olevel import GRADE_PATTERN, SUBJECT_ALIASES, parse_many, parse_sitting
+
+SAMPLE_SUBJECTS = [
+    "English Language", "Eng", "Mathematics", "Maths", "Physics", "Chem", "Biology", "Bio",
+    "Economics", "Govt", "Literature", "Agric Science", "Civic Education", "Geography",
+    "C.R.K", "Further Maths", "Commerce", "Technical Drawing", "Data Processing",
+]
+SAMPLE_GRADES = ["A1", "B2", "B3", "C4", "C5", "C6", "D7", "E8", "F9"]
+SAMPLE_SEPARATORS = [": ", " - ", " "]
+
+
+def legacy_parse_sitting(sitting_text: str) -> dict[str, str]:
+    """The pre-olevel.py parser, kept verbatim as the benchmark baseline."""
+    results: dict[str, str] = {}
+    if not sitting_text:
+        return results
+
+    for entry in re.split(r'[,;\|\n]+', sitting_text):
+        entry = entry.strip()
+        if not entry:
+            continue
+        match = re.match(
+            r'^(.+?)[\s:\-–]+(' + '|'.join(GRADE_PATTERN.pattern[3:-3].split('|')) + r')\s*$',
+            entry,
+            re.IGNORECASE,
+        )
+        if match:
+            cleaned = match.group(1).strip().lower()
+            results[SUBJECT_ALIASES.get(cleaned, cleaned)] = match.group(2).upper()
+    return results
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark: per-sitting O'Level parse cost, legacy parser vs olevel.parse_sitting / parse_many"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sittings", type=int, default=5000, help="Sittings per run")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per parser; the best is reported")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def _generate(self, count: int, seed: int) -> list[str]:
+        rng = random.Random(seed)
+        return [
+            ", ".join(
+                f"{subject}{rng.choice(SAMPLE_SEPARATORS)}{rng.choice(SAMPLE_GRADES)}"
+                for subject in rng.sample(SAMPLE_SUBJECTS, rng.randint(5, 9))
+            )
+            for _ in range(count)
+        ]
+
+    def _best_of(self, repeat: int, fn) -> float:
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    def handle(self, *args, **options):
+        sittings = self._generate(options["sittings"], options["seed"])
+        count = len(sittings)
+        repeat = options["repeat"]
+
+        results = {
+            "legacy (per-entry regex rebuild)": self._best_of(repeat, lambda: [legacy_parse_sitting(s) for s in sittings]),
+            "olevel.parse_sitting": self._best_of(repeat, lambda: [parse_sitting(s) for s in sittings]),
+            "olevel.parse_many": self._best_of(repeat, lambda: parse_many(sittings)),
+        }
+
+        baseline = next(iter(results.values()))
+        self.stdout.write(f"{count} sittings, best of {repeat} runs")
+        for name, seconds in results.items():
+            self.stdout.write(
+                f"  {name:<34} {seconds * 1e6 / count:8.2f} µs/sitting  ({baseline / seconds:4.1f}x)"
+            )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from apps.ai_assistant.models import ChatHistory
+from apps.ai_assistant.views import history_compactor
+
+
+class Command(BaseCommand):
+    help = "Summarises older chat turns for every conversation whose un-summarised history is over the threshold"
+
+    def handle(self, *args, **kwargs):
+        if not history_compactor.enabled:
+            self.stdout.write(self.style.WARNING("Chat summaries are disabled (AI_CHAT_SUMMARY_TRIGGER_TOKENS=0)"))
+            return
+
+        compacted = failed = 0
+        conversation_ids = (
+            ChatHistory.objects.filter(conversation__isnull=False)
+            .values_list('conversation_id', flat=True).distinct().order_by()
+        )
+        for conversation_id in conversation_ids:
+            try:
+                compacted += history_compactor.compact(conversation_id)
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Conversation {conversation_id}: {e}")
+
+        self.stdout.write(self.style.SUCCESS(f"Compacted {compacted} conversation(s), {failed} failure(s)"))
@@ -0,0 +1,31 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.ai_assistant.cache import eligibility_result_cache, institution_overview_cache
+from apps.ai_assistant.models import EligibilityCheck, RateLimitBucket
+
+# Partial eligibility answers are polled for seconds, not days
+ELIGIBILITY_CHECK_RETENTION = timedelta(days=1)
+# Long refilled by now; a missing bucket counts as a full one
+RATE_LIMIT_BUCKET_RETENTION = timedelta(days=1)
+
+
+class Command(BaseCommand):
+    help = "Deletes expired institution overview and eligibility cache rows, old partial eligibility checks and idle rate limit buckets"
+
+    def handle(self, *args, **kwargs):
+        overviews = institution_overview_cache.prune()
+        eligibility = eligibility_result_cache.prune()
+        checks, _ = EligibilityCheck.objects.filter(created_at__lt=timezone.now() - ELIGIBILITY_CHECK_RETENTION).delete()
+        buckets, _ = RateLimitBucket.objects.filter(
+            refilled_at__lt=time.time() - RATE_LIMIT_BUCKET_RETENTION.total_seconds()
+        ).delete()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Pruned {overviews} institution overview and {eligibility} eligibility cache row(s), "
+                f"{checks} partial eligibility check(s) and {buckets} idle rate limit bucket(s)"
+            )
+        )
@@ -0,0 +1,51 @@
+import os
+
+from django.conf import settings
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Workers share their samples through files here (prometheus_client multiprocess mode)
+if settings.PROMETHEUS_MULTIPROC_DIR:
+  os.makedirs(settings.PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+# The endpoint label is the feature that made the call: eligibility, eligibility_batch,
+# chat, chat_stream, overview or chat_summary. Its limiter priority is separate (see
+# limiter.PRIORITIES)
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+
+llm_call_seconds = Histogram(
+  "eduwaka_llm_call_duration_seconds",
+  "Time for one LLM call as the caller saw it: queueing, retries and hedges included",
+  ["endpoint", "outcome"],
+  buckets=LATENCY_BUCKETS,
+)
+llm_attempts = Counter(
+  "eduwaka_llm_attempts_total",
+  "Upstream LLM attempts, retries included; outcome is ok, error or timeout",
+  ["endpoint", "outcome"],
+)
+llm_retries = Counter("eduwaka_llm_retries_total", "LLM attempts that were retried", ["endpoint"])
+llm_hedges = Counter("eduwaka_llm_hedges_total", "Hedged second requests sent", ["endpoint"])
+llm_tokens = Counter("eduwaka_llm_tokens_total", "Tokens reported by the model's usage metadata", ["endpoint", "kind"])
+llm_finish_reasons = Counter("eduwaka_llm_finish_reasons_total", "Finish reasons of completed LLM calls", ["endpoint", "reason"])
+llm_in_flight = Gauge(
+  "eduwaka_llm_in_flight", "LLM calls holding a concurrency slot", ["endpoint"], multiprocess_mode="livesum",
+)
+json_decode_failures = Counter(
+  "eduwaka_llm_json_decode_failures_total", "Model replies that should have been JSON but did not parse", ["endpoint"],
+)
+cache_lookups = Counter(
+  "eduwaka_ai_cache_lookups_total",
+  "Lookups in the caches and local answerers in front of the LLM; result is hit, negative_hit or miss",
+  ["cache", "result"],
+)
+rate_limited = Counter("eduwaka_ai_rate_limited_total", "AI requests refused by a rate limit bucket", ["scope"])
+
+
+def render() -> tuple[bytes, str]:
+  """(body, content type) of every worker's metrics in Prometheus text format."""
+  if settings.PROMETHEUS_MULTIPROC_DIR:
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+  else:
+    registry = REGISTRY
+  return generate_latest(registry), CONTENT_TYPE_LATEST
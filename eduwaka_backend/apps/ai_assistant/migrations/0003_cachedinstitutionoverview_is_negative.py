@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0002_cachedinstitutionoverview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cachedinstitutionoverview',
+            name='is_negative',
+            field=models.BooleanField(default=False),
+        ),
+    ]
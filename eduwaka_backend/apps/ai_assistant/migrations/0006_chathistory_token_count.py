@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+def backfill_token_counts(apps, schema_editor):
+    # Same estimate as apps.ai_assistant.llm.estimate_tokens, frozen for this migration
+    ChatHistory = apps.get_model('ai_assistant', 'ChatHistory')
+    batch = []
+    for row in ChatHistory.objects.filter(token_count=0).only('id', 'message').iterator(chunk_size=2000):
+        row.token_count = max(1, (len(row.message) + 3) // 4) if row.message else 0
+        batch.append(row)
+        if len(batch) >= 2000:
+            ChatHistory.objects.bulk_update(batch, ['token_count'])
+            batch = []
+    if batch:
+        ChatHistory.objects.bulk_update(batch, ['token_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0005_chathistory_chathistory_user_ts_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chathistory',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_token_counts, migrations.RunPython.noop),
+    ]
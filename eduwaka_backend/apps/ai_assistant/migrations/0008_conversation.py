@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def move_history_into_conversations(apps, schema_editor):
+    """Each user's existing flat history becomes their first conversation."""
+    Conversation = apps.get_model('ai_assistant', 'Conversation')
+    ChatHistory = apps.get_model('ai_assistant', 'ChatHistory')
+    ConversationSummary = apps.get_model('ai_assistant', 'ConversationSummary')
+
+    user_ids = ChatHistory.objects.filter(conversation__isnull=True).values_list('user_id', flat=True).distinct().order_by()
+    for user_id in user_ids:
+        conversation = Conversation.objects.create(user_id=user_id, title="Earlier chats")
+        ChatHistory.objects.filter(user_id=user_id, conversation__isnull=True).update(conversation=conversation)
+        ConversationSummary.objects.filter(user_id=user_id).update(conversation=conversation)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ai_assistant', '0007_conversationsummary'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(blank=True, max_length=255)),
+                ('is_archived', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-updated_at'],
+                'indexes': [models.Index(fields=['user', 'is_archived', '-updated_at'], name='conversation_user_recent_idx')],
+            },
+        ),
+        migrations.AddField(
+            model_name='chathistory',
+            name='conversation',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='ai_assistant.conversation'),
+        ),
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='conversation',
+            field=models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='ai_assistant.conversation'),
+        ),
+        migrations.RunPython(move_history_into_conversations, migrations.RunPython.noop),
+    ]
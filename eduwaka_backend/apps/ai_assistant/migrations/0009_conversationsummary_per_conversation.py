@@ -0,0 +1,26 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    # Kept apart from 0008 so the data move is committed before these ALTERs run
+
+    dependencies = [
+        ('ai_assistant', '0008_conversation'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='conversationsummary',
+            name='user',
+        ),
+        migrations.AlterField(
+            model_name='conversationsummary',
+            name='conversation',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='ai_assistant.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['conversation', 'timestamp'], name='chathistory_conv_ts_idx'),
+        ),
+    ]
@@ -1,16 +1,166 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth import get_user_model
 
+from .llm import estimate_tokens
+
 User = get_user_model()
 
+class Conversation(models.Model):
+  """
+  A chat thread. Every ChatHistory row belongs to one; the chatbot's context,
+  trimming and rolling summary are all scoped to the thread.
+  """
+  user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='conversations')
+  title = models.CharField(max_length=255, blank=True)
+  is_archived = models.BooleanField(default=False)
+  created_at = models.DateTimeField(auto_now_add=True)
+  updated_at = models.DateTimeField(auto_now=True) # bumped on every turn
+
+  class Meta:
+    ordering = ['-updated_at']
+    indexes = [
+      models.Index(fields=['user', 'is_archived', '-updated_at'], name='conversation_user_recent_idx'),
+    ]
+
+  def __str__(self):
+    return f"{self.user.username}: {self.title or f'Conversation {self.pk}'}"
+
+
 class ChatHistory(models.Model):
   user = models.ForeignKey(User, on_delete=models.CASCADE)
+  # Only null for rows that predate threads and were not migrated
+  conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages', null=True, blank=True)
   role = models.CharField(max_length=10) # 'user' or 'model'
   message = models.TextField()
   timestamp = models.DateTimeField(auto_now_add=True)
+  token_count = models.PositiveIntegerField(default=0) # counted once on write: llm.estimate_tokens for user messages (save(), views.finish_turn), the reported output tokens for replies
 
   class Meta:
     ordering = ['timestamp']
+    indexes = [
+      # Serves the chatbot's "latest N messages for this user" window.
+      # message is deliberately not INCLUDEd: long replies would exceed btree row limits
+      models.Index(fields=['user', 'timestamp'], name='chathistory_user_ts_idx'),
+      # Same, scoped to one thread
+      models.Index(fields=['conversation', 'timestamp'], name='chathistory_conv_ts_idx'),
+    ]
+
+  def save(self, *args, **kwargs):
+    # Model replies arrive with the real count from the LLM; estimate the rest
+    if not self.token_count:
+      self.token_count = estimate_tokens(self.message)
+    super().save(*args, **kwargs)
+
+  def __str__(self):
+    return f"{self.user.username}: {self.message[:50]}"
+
+
+class ConversationSummary(models.Model):
+  """
+  Rolling summary of a conversation's older turns (see history.HistoryCompactor).
+  Messages up to and including (summarized_until, summarized_until_id) are
+  represented by the summary and no longer sent to the model verbatim.
+  """
+  conversation = models.OneToOneField(Conversation, on_delete=models.CASCADE, related_name='summary')
+  summary = models.TextField()
+  token_count = models.PositiveIntegerField(default=0)
+  summarized_until = models.DateTimeField()
+  summarized_until_id = models.BigIntegerField()
+  updated_at = models.DateTimeField(auto_now=True)
+
+  def __str__(self):
+    return f"{self.conversation}: summary up to #{self.summarized_until_id}"
+
+
+class CachedInstitutionOverview(models.Model):
+  """
+  Persistent store behind the institution overview cache (see cache.py).
+  One row per normalised institution name.
+  """
+  key = models.CharField(max_length=255, unique=True)
+  institution_name = models.CharField(max_length=255) # name as last requested
+  data = models.JSONField()
+  is_negative = models.BooleanField(default=False) # "not a recognized institution" answer
+  updated_at = models.DateTimeField(auto_now=True)
+  expires_at = models.DateTimeField(db_index=True)
+
+  def __str__(self):
+    return self.key
+
+
+class CachedEligibilityResult(models.Model):
+  """
+  Final (post-enforcement) eligibility check results, keyed by a hash of the
+  normalised inputs. course_key lets Course edits invalidate stale entries.
+  """
+  key = models.CharField(max_length=64, unique=True) # sha256 hex
+  course_key = models.CharField(max_length=255, db_index=True)
+  data = models.JSONField()
+  updated_at = models.DateTimeField(auto_now=True)
+  expires_at = models.DateTimeField(db_index=True)
+
+  def __str__(self):
+    return f"{self.course_key}: {self.key[:12]}"
+
+
+class EligibilityCheck(models.Model):
+  """
+  An eligibility check that missed the request deadline. The student got the
+  rules-based part of the answer (partial: true) and this id; the model's full
+  result is stored here when the background evaluation finishes.
+  """
+  STATUS_CHOICES = [
+    ('pending', 'Pending'),
+    ('complete', 'Complete'),
+    ('failed', 'Failed'),
+  ]
+
+  id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+  user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='eligibility_checks')
+  status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+  result = models.JSONField(null=True, blank=True)
+  error = models.TextField(blank=True)
+  created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+  updated_at = models.DateTimeField(auto_now=True)
+
+  def __str__(self):
+    return f"{self.user.username}: {self.status} ({self.pk})"
+
+
+class RateLimitBucket(models.Model):
+  """
+  Token bucket state for the AI endpoints' rate limits (see ratelimit.py) when
+  no shared cache is configured, or it is unreachable.
+  """
+  key = models.CharField(max_length=100, primary_key=True) # "ai:user:<id>" / "ai:ip:<address>"
+  tokens = models.FloatField()
+  refilled_at = models.FloatField(db_index=True) # time.time() of the last refill
+
+  def __str__(self):
+    return f"{self.key}: {self.tokens:.1f}"
+
+
+class DailyUsage(models.Model):
+  """
+  Per-user, per-day rollup of AI endpoint use (see usage.py). Token counts
+  are the model's own usage metadata for the calls the user's requests made.
+  """
+  user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ai_usage')
+  day = models.DateField()
+  requests = models.PositiveIntegerField(default=0)
+  throttled = models.PositiveIntegerField(default=0) # rejected by the rate limit
+  prompt_tokens = models.PositiveBigIntegerField(default=0)
+  output_tokens = models.PositiveBigIntegerField(default=0)
+
+  class Meta:
+    constraints = [
+      models.UniqueConstraint(fields=['user', 'day'], name='daily_usage_user_day_uniq'),
+    ]
+    indexes = [
+      models.Index(fields=['day'], name='daily_usage_day_idx'),
+    ]
 
   def __str__(self):
-    return f"{self.user.username}: {self.message[:50]}"
\ No newline at end of file
+    return f"{self.user.username} on {self.day}: {self.requests} request(s)"
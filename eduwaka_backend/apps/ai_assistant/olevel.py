@@ -0,0 +1,204 @@
+import difflib
+import re
+from functools import lru_cache
+from typing import Iterable
+
+#  Subjects that MUST appear as credits
+COMPULSORY_SUBJECTS = {"english", "mathematics"}
+
+# Patterns used to normalise subject names coming from free-text O'Level strings
+SUBJECT_ALIASES = {
+    "english language": "english",
+    "eng": "english",
+    "maths": "mathematics",
+    "math": "mathematics",
+    "further maths": "further mathematics",
+    "further math": "further mathematics",
+    "lit in english": "literature in english",
+    "literature": "literature in english",
+    "agric": "agricultural science",
+    "agric science": "agricultural science",
+    "civic": "civic education",
+    "econs": "economics",
+    "govt": "government",
+    "phy": "physics",
+    "chem": "chemistry",
+    "bio": "biology",
+    "crk": "christian religious knowledge",
+    "irk": "islamic religious knowledge",
+    "c.r.k": "christian religious knowledge",
+    "i.r.k": "islamic religious knowledge",
+    "c.r.s": "christian religious studies",
+    "i.r.s": "islamic religious studies",
+    "ict": "information technology",
+    "comp": "computer science",
+    "td": "technical drawing",
+}
+
+GRADE_PATTERN = re.compile(r'\b(A1|B2|B3|C4|C5|C6|D7|E8|F9)\b', re.IGNORECASE)
+CREDIT_GRADES = {"a1", "b2", "b3", "c4", "c5", "c6"}
+GRADE_RANK = {"A1": 1, "B2": 2, "B3": 3, "C4": 4, "C5": 5, "C6": 6, "D7": 7, "E8": 8, "F9": 9}
+
+# Word-level expansions applied before the phrase lookup, so "Eng. Lang." and
+# "Agric Sci" reach the same aliases as their spelled-out forms
+TOKEN_EXPANSIONS = {
+    "eng": "english",
+    "lang": "language",
+    "lit": "literature",
+    "sci": "science",
+    "agric": "agricultural",
+    "maths": "mathematics",
+    "math": "mathematics",
+    "mths": "mathematics",
+    "govt": "government",
+    "gov": "government",
+    "econs": "economics",
+    "econ": "economics",
+    "geog": "geography",
+    "tech": "technical",
+    "accts": "accounting",
+    "acct": "accounting",
+}
+
+# Canonical WAEC/NECO subject names; targets for fuzzy matching of misspellings
+KNOWN_SUBJECTS = {
+    "english", "mathematics", "further mathematics", "physics", "chemistry", "biology",
+    "agricultural science", "economics", "government", "literature in english", "geography",
+    "commerce", "financial accounting", "civic education", "history", "french", "yoruba",
+    "igbo", "hausa", "arabic", "computer science", "data processing", "information technology",
+    "technical drawing", "food and nutrition", "home management", "fine art", "music",
+    "marketing", "animal husbandry", "fisheries", "office practice", "book keeping",
+    "christian religious knowledge", "islamic religious knowledge",
+    "christian religious studies", "islamic religious studies", "visual art", "health education",
+    "physical education", "catering craft practice", "insurance", "salesmanship",
+}
+
+FUZZY_CUTOFF = 0.85      # difflib ratio; high enough that "physics" never becomes "phonics"
+FUZZY_MIN_LENGTH = 5     # short strings are abbreviations, not misspellings
+
+# One pass over the whole sitting: each comma/semicolon/pipe/newline separated
+# entry of the form "Subject: Grade", "Subject - Grade" or "Subject Grade"
+_ENTRY_PATTERN = re.compile(
+    r'(?:^|(?<=[,;|\n]))[^\S\n]*'
+    r'([^,;|\n]+?)(?:[^\S\n]|[:\-–])+'
+    r'(' + GRADE_PATTERN.pattern[3:-3] + r')[^\S\n]*'
+    r'(?=[,;|\n]|\Z)',
+    re.IGNORECASE,
+)
+_WORDS = re.compile(r"[a-z0-9]+")
+_LEADING_USE_OF = re.compile(r'^use of\s+')
+
+
+class SubjectResolver:
+  """
+  Maps free-text subject names onto canonical names.
+
+  Resolution order: exact alias, tokenised form (punctuation dropped, word
+  expansions applied) against the aliases, then a fuzzy match against known
+  subjects and alias phrases for misspellings. Unknown names pass through
+  lower-cased. Results are memoised, since the same few dozen spellings make
+  up nearly all traffic.
+  """
+
+  def __init__(self, aliases: dict[str, str], known_subjects: Iterable[str], cache_size: int = 4096):
+    self.aliases = dict(aliases)
+    # "c.r.k" and "crk" are the same alias once punctuation is stripped
+    for alias, subject in aliases.items():
+      self.aliases.setdefault(" ".join(_WORDS.findall(alias)), subject)
+      self.aliases.setdefault("".join(_WORDS.findall(alias)), subject)
+
+    self.known_subjects = set(known_subjects) | set(aliases.values())
+    self._fuzzy_targets = sorted(self.known_subjects | {a for a in self.aliases if len(a) >= FUZZY_MIN_LENGTH})
+    self.resolve = lru_cache(maxsize=cache_size)(self._resolve)
+
+  def _tokenize(self, cleaned: str) -> str:
+    return " ".join(TOKEN_EXPANSIONS.get(word, word) for word in _WORDS.findall(cleaned))
+
+  def _lookup(self, phrase: str) -> str | None:
+    if phrase in self.known_subjects:
+      return phrase
+    return self.aliases.get(phrase)
+
+  def _resolve(self, raw: str) -> str:
+    cleaned = raw.strip().lower()
+    found = self.aliases.get(cleaned)
+    if found:
+      return found
+
+    tokenized = self._tokenize(cleaned)
+    found = self._lookup(tokenized) or self._lookup(tokenized.replace(" ", ""))
+    if found:
+      return found
+
+    if len(tokenized) >= FUZZY_MIN_LENGTH:
+      close = difflib.get_close_matches(tokenized, self._fuzzy_targets, n=1, cutoff=FUZZY_CUTOFF)
+      if close:
+        return self._lookup(close[0]) or close[0]
+
+    return cleaned
+
+
+subject_resolver = SubjectResolver(SUBJECT_ALIASES, KNOWN_SUBJECTS)
+
+
+def normalise_subject(raw: str) -> str:
+  """Lower-case and resolve common aliases and misspellings."""
+  return subject_resolver.resolve(raw)
+
+
+def normalise_jamb_subject(raw: str) -> str:
+  """JAMB lists "Use of English"; everything else follows O'Level aliases."""
+  return subject_resolver.resolve(_LEADING_USE_OF.sub("", raw.strip().lower()))
+
+
+def parse_sitting(sitting_text: str) -> dict[str, str]:
+  """
+  Parse a free-text O'Level sitting into {normalised_subject: grade}.
+
+  Expects formats like:
+    "English Language: A1, Mathematics: B2, Physics: C4"
+    "English - A1 | Mathematics - B2"
+  Returns {} if nothing parseable is found.
+  """
+  results: dict[str, str] = {}
+  if not sitting_text:
+    return results
+
+  resolve = subject_resolver.resolve
+  for subject, grade in _ENTRY_PATTERN.findall(sitting_text):
+    # Keep best grade if subject appears in both sittings (handled at combine step)
+    results[resolve(subject)] = grade.upper()
+
+  return results
+
+
+def parse_many(sitting_texts: Iterable[str]) -> list[dict[str, str]]:
+  """
+  Parse a batch of sittings, in order. Identical texts are parsed once; each
+  result is a separate dict so callers may mutate them freely.
+  """
+  parsed: dict[str, dict[str, str]] = {}
+  results = []
+  for text in sitting_texts:
+    first = parsed.get(text)
+    if first is None:
+      # All copies are taken before returning, so the first result can be handed out as is
+      parsed[text] = first = parse_sitting(text)
+      results.append(first)
+    else:
+      results.append(dict(first))
+  return results
+
+
+def combine_sittings(sitting1: dict[str, str], sitting2: dict[str, str]) -> dict[str, str]:
+  """
+  Merge two sittings; keep the best (highest) grade per subject so that
+  the same subject is never double-counted.
+  Grade ranking: A1 > B2 > B3 > C4 > C5 > C6 > D7 > E8 > F9
+  """
+  combined = dict(sitting1)
+  for subject, grade in sitting2.items():
+    # Lower rank number = better grade
+    if subject not in combined or GRADE_RANK.get(grade, 99) < GRADE_RANK.get(combined[subject], 99):
+      combined[subject] = grade
+  return combined
@@ -0,0 +1,235 @@
+import logging
+import math
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+from .models import RateLimitBucket
+from .usage import set_usage_user, usage_rollup
+
+logger = logging.getLogger(__name__)
+
+
+class BucketStoreError(Exception):
+  """The store could not take a token in time; the limiter falls back to the next one."""
+
+
+def take_token(state: tuple | None, capacity: float, per_second: float, now: float) -> tuple[tuple, float]:
+  """
+  One token-bucket step. `state` is (tokens, refilled_at), or None for a full
+  bucket. Returns the new state and 0.0 if a token was taken, else the
+  seconds until one will be available.
+  """
+  tokens = capacity
+  if state is not None:
+    tokens, refilled_at = state
+    tokens = min(capacity, tokens + max(0.0, now - refilled_at) * per_second)
+  if tokens >= 1:
+    return (tokens - 1, now), 0.0
+  return (tokens, now), (1 - tokens) / per_second
+
+
+def refund_token(state: tuple | None, capacity: float, per_second: float, now: float) -> tuple | None:
+  """Give back a token taken by take_token(), up to a full bucket (None stays full)."""
+  if state is None:
+    return None
+  tokens, refilled_at = state
+  tokens = min(capacity, tokens + max(0.0, now - refilled_at) * per_second)
+  return (min(capacity, tokens + 1), now)
+
+
+class CacheBucketStore:
+  """
+  Buckets in a Django cache: shared by all workers with Redis or Memcached,
+  per process with the local-memory cache. Each read-modify-write holds a
+  short lock taken with cache.add(), which is atomic on those backends.
+  """
+
+  LOCK_TIMEOUT = 1      # seconds; frees the lock if a worker dies holding it
+  LOCK_WAIT = 0.05      # give up and fall back after this long
+  POLL_INTERVAL = 0.002
+
+  def __init__(self, cache):
+    self.cache = cache
+
+  @contextmanager
+  def _locked(self, key: str):
+    lock_key = f"{key}:lock"
+    deadline = time.monotonic() + self.LOCK_WAIT
+    while not self.cache.add(lock_key, 1, timeout=self.LOCK_TIMEOUT):
+      if time.monotonic() >= deadline:
+        raise BucketStoreError(f"{key} is busy")
+      time.sleep(self.POLL_INTERVAL)
+    try:
+      yield
+    finally:
+      self.cache.delete(lock_key)
+
+  def take(self, key: str, capacity: float, per_second: float) -> float:
+    with self._locked(key):
+      state, wait = take_token(self.cache.get(key), capacity, per_second, time.time())
+      # Kept until it would be full again; a missing bucket is a full one
+      self.cache.set(key, state, timeout=math.ceil(capacity / per_second) + 1)
+      return wait
+
+  def refund(self, key: str, capacity: float, per_second: float) -> None:
+    with self._locked(key):
+      state = refund_token(self.cache.get(key), capacity, per_second, time.time())
+      if state is not None:
+        self.cache.set(key, state, timeout=math.ceil(capacity / per_second) + 1)
+
+
+class DatabaseBucketStore:
+  """
+  Buckets as RateLimitBucket rows, updated under a row lock: shared by all
+  workers without Redis, at the cost of a locking transaction per bucket
+  per request. The Redis fallback, or the only store without Redis; see
+  AI_RATE_LIMIT_STORES.
+  """
+
+  def take(self, key: str, capacity: float, per_second: float) -> float:
+    now = time.time()
+    with transaction.atomic():
+      bucket, created = RateLimitBucket.objects.select_for_update().get_or_create(
+        key=key, defaults={"tokens": capacity, "refilled_at": now},
+      )
+      (bucket.tokens, bucket.refilled_at), wait = take_token(
+        (bucket.tokens, bucket.refilled_at), capacity, per_second, now,
+      )
+      bucket.save(update_fields=["tokens", "refilled_at"])
+    return wait
+
+  def refund(self, key: str, capacity: float, per_second: float) -> None:
+    with transaction.atomic():
+      bucket = RateLimitBucket.objects.select_for_update().filter(key=key).first()
+      if bucket is not None:
+        bucket.tokens, bucket.refilled_at = refund_token(
+          (bucket.tokens, bucket.refilled_at), capacity, per_second, time.time(),
+        )
+        bucket.save(update_fields=["tokens", "refilled_at"])
+
+
+class RateLimiter:
+  """
+  Per-user and per-IP token buckets in front of the Gemini-backed endpoints.
+
+  `rules` maps a scope ("user", "ip") to (burst, per_minute): a bucket holds
+  up to `burst` requests and refills at `per_minute`. A scope with a burst of
+  0 is not limited. The user bucket is tried first, so a rejected user does
+  not also spend their IP's tokens; if the IP bucket then rejects the
+  request, the user's token is given back.
+
+  Buckets are kept in the first of `stores` that answers. If none does, the
+  request is let through: the limiter must not take the API down with it.
+  """
+
+  def __init__(self, rules: dict[str, tuple[float, float]], stores: list, trusted_proxies: int = 0):
+    self.rules = {scope: rule for scope, rule in rules.items() if rule[0] > 0 and rule[1] > 0}
+    self.stores = stores
+    self.trusted_proxies = trusted_proxies
+
+  def client_ip(self, request) -> str:
+    """REMOTE_ADDR, or the address our own proxies put in X-Forwarded-For."""
+    if self.trusted_proxies:
+      forwarded = [hop.strip() for hop in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",") if hop.strip()]
+      if len(forwarded) >= self.trusted_proxies:
+        return forwarded[-self.trusted_proxies]
+    return request.META.get("REMOTE_ADDR", "")
+
+  def _take(self, key: str, capacity: float, per_second: float) -> tuple[float, object]:
+    """(wait, the store that answered), or (0.0, None) if none did."""
+    for store in self.stores:
+      try:
+        return store.take(key, capacity, per_second), store
+      except Exception as e:
+        logger.warning(f"Rate limit store {type(store).__name__} failed for {key}: {e}")
+    return 0.0, None
+
+  def _refund(self, store, key: str, capacity: float, per_second: float) -> None:
+    try:
+      store.refund(key, capacity, per_second)
+    except Exception as e:
+      logger.warning(f"Rate limit store {type(store).__name__} failed to refund {key}: {e}")
+
+  def wait_time(self, user_id: int | None, ip: str) -> float:
+    """0.0 if the request may go ahead (its tokens are taken), else seconds to wait."""
+    subjects = {"user": user_id, "ip": ip or None}
+    taken = []
+    for scope, (burst, per_minute) in self.rules.items():
+      if subjects.get(scope) is None:
+        continue
+      key = f"ai:{scope}:{subjects[scope]}"
+      wait, store = self._take(key, burst, per_minute / 60)
+      if wait:
+        metrics.rate_limited.labels(scope).inc()
+        # Rejected: the earlier scopes keep their tokens
+        for args in taken:
+          self._refund(*args)
+        return wait
+      if store is not None:
+        taken.append((store, key, burst, per_minute / 60))
+    return 0.0
+
+  def check(self, request) -> float:
+    """
+    wait_time() for a request, which is also counted in the user's daily usage.
+    Their LLM calls for the rest of the request are billed to them too.
+    """
+    user = getattr(request, "user", None)
+    user_id = user.pk if user is not None and user.is_authenticated else None
+    set_usage_user(user_id)
+
+    wait = self.wait_time(user_id, self.client_ip(request))
+    usage_rollup.add(user_id, **({"throttled": 1} if wait else {"requests": 1}))
+    usage_rollup.flush_if_due()
+    return wait
+
+
+STORES = {
+  "cache": lambda: CacheBucketStore(caches[settings.AI_RATE_LIMIT_CACHE]),
+  "database": DatabaseBucketStore,
+}
+
+
+def _stores() -> list:
+  """The stores named in AI_RATE_LIMIT_STORES, in order."""
+  unknown = set(settings.AI_RATE_LIMIT_STORES) - STORES.keys()
+  if unknown:
+    raise ImproperlyConfigured(f"Unknown AI_RATE_LIMIT_STORES: {', '.join(sorted(unknown))}")
+  stores = [STORES[name]() for name in settings.AI_RATE_LIMIT_STORES]
+  # A local-memory cache answers every time, so later stores never get a say
+  first = stores[0] if stores else None
+  if isinstance(first, CacheBucketStore) and isinstance(first.cache, LocMemCache) and not settings.DEBUG:
+    logger.warning(
+      "AI rate limits are kept in each worker's local-memory cache, so every worker allows the full "
+      "limit. Set AI_RATE_LIMIT_CACHE_URL, or list database first in AI_RATE_LIMIT_STORES."
+    )
+  return stores
+
+
+ai_rate_limiter = RateLimiter(
+  rules={
+    "user": (settings.AI_RATE_LIMIT_USER_BURST, settings.AI_RATE_LIMIT_USER_PER_MINUTE),
+    "ip": (settings.AI_RATE_LIMIT_IP_BURST, settings.AI_RATE_LIMIT_IP_PER_MINUTE),
+  },
+  stores=_stores(),
+  trusted_proxies=settings.AI_RATE_LIMIT_TRUSTED_PROXIES,
+)
+
+
+class AIRateThrottle(BaseThrottle):
+  """DRF throttle for the Gemini-backed views: 429 with Retry-After once a bucket is empty."""
+
+  def allow_request(self, request, view):
+    self.wait_seconds = ai_rate_limiter.check(request)
+    return not self.wait_seconds
+
+  def wait(self):
+    return self.wait_seconds
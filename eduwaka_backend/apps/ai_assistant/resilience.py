@@ -0,0 +1,573 @@
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from typing import AsyncIterator, Iterator
+
+from . import metrics
+from .llm import LLMClient, LLMResponse
+
+logger = logging.getLogger(__name__)
+
+# google.api_core exception classes worth another attempt, matched by name so
+# the check works without importing the Gemini SDK
+RETRYABLE_ERROR_NAMES = {
+  "ServiceUnavailable", "TooManyRequests", "ResourceExhausted", "InternalServerError",
+  "DeadlineExceeded", "GatewayTimeout", "BadGateway", "Aborted",
+}
+_RETRYABLE_MESSAGE = re.compile(
+  r"\b(?:429|500|502|503|504)\b|unavailable|overloaded|rate limit|resource exhausted"
+  r"|deadline exceeded|timed? ?out|connection (?:reset|refused|aborted)",
+  re.IGNORECASE,
+)
+
+
+class LLMUnavailableError(Exception):
+  """The LLM is unhealthy: timed out, kept failing, or the circuit is open."""
+  retry_after: int | None = None
+  outcome = "unavailable"  # metrics label
+
+
+class LLMTimeoutError(LLMUnavailableError):
+  outcome = "timeout"
+
+
+class CircuitOpenError(LLMUnavailableError):
+  outcome = "circuit_open"
+
+  def __init__(self, retry_after: float):
+    self.retry_after = max(1, round(retry_after))
+    super().__init__(f"AI service temporarily unavailable; retry in {self.retry_after}s")
+
+
+def is_retryable(error: BaseException) -> bool:
+  """Upstream trouble (5xx, 429, timeouts, dropped connections), not a bad request."""
+  if isinstance(error, (TimeoutError, ConnectionError, LLMTimeoutError)):
+    return True
+  if any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__):
+    return True
+  return bool(_RETRYABLE_MESSAGE.search(str(error)))
+
+
+class CircuitBreaker:
+  """
+  Closed -> open when at least `failure_rate` of the calls in the last `window`
+  seconds failed (and there were at least `min_calls` of them). Open fails every
+  call at once for `open_seconds`; then one probe call is let through
+  (half-open), and its outcome closes or re-opens the circuit.
+  """
+
+  def __init__(self, failure_rate: float, min_calls: int, window: float, open_seconds: float, clock=time.monotonic):
+    self.failure_rate = failure_rate
+    self.min_calls = min_calls
+    self.window = window
+    self.open_seconds = open_seconds
+    self._clock = clock
+    self._lock = threading.Lock()
+    self.reset()
+
+  def reset(self) -> None:
+    with self._lock:
+      self._calls: deque[tuple[float, bool]] = deque()  # (time, failed)
+      self._opened_at = None
+      self._probing = False
+      self._stats = {"opened": 0, "rejected": 0}
+
+  @property
+  def state(self) -> str:
+    with self._lock:
+      return self._state(self._clock())
+
+  def _state(self, now: float) -> str:
+    if self._opened_at is None:
+      return "closed"
+    return "open" if now - self._opened_at < self.open_seconds else "half_open"
+
+  def before_call(self) -> bool:
+    """
+    Raises CircuitOpenError unless this call may go upstream. True if it is
+    the half-open probe, which must end in record() or release().
+    """
+    with self._lock:
+      now = self._clock()
+      state = self._state(now)
+      if state == "closed":
+        return False
+      if state == "half_open" and not self._probing:
+        self._probing = True
+        return True
+      self._stats["rejected"] += 1
+      retry_after = self._opened_at + self.open_seconds - now
+    raise CircuitOpenError(retry_after if retry_after > 0 else self.open_seconds)
+
+  def record(self, failed: bool) -> None:
+    with self._lock:
+      now = self._clock()
+      if self._opened_at is not None:
+        if self._probing:
+          # The probe decides: back to normal, or another full open period
+          self._probing = False
+          self._opened_at = now if failed else None
+          self._calls.clear()
+        return
+
+      self._calls.append((now, failed))
+      while self._calls and now - self._calls[0][0] > self.window:
+        self._calls.popleft()
+      failures = sum(1 for _, f in self._calls if f)
+      if failed and len(self._calls) >= self.min_calls and failures >= self.failure_rate * len(self._calls):
+        self._opened_at = now
+        self._stats["opened"] += 1
+        logger.warning(f"LLM circuit opened: {failures} of the last {len(self._calls)} calls failed")
+
+  def release(self) -> None:
+    """The probe ended without an outcome (cancelled): no verdict, the next call probes."""
+    with self._lock:
+      self._probing = False
+
+  def stats(self) -> dict:
+    with self._lock:
+      stats = dict(self._stats)
+      stats["state"] = self._state(self._clock())
+      stats["recent_calls"] = len(self._calls)
+      stats["recent_failures"] = sum(1 for _, f in self._calls if f)
+    return stats
+
+
+class LatencyTracker:
+  """Latencies of the last `size` successful calls, for the hedging delay."""
+
+  def __init__(self, size: int = 200, min_samples: int = 20):
+    self.min_samples = min_samples
+    self._samples: deque[float] = deque(maxlen=size)
+    self._lock = threading.Lock()
+
+  def add(self, seconds: float) -> None:
+    with self._lock:
+      self._samples.append(seconds)
+
+  def percentile(self, fraction: float) -> float | None:
+    """None until there are enough samples to trust."""
+    with self._lock:
+      if len(self._samples) < self.min_samples:
+        return None
+      ordered = sorted(self._samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class ResilientClient(LLMClient):
+  """
+  Wraps any LLMClient (see get_llm_client) with:
+
+    timeout      seconds per attempt; the caller gets LLMTimeoutError instead of
+                 waiting on a hung upstream (0 waits forever)
+    max_retries  further attempts for retryable errors (is_retryable), after an
+                 exponential backoff with full jitter, within `deadline` seconds
+    hedge        once enough latencies are known, a second identical request is
+                 sent when the first is still running at the p95; the first
+                 answer wins. generate/agenerate only
+    breaker      a CircuitBreaker; while open, calls fail at once with
+                 CircuitOpenError so the views can serve a cached or degraded answer
+    limiter      a limiter.ConcurrencyLimiter; each attempt holds one of its slots,
+                 queued by the `priority` the caller passes (a stream holds one
+                 until it ends). Hedges only go out while a slot is free
+
+  Metrics are labelled with the `endpoint` the caller passes, else its priority.
+
+  Retries exhausted and timeouts both surface as LLMUnavailableError. Errors
+  that are not retryable (bad request, blocked prompt...) are raised unchanged.
+  Sync calls run on a small thread pool so they can be timed out; a timed-out
+  call keeps its pool thread until the upstream gives up.
+  """
+
+  MAX_THREADS = 32
+
+  def __init__(
+      self,
+      backend: LLMClient,
+      *,
+      timeout: float,
+      deadline: float,
+      max_retries: int,
+      backoff_base: float,
+      backoff_max: float,
+      hedge: bool,
+      breaker: CircuitBreaker,
+      limiter=None,
+      hedge_percentile: float = 0.95,
+      rng: random.Random | None = None,
+  ):
+    self.backend = backend
+    self.timeout = timeout
+    self.deadline = deadline
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.hedge = hedge
+    self.hedge_percentile = hedge_percentile
+    self.breaker = breaker
+    self.limiter = limiter
+    self.latencies = LatencyTracker()
+    self._random = rng or random.Random()
+    self._executor = ThreadPoolExecutor(max_workers=self.MAX_THREADS, thread_name_prefix="llm-call")
+    self._lock = threading.Lock()
+    self._stats = {"calls": 0, "retries": 0, "timeouts": 0, "hedges": 0, "hedge_wins": 0}
+
+  @property
+  def model_name(self) -> str:
+    return self.backend.model_name
+
+  def _count(self, name: str) -> None:
+    with self._lock:
+      self._stats[name] += 1
+
+  def stats(self) -> dict:
+    with self._lock:
+      stats = dict(self._stats)
+    stats["hedge_delay"] = self._hedge_delay()
+    stats["breaker"] = self.breaker.stats()
+    if self.limiter is not None:
+      stats["limiter"] = self.limiter.stats()
+    return stats
+
+  def with_priority(self, priority: str, endpoint: str | None = None) -> "PrioritizedClient":
+    """A plain LLMClient whose calls all queue as `priority`, for code that takes one."""
+    return PrioritizedClient(self, priority, endpoint)
+
+  #  Policy
+  def _backoff(self, attempt: int) -> float:
+    """Full jitter: uniform over [0, min(max, base * 2^attempt)]."""
+    return self._random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+  def _hedge_delay(self) -> float | None:
+    if not self.hedge or (self.limiter is not None and not self.limiter.has_capacity()):
+      return None
+    return self.latencies.percentile(self.hedge_percentile)
+
+  @contextmanager
+  def _slot(self, priority: str, endpoint: str, take: bool = True):
+    """A limiter slot for one call, counted in the in-flight gauge; nothing if not `take` (caller holds one)."""
+    if not take:
+      yield
+      return
+    with self.limiter.slot(priority) if self.limiter is not None else nullcontext():
+      in_flight = metrics.llm_in_flight.labels(endpoint)
+      in_flight.inc()
+      try:
+        yield
+      finally:
+        in_flight.dec()
+
+  @asynccontextmanager
+  async def _aslot(self, priority: str, endpoint: str, take: bool = True):
+    """Async counterpart of _slot."""
+    if not take:
+      yield
+      return
+    async with self.limiter.aslot(priority) if self.limiter is not None else _anullcontext():
+      in_flight = metrics.llm_in_flight.labels(endpoint)
+      in_flight.inc()
+      try:
+        yield
+      finally:
+        in_flight.dec()
+
+  def _attempt_timeout(self, started: float) -> float | None:
+    """This attempt's timeout: the per-call timeout, cut to what is left of the deadline."""
+    limits = [t for t in (self.timeout, self.deadline and self.deadline - (time.monotonic() - started)) if t]
+    return max(min(limits), 0.001) if limits else None
+
+  def _next_delay(self, error: BaseException, attempt: int, started: float) -> float | None:
+    """Seconds to wait before retrying, or None to give up."""
+    if not is_retryable(error) or attempt >= self.max_retries:
+      return None
+    delay = self._backoff(attempt)
+    if self.deadline and time.monotonic() - started + delay >= self.deadline:
+      return None
+    return delay
+
+  def _give_up(self, error: Exception):
+    if isinstance(error, LLMUnavailableError) or not is_retryable(error):
+      raise error
+    raise LLMUnavailableError(f"AI service temporarily unavailable: {error}") from error
+
+  def _record(self, endpoint: str, error: BaseException | None, elapsed: float) -> None:
+    # Only upstream trouble counts against the circuit; a bad request says nothing about health
+    self.breaker.record(failed=error is not None and is_retryable(error))
+    if error is None:
+      self.latencies.add(elapsed)
+    outcome = "ok" if error is None else "timeout" if isinstance(error, LLMTimeoutError) else "error"
+    metrics.llm_attempts.labels(endpoint, outcome).inc()
+
+  def _observe(self, endpoint: str, started: float, response: LLMResponse | None, error: BaseException | None) -> None:
+    """Metrics for one whole call, as the caller saw it."""
+    outcome = "ok" if error is None else getattr(error, "outcome", "error")
+    metrics.llm_call_seconds.labels(endpoint, outcome).observe(time.monotonic() - started)
+    if response is not None:
+      metrics.llm_tokens.labels(endpoint, "prompt").inc(response.prompt_tokens)
+      metrics.llm_tokens.labels(endpoint, "output").inc(response.output_tokens)
+      metrics.llm_finish_reasons.labels(endpoint, response.finish_reason or "UNFINISHED").inc()
+
+  def _retried(self, endpoint: str, error: Exception, attempt: int, delay: float) -> None:
+    logger.info(f"LLM call failed ({error}); retry {attempt + 1} in {delay:.2f}s")
+    self._count("retries")
+    metrics.llm_retries.labels(endpoint).inc()
+
+  def _hedged(self, endpoint: str) -> None:
+    self._count("hedges")
+    metrics.llm_hedges.labels(endpoint).inc()
+
+  #  Sync
+  def _timed(self, call, timeout: float | None, endpoint: str, hedge: bool = True):
+    """call() on the pool, hedged if enabled; LLMTimeoutError after `timeout` seconds."""
+    hedge_delay = self._hedge_delay() if hedge else None
+    if not timeout and hedge_delay is None:
+      return call()
+
+    futures = [self._executor.submit(call)]
+    started = time.monotonic()
+    if hedge_delay is not None and (not timeout or hedge_delay < timeout):
+      done, _ = wait(futures, timeout=hedge_delay)
+      if not done:
+        self._hedged(endpoint)
+        futures.append(self._executor.submit(call))
+
+    error = None
+    pending = set(futures)
+    while pending:
+      remaining = timeout - (time.monotonic() - started) if timeout else None
+      if remaining is not None and remaining <= 0:
+        break
+      done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+      for future in done:
+        if future.exception() is None:
+          if future is not futures[0]:
+            self._count("hedge_wins")
+          return future.result()
+        error = future.exception()
+    if error is not None and not pending:
+      raise error
+    self._count("timeouts")
+    raise LLMTimeoutError(f"AI service timed out after {timeout:g}s")
+
+  def _call(self, fn, priority: str, endpoint: str, take_slot: bool = True):
+    """fn(timeout) with retries; each attempt in a limiter slot unless the caller holds one."""
+    self._count("calls")
+    started = time.monotonic()
+    attempt = 0
+    while True:
+      # Slot first: a half-open probe must not wait in the queue
+      with self._slot(priority, endpoint, take_slot):
+        probe = self.breaker.before_call()
+        attempt_started = time.monotonic()
+        try:
+          result, error = fn(self._attempt_timeout(started)), None
+        except Exception as e:
+          result, error = None, e
+        except BaseException:
+          if probe:
+            self.breaker.release()
+          raise
+      self._record(endpoint, error, time.monotonic() - attempt_started)
+      if error is None:
+        return result
+
+      delay = self._next_delay(error, attempt, started)
+      if delay is None:
+        self._give_up(error)
+      self._retried(endpoint, error, attempt, delay)
+      attempt += 1
+      time.sleep(delay)
+
+  def generate(self, contents, generation_config=None, *, priority: str = "chat", endpoint: str | None = None):
+    """endpoint: the metrics label for the caller, `priority` if not given."""
+    endpoint = endpoint or priority
+    started = time.monotonic()
+    try:
+      response = self._call(
+        lambda timeout: self._timed(lambda: self.backend.generate(contents, generation_config), timeout, endpoint),
+        priority,
+        endpoint,
+      )
+    except Exception as e:
+      self._observe(endpoint, started, None, e)
+      raise
+    self._observe(endpoint, started, response, None)
+    return response
+
+  def stream(
+      self, contents, generation_config=None, *, priority: str = "chat", endpoint: str | None = None,
+  ) -> Iterator[LLMResponse]:
+    """
+    Retries and the timeout cover opening the stream, up to its first chunk;
+    once text has been sent to the client a failure can no longer be retried.
+    Each later chunk must also arrive within the per-call timeout, so a stream
+    that stalls halfway fails instead of holding its slot.
+    """
+    def first_chunk(timeout):
+      chunks = iter(self.backend.stream(contents, generation_config))
+      # Not hedged: both requests would share one iterator
+      return self._timed(lambda: (next(chunks, None), chunks), timeout, endpoint, hedge=False)
+
+    endpoint = endpoint or priority
+    started = time.monotonic()
+    last, error = None, None
+    try:
+      with self._slot(priority, endpoint):
+        chunk, chunks = self._call(first_chunk, priority, endpoint, take_slot=False)
+        while chunk is not None:
+          last = chunk
+          yield chunk
+          chunk = self._timed(lambda: next(chunks, None), self.timeout, endpoint, hedge=False)
+    except Exception as e:
+      error = e
+      raise
+    finally:
+      # Gemini's usage on the last chunk covers the whole stream
+      self._observe(endpoint, started, last if error is None else None, error)
+
+  #  Async
+  async def _atimed(self, make_call, timeout: float | None, endpoint: str, hedge: bool = True):
+    """Async counterpart of _timed."""
+    tasks = [asyncio.ensure_future(make_call())]
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    try:
+      hedge_delay = self._hedge_delay() if hedge else None
+      if hedge_delay is not None and (not timeout or hedge_delay < timeout):
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+        if not done:
+          self._hedged(endpoint)
+          tasks.append(asyncio.ensure_future(make_call()))
+
+      error = None
+      pending = set(tasks)
+      while pending:
+        remaining = timeout - (loop.time() - started) if timeout else None
+        if remaining is not None and remaining <= 0:
+          break
+        done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+          if task.exception() is None:
+            if task is not tasks[0]:
+              self._count("hedge_wins")
+            return task.result()
+          error = task.exception()
+      if error is not None and not pending:
+        raise error
+      self._count("timeouts")
+      raise LLMTimeoutError(f"AI service timed out after {timeout:g}s")
+    finally:
+      for task in tasks:
+        task.cancel()
+
+  async def _acall(self, fn, priority: str, endpoint: str, take_slot: bool = True):
+    """Async counterpart of _call(): awaits fn(timeout)."""
+    self._count("calls")
+    started = time.monotonic()
+    attempt = 0
+    while True:
+      async with self._aslot(priority, endpoint, take_slot):
+        probe = self.breaker.before_call()
+        attempt_started = time.monotonic()
+        try:
+          result, error = await fn(self._attempt_timeout(started)), None
+        except Exception as e:
+          result, error = None, e
+        except BaseException:
+          # Cancelled (client went away): says nothing about upstream health
+          if probe:
+            self.breaker.release()
+          raise
+      self._record(endpoint, error, time.monotonic() - attempt_started)
+      if error is None:
+        return result
+
+      delay = self._next_delay(error, attempt, started)
+      if delay is None:
+        self._give_up(error)
+      self._retried(endpoint, error, attempt, delay)
+      attempt += 1
+      await asyncio.sleep(delay)
+
+  async def agenerate(self, contents, generation_config=None, *, priority: str = "chat", endpoint: str | None = None):
+    endpoint = endpoint or priority
+    started = time.monotonic()
+    try:
+      response = await self._acall(
+        lambda timeout: self._atimed(lambda: self.backend.agenerate(contents, generation_config), timeout, endpoint),
+        priority,
+        endpoint,
+      )
+    except Exception as e:
+      self._observe(endpoint, started, None, e)
+      raise
+    self._observe(endpoint, started, response, None)
+    return response
+
+  async def astream(
+      self, contents, generation_config=None, *, priority: str = "chat", endpoint: str | None = None,
+  ) -> AsyncIterator[LLMResponse]:
+    """Async counterpart of stream(), with the same retry and timeout cover."""
+    def first_chunk(timeout):
+      chunks = aiter(self.backend.astream(contents, generation_config))
+
+      async def open_stream():
+        return await anext(chunks, None), chunks
+
+      return self._atimed(open_stream, timeout, endpoint, hedge=False)
+
+    endpoint = endpoint or priority
+    started = time.monotonic()
+    last, error = None, None
+    try:
+      async with self._aslot(priority, endpoint):
+        chunk, chunks = await self._acall(first_chunk, priority, endpoint, take_slot=False)
+
+        async def next_chunk():
+          return await anext(chunks, None)
+
+        while chunk is not None:
+          last = chunk
+          yield chunk
+          chunk = await self._atimed(next_chunk, self.timeout, endpoint, hedge=False)
+    except Exception as e:
+      error = e
+      raise
+    finally:
+      self._observe(endpoint, started, last if error is None else None, error)
+
+
+@asynccontextmanager
+async def _anullcontext():
+  yield
+
+
+class PrioritizedClient(LLMClient):
+  """A ResilientClient seen through the plain LLMClient interface, with a fixed priority and metrics endpoint."""
+
+  def __init__(self, client: ResilientClient, priority: str, endpoint: str | None = None):
+    self.client = client
+    self.priority = priority
+    self.endpoint = endpoint
+
+  @property
+  def model_name(self) -> str:
+    return self.client.model_name
+
+  def generate(self, contents, generation_config=None):
+    return self.client.generate(contents, generation_config, priority=self.priority, endpoint=self.endpoint)
+
+  async def agenerate(self, contents, generation_config=None):
+    return await self.client.agenerate(contents, generation_config, priority=self.priority, endpoint=self.endpoint)
+
+  def stream(self, contents, generation_config=None):
+    return self.client.stream(contents, generation_config, priority=self.priority, endpoint=self.endpoint)
+
+  def astream(self, contents, generation_config=None):
+    return self.client.astream(contents, generation_config, priority=self.priority, endpoint=self.endpoint)
@@ -0,0 +1,289 @@
+import math
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from apps.courses.models import Course
+from apps.institutions.models import Institution
+from .cache import INSTITUTION_ABBREVIATIONS
+from .llm import estimate_tokens
+from .semantic_cache import question_terms
+
+# Field weights: a hit on the course or institution name counts for more
+COURSE_FIELD_WEIGHTS = {
+  "name": 3,
+  "faculty": 1,
+  "department": 1,
+  "institution__name": 2,
+  "institution__abbreviation": 2,
+  "institution__state": 1,
+  "institution__city": 1,
+}
+INSTITUTION_FIELD_WEIGHTS = {
+  "name": 3,
+  "abbreviation": 3,
+  "state": 1,
+  "city": 1,
+  "institution_type": 1,
+  "ownership_type": 1,
+}
+
+# Institution field defaults; not real data
+PLACEHOLDER_VALUES = {"check on google"}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def _present(value) -> str:
+  text = str(value or "").strip()
+  return "" if text.lower() in PLACEHOLDER_VALUES else text
+
+
+def _document_terms(row: dict, weights: dict[str, int]) -> Counter:
+  counts = Counter()
+  for field, weight in weights.items():
+    for term in question_terms(_present(row.get(field)).replace("_", " ")):
+      counts[term] += weight
+  return counts
+
+
+class CatalogIndex:
+  """
+  In-process inverted index over Institution and Course rows, ranked with BM25.
+
+  Documents are keyed ("course", pk) / ("institution", pk). The index is built
+  on first use and then kept current by the Course/Institution signals (see
+  signals.py). Those only fire in the worker that made the change, so every
+  worker also rebuilds after `ttl` seconds: one thread rebuilds while the
+  others keep searching the old index.
+  """
+
+  def __init__(self, ttl: int, clock=time.monotonic):
+    self.ttl = ttl
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._rebuild_lock = threading.Lock()  # held by the one thread rebuilding
+    self._built_at = None
+    self._postings: dict[str, dict[tuple, int]] = {}
+    self._documents: dict[tuple, Counter] = {}
+    self._lengths: dict[tuple, int] = {}
+    self._total_length = 0
+
+  @property
+  def is_built(self) -> bool:
+    return self._built_at is not None
+
+  #  Maintenance
+  def _add(self, key: tuple, terms: Counter) -> None:
+    self._remove(key)
+    if not terms:
+      return
+    self._documents[key] = terms
+    self._lengths[key] = sum(terms.values())
+    self._total_length += self._lengths[key]
+    for term, count in terms.items():
+      self._postings.setdefault(term, {})[key] = count
+
+  def _remove(self, key: tuple) -> None:
+    terms = self._documents.pop(key, None)
+    if terms is None:
+      return
+    self._total_length -= self._lengths.pop(key)
+    for term in terms:
+      posting = self._postings[term]
+      del posting[key]
+      if not posting:
+        del self._postings[term]
+
+  def _course_rows(self, courses):
+    return courses.values("pk", *COURSE_FIELD_WEIGHTS)
+
+  def rebuild(self) -> None:
+    """Index the whole catalog: two queries, only the searchable columns."""
+    institutions = list(Institution.objects.values("pk", *INSTITUTION_FIELD_WEIGHTS))
+    courses = list(self._course_rows(Course.objects.all()))
+    # Build aside and swap in, so searches never wait on the whole catalog
+    fresh = CatalogIndex(self.ttl, self._clock)
+    for row in institutions:
+      fresh._add(("institution", row["pk"]), _document_terms(row, INSTITUTION_FIELD_WEIGHTS))
+    for row in courses:
+      fresh._add(("course", row["pk"]), _document_terms(row, COURSE_FIELD_WEIGHTS))
+    with self._lock:
+      self._postings, self._documents, self._lengths, self._total_length = (
+        fresh._postings, fresh._documents, fresh._lengths, fresh._total_length,
+      )
+      self._built_at = self._clock()
+
+  def _is_fresh(self) -> bool:
+    return self._built_at is not None and self._clock() - self._built_at <= self.ttl
+
+  def _ensure_built(self) -> None:
+    if self._is_fresh():
+      return
+    if self._built_at is None:
+      # Nothing to search yet: wait for whoever is building the first index
+      with self._rebuild_lock:
+        if self._built_at is None:
+          self.rebuild()
+      return
+    # Stale: one thread rebuilds, the rest search the old index meanwhile
+    if self._rebuild_lock.acquire(blocking=False):
+      try:
+        if not self._is_fresh():
+          self.rebuild()
+      finally:
+        self._rebuild_lock.release()
+
+  def index_courses(self, course_ids) -> None:
+    if not self.is_built:
+      return  # the first search builds everything anyway
+    rows = {row["pk"]: row for row in self._course_rows(Course.objects.filter(pk__in=course_ids))}
+    with self._lock:
+      for pk in course_ids:
+        if pk in rows:
+          self._add(("course", pk), _document_terms(rows[pk], COURSE_FIELD_WEIGHTS))
+        else:
+          self._remove(("course", pk))
+
+  def index_institution(self, institution) -> None:
+    """Re-index the institution and its courses, whose documents carry its name."""
+    if not self.is_built:
+      return
+    row = {field: getattr(institution, field) for field in INSTITUTION_FIELD_WEIGHTS}
+    with self._lock:
+      self._add(("institution", institution.pk), _document_terms(row, INSTITUTION_FIELD_WEIGHTS))
+    self.index_courses(list(Course.objects.filter(institution_id=institution.pk).values_list("pk", flat=True)))
+
+  def remove(self, kind: str, pk: int) -> None:
+    with self._lock:
+      self._remove((kind, pk))
+
+  #  Search
+  def _query_terms(self, text: str) -> set[str]:
+    terms = set(question_terms(text))
+    # "UNILAG" also finds rows that only spell out "University of Lagos"
+    for term in list(terms):
+      if term in INSTITUTION_ABBREVIATIONS:
+        terms.update(question_terms(INSTITUTION_ABBREVIATIONS[term]))
+    return terms
+
+  def search(self, text: str, limit: int) -> list[tuple[tuple, float, frozenset]]:
+    """(document key, BM25 score, matched query terms) of the best matches, best first."""
+    self._ensure_built()
+    terms = self._query_terms(text)
+    with self._lock:
+      count = len(self._documents)
+      if not count:
+        return []
+      average_length = self._total_length / count
+      scores: dict[tuple, float] = {}
+      matched: dict[tuple, set] = {}
+      for term in terms:
+        posting = self._postings.get(term)
+        if not posting:
+          continue
+        idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+        for key, frequency in posting.items():
+          norm = frequency + BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[key] / average_length)
+          scores[key] = scores.get(key, 0.0) + idf * frequency * (BM25_K1 + 1) / norm
+          matched.setdefault(key, set()).add(term)
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return [(key, scores[key], frozenset(matched[key])) for key in best]
+
+
+class CatalogRetriever:
+  """
+  Turns a chat message into a short block of catalog facts for the prompt:
+  the top_k best matching courses/institutions, within max_tokens.
+  """
+
+  INTRO = (
+    "EduWaka catalog entries that may be relevant. Prefer them over your own knowledge "
+    "when they apply, and ignore them when they don't:"
+  )
+  FIELD_CHARS = 300  # per requirements field; long free text is cut
+
+  def __init__(self, index: CatalogIndex, top_k: int, max_tokens: int, min_relative_score: float = 0.5):
+    self.index = index
+    self.top_k = top_k
+    self.max_tokens = max_tokens
+    self.min_relative_score = min_relative_score
+
+  @property
+  def enabled(self) -> bool:
+    return self.top_k > 0
+
+  def _clip(self, value) -> str:
+    text = " ".join(_present(value).split())
+    return text if len(text) <= self.FIELD_CHARS else text[:self.FIELD_CHARS].rstrip() + "…"
+
+  def _institution_label(self, institution) -> str:
+    abbreviation = _present(institution.abbreviation)
+    return f"{institution.name} ({abbreviation})" if abbreviation else institution.name
+
+  def _format_course(self, course) -> str:
+    details = [f"{course.duration_years} years"] if course.duration_years else []
+    for label, value in (
+        ("O'Level", course.olevel_requirements),
+        ("UTME subjects", course.jamb_requirements),
+        ("Post-UTME", course.post_utme_details),
+    ):
+      if _present(value):
+        details.append(f"{label}: {self._clip(value)}")
+    return f"- {course.name} at {self._institution_label(course.institution)}. " + "; ".join(details)
+
+  def _format_institution(self, institution) -> str:
+    kind = " ".join(filter(None, [institution.get_ownership_type_display(), institution.get_institution_type_display()]))
+    place = ", ".join(filter(None, [_present(institution.city), _present(institution.state)]))
+    line = f"- {self._institution_label(institution)}: {kind.lower()}" + (f" in {place}" if place else "")
+    if _present(institution.year_of_establishment):
+      line += f", established {_present(institution.year_of_establishment)}"
+    website = _present(institution.website)
+    return line + (f". Website: {website}" if website else "")
+
+  def context_block(self, text: str) -> str | None:
+    """The catalog block for this message, or None when nothing matches well."""
+    if not self.enabled:
+      return None
+    results = self.index.search(text, self.top_k)
+    if not results:
+      return None
+    _, top_score, top_terms = results[0]
+    # Asked about Medicine at UNILAG: other Medicine courses may help, other UNILAG courses don't
+    keys = [
+      key for key, score, terms in results
+      if score >= top_score * self.min_relative_score and not terms < top_terms
+    ]
+
+    # One query per kind, by primary key
+    course_ids = [pk for kind, pk in keys if kind == "course"]
+    institution_ids = [pk for kind, pk in keys if kind == "institution"]
+    courses = Course.objects.select_related("institution").in_bulk(course_ids) if course_ids else {}
+    institutions = Institution.objects.in_bulk(institution_ids) if institution_ids else {}
+
+    lines = [self.INTRO]
+    tokens = estimate_tokens(self.INTRO)
+    for kind, pk in keys:
+      if kind == "course" and pk in courses:
+        line = self._format_course(courses[pk])
+      elif kind == "institution" and pk in institutions:
+        line = self._format_institution(institutions[pk])
+      else:
+        continue  # deleted since it was indexed
+      if tokens + estimate_tokens(line) > self.max_tokens:
+        break
+      lines.append(line)
+      tokens += estimate_tokens(line)
+    return "\n".join(lines) if len(lines) > 1 else None
+
+
+catalog_index = CatalogIndex(ttl=settings.AI_CATALOG_INDEX_TTL)
+
+catalog_retriever = CatalogRetriever(
+  catalog_index,
+  top_k=settings.AI_CHAT_CATALOG_TOP_K,
+  max_tokens=settings.AI_CHAT_CATALOG_MAX_TOKENS,
+)
@@ -0,0 +1,220 @@
+import hashlib
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from . import metrics
+
+try:
+  import numpy as np
+except ImportError:  # optional; the pure-Python scorer is fine for a few thousand entries
+  np = None
+
+# Words that carry no meaning for matching admissions questions
+STOPWORDS = {
+  "a", "an", "the", "is", "are", "was", "be", "am", "do", "does", "did", "i", "me", "my", "you",
+  "your", "we", "it", "its", "of", "in", "on", "at", "to", "for", "and", "or", "with", "about",
+  "what", "whats", "which", "how", "when", "where", "please", "pls", "can", "could", "would",
+  "will", "should", "tell", "know", "want", "there", "this", "that", "these", "those", "so",
+  "if", "any", "some", "hi", "hello", "kindly", "much", "many", "by", "as", "use", "get",
+}
+
+# Two-word terms that are written both ways ("cut off", "cut-off", "cutoff")
+COMPOUND_TERMS = {
+  ("cut", "off"): "cutoff",
+  ("o", "level"): "olevel",
+  ("post", "utme"): "postutme",
+  ("direct", "entry"): "directentry",
+}
+
+# Applied after plurals are dropped, so "requirements" and "required" meet at "need"
+TERM_SYNONYMS = {
+  "begin": "start", "commence": "start", "open": "start",
+  "required": "need", "requirement": "need", "needed": "need",
+  "allowed": "allow", "accepted": "allow", "permitted": "allow",
+  "score": "mark", "utme": "jamb", "combination": "subject",
+}
+
+# Terms shared by most admissions questions. Every other term (course,
+# institution, number...) is an anchor: two questions only match if their
+# anchors are identical, so "cut-off for Law at UNILAG" never gets the answer
+# for Medicine, however similar the rest of the wording is
+GENERIC_TERMS = {
+  "jamb", "cutoff", "mark", "olevel", "sitting", "allow", "need", "subject", "start",
+  "registration", "register", "admission", "apply", "application", "form", "course", "study",
+  "university", "school", "institution", "date", "deadline", "close", "year", "pass", "minimum",
+  "waec", "neco", "result", "check", "list", "grade", "credit", "number", "require",
+}
+
+# "cut-off"/"cutoff" and "O'Level"/"olevel" are the same word
+_JOINERS = re.compile(r"(?<=[a-z0-9])['’\-.](?=[a-z0-9])")
+_WORDS = re.compile(r"[a-z0-9]+")
+
+
+def _singular(word: str) -> str:
+  return word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+
+
+def question_terms(text: str) -> list[str]:
+  """Normalised content words of a question, in order."""
+  words = _WORDS.findall(_JOINERS.sub("", text.lower()))
+  terms = []
+  i = 0
+  while i < len(words):
+    compound = COMPOUND_TERMS.get(tuple(words[i:i + 2]))
+    word = compound or words[i]
+    i += 2 if compound else 1
+    if word in STOPWORDS:
+      continue
+    word = TERM_SYNONYMS.get(word) or TERM_SYNONYMS.get(_singular(word)) or _singular(word)
+    terms.append(word)
+  return terms
+
+
+def _bucket(term: str, dim: int) -> tuple[int, float]:
+  digest = hashlib.blake2b(term.encode(), digest_size=8).digest()
+  value = int.from_bytes(digest, "little")
+  # Signed hashing: collisions cancel out on average instead of adding up
+  return value % dim, 1.0 if value >> 63 else -1.0
+
+
+def embed(terms: list[str], dim: int) -> dict[int, float]:
+  """Sparse, L2-normalised hashed bag of words. Computed locally; nothing leaves the process."""
+  vector: dict[int, float] = {}
+  for term in terms:
+    index, sign = _bucket(term, dim)
+    vector[index] = vector.get(index, 0.0) + sign
+  norm = math.sqrt(sum(v * v for v in vector.values()))
+  return {i: v / norm for i, v in vector.items() if v} if norm else {}
+
+
+class SemanticAnswerCache:
+  """
+  In-process cache of chatbot replies to opening questions, matched by
+  similarity rather than exact text, so the common admissions FAQs are
+  answered once per TTL instead of once per student.
+
+  Questions are embedded locally (embed()) and compared by cosine similarity;
+  a stored reply is served when the best match reaches `threshold` and both
+  questions have the same anchor terms (see GENERIC_TERMS).
+  Entries expire after `ttl` seconds; past `max_entries` the least recently
+  used entry is evicted. Scoring uses NumPy when it is installed.
+  """
+
+  def __init__(self, threshold: float, ttl: int, max_entries: int, dim: int = 1024, clock=time.monotonic):
+    self.threshold = threshold
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.dim = dim
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+    self.clear()
+
+  @property
+  def enabled(self) -> bool:
+    return self.max_entries > 0
+
+  def clear(self) -> None:
+    with self._lock:
+      # slot -> (expires_at, anchors, reply, sparse vector, terms key); order is recency of use
+      self._entries: OrderedDict[int, tuple] = OrderedDict()
+      self._slots_by_terms: dict[str, int] = {}
+      self._free = list(range(self.max_entries - 1, -1, -1))
+      self._matrix = np.zeros((self.max_entries, self.dim), dtype=np.float32) if np is not None and self.enabled else None
+
+  def _anchors(self, terms: list[str]) -> frozenset:
+    return frozenset(term for term in terms if term not in GENERIC_TERMS)
+
+  def _drop(self, slot: int) -> None:
+    del self._slots_by_terms[self._entries.pop(slot)[4]]
+    if self._matrix is not None:
+      self._matrix[slot] = 0.0
+    self._free.append(slot)
+
+  def _candidates(self, vector: dict[int, float]) -> list[tuple[float, int]]:
+    """(similarity, slot) of the entries at or above the threshold, best first."""
+    if self._matrix is not None:
+      query = np.zeros(self.dim, dtype=np.float32)
+      query[list(vector)] = list(vector.values())
+      similarities = self._matrix @ query
+      # Free slots are all-zero rows, so they never pass a positive threshold
+      slots = np.flatnonzero(similarities >= self.threshold)
+      return sorted(((float(similarities[slot]), int(slot)) for slot in slots), reverse=True)
+
+    candidates = []
+    for slot, (_, _, _, stored, _) in self._entries.items():
+      similarity = sum(weight * stored.get(index, 0.0) for index, weight in vector.items())
+      if similarity >= self.threshold:
+        candidates.append((similarity, slot))
+    return sorted(candidates, reverse=True)
+
+  def get(self, question: str) -> str | None:
+    """A stored reply to a question like this one, or None."""
+    if not self.enabled:
+      return None
+    terms = question_terms(question)
+    vector = embed(terms, self.dim)
+    anchors = self._anchors(terms)
+    now = self._clock()
+
+    with self._lock:
+      if vector:
+        for _, slot in self._candidates(vector):
+          expires_at, stored_anchors, reply, _, _ = self._entries[slot]
+          if expires_at <= now:
+            self._drop(slot)
+            self._stats["expired"] += 1
+            continue
+          if stored_anchors != anchors:
+            continue
+          self._entries.move_to_end(slot)
+          self._stats["hits"] += 1
+          metrics.cache_lookups.labels("semantic_answers", "hit").inc()
+          return reply
+
+      self._stats["misses"] += 1
+    metrics.cache_lookups.labels("semantic_answers", "miss").inc()
+    return None
+
+  def set(self, question: str, reply: str) -> None:
+    if not self.enabled:
+      return
+    terms = question_terms(question)
+    vector = embed(terms, self.dim)
+    if not vector:
+      return  # nothing but stopwords: "hi", "hello?"
+
+    key = " ".join(terms)
+    with self._lock:
+      if key in self._slots_by_terms:
+        self._drop(self._slots_by_terms[key])  # same question asked again: refresh it
+      elif not self._free:
+        self._drop(next(iter(self._entries)))  # least recently used
+        self._stats["evictions"] += 1
+      slot = self._free.pop()
+      self._entries[slot] = (self._clock() + self.ttl, self._anchors(terms), reply, vector, key)
+      self._slots_by_terms[key] = slot
+      if self._matrix is not None:
+        self._matrix[slot, list(vector)] = list(vector.values())
+
+  def stats(self) -> dict:
+    """Counters for this process; every hit is one Gemini call saved."""
+    with self._lock:
+      stats = dict(self._stats)
+      stats["entries"] = len(self._entries)
+    lookups = stats["hits"] + stats["misses"]
+    stats["lookups"] = lookups
+    stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats
+
+
+semantic_answer_cache = SemanticAnswerCache(
+  threshold=settings.AI_CHAT_SEMANTIC_CACHE_THRESHOLD,
+  ttl=settings.AI_CHAT_SEMANTIC_CACHE_TTL,
+  max_entries=settings.AI_CHAT_SEMANTIC_CACHE_SIZE,
+)
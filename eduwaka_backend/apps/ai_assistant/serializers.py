@@ -1,21 +1,40 @@
+from django.conf import settings
 from rest_framework import serializers
 
+from apps.ai_assistant.models import Conversation
+
 
 class InstitutionRequestSerializer(serializers.Serializer):
   institution_name = serializers.CharField(max_length=255)
 
-class EligibilityCheckRequestSerializer(serializers.Serializer):
+class EligibilityProfileSerializer(serializers.Serializer):
   """
-  Serializer for validating incoming data for the EligibilityCheckAPIView.
+  The student's results, shared by single and multi-target eligibility checks.
   """
-  institution_name = serializers.CharField(max_length=255, required=True)
-  desired_course = serializers.CharField(max_length=255, required=True)
   o_level_sittings = serializers.ChoiceField(choices=['1', '2'], required=True)
   o_level_sitting_1 = serializers.CharField(required=True)
   o_level_sitting_2 = serializers.CharField(required=False, allow_blank=True) # Optional for 1 sitting
   jamb_score = serializers.IntegerField(required=True, min_value=0, max_value=400)
   jamb_subjects = serializers.CharField(required=True)
 
+class EligibilityCheckRequestSerializer(EligibilityProfileSerializer):
+  """
+  Serializer for validating incoming data for the EligibilityCheckAPIView.
+  """
+  institution_name = serializers.CharField(max_length=255, required=True)
+  desired_course = serializers.CharField(max_length=255, required=True)
+
+class EligibilityTargetSerializer(serializers.Serializer):
+  institution_name = serializers.CharField(max_length=255, required=True)
+  desired_course = serializers.CharField(max_length=255, required=True)
+
+class EligibilityBatchRequestSerializer(EligibilityProfileSerializer):
+  """
+  Serializer for validating incoming data for the EligibilityBatchAPIView:
+  one student profile checked against several institution/course targets.
+  """
+  targets = EligibilityTargetSerializer(many=True, min_length=1, max_length=settings.ELIGIBILITY_BATCH_MAX_TARGETS)
+
 class ChatMessagePartSerializer(serializers.Serializer):
   """
   Serializer for the 'parts' within a chat message.
@@ -28,10 +47,50 @@ class ChatHistoryItemSerializer(serializers.Serializer):
   Serializer for each item in the chat_history list.
   """
   role = serializers.CharField(required=True) # Could be serializers.ChoiceField(['user', 'bot']) for strict roles
-  parts = ChatMessagePartSerializer(many=True, required=True)
+  parts = ChatMessagePartSerializer(many=True, required=True, min_length=1)
 
 class ChatbotRequestSerializer(serializers.Serializer):
   """
   Serializer for validating incoming data for the ChatbotAPIView.
+
+  Compact shape: {"message": "...", "conversation_id": 12}
+  Legacy shape:  {"chat_history": [..., {"role": "user", "parts": [{"text": "..."}]}]}
+  The history is loaded from the database, so of a legacy chat_history only
+  the last item is validated; validated_data["message"] is set either way.
+  """
+  message = serializers.CharField(required=False, allow_blank=False)
+  chat_history = ChatHistoryItemSerializer(many=True, required=False, min_length=1)
+  conversation_id = serializers.IntegerField(required=False, allow_null=True) # defaults to the latest active thread
+
+  def to_internal_value(self, data):
+    chat_history = data.get('chat_history') if isinstance(data, dict) else None
+    if 'message' not in data and isinstance(chat_history, list) and len(chat_history) > 1:
+      data = {**data, 'chat_history': chat_history[-1:]}
+    return super().to_internal_value(data)
+
+  def validate(self, attrs):
+    if 'message' not in attrs:
+      if 'chat_history' not in attrs:
+        raise serializers.ValidationError({"message": "This field is required."})
+      attrs['message'] = attrs['chat_history'][-1]['parts'][0]['text']
+    attrs.pop('chat_history', None)
+    return attrs
+
+
+class ConversationSerializer(serializers.ModelSerializer):
+  class Meta:
+    model = Conversation
+    fields = ['id', 'title', 'is_archived', 'created_at', 'updated_at']
+    read_only_fields = ['created_at', 'updated_at']
+
+class TopConsumersQuerySerializer(serializers.Serializer):
+  """
+  Query parameters of the admin top-consumers endpoint: the last `days` days,
+  today included, ranked by `order_by`.
   """
-  chat_history = ChatHistoryItemSerializer(many=True, required=True, min_length=1)
\ No newline at end of file
+  days = serializers.IntegerField(required=False, default=1, min_value=1, max_value=90)
+  order_by = serializers.ChoiceField(
+    choices=['requests', 'throttled', 'prompt_tokens', 'output_tokens', 'total_tokens'],
+    required=False, default='total_tokens',
+  )
+  limit = serializers.IntegerField(required=False, default=20, min_value=1, max_value=100)
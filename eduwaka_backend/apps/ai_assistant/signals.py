@@ -0,0 +1,45 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from apps.courses.models import Course
+from apps.institutions.models import Institution
+from .cache import eligibility_result_cache
+from .retrieval import catalog_index
+
+
+@receiver(pre_save, sender=Course)
+def remember_previous_course_name(sender, instance, **kwargs):
+  # A rename must also invalidate answers cached under the old name
+  if instance.pk:
+    instance._previous_name = Course.objects.filter(pk=instance.pk).values_list("name", flat=True).first()
+
+
+@receiver(post_save, sender=Course)
+@receiver(post_delete, sender=Course)
+def invalidate_eligibility_cache(sender, instance, **kwargs):
+  """Cached eligibility answers may depend on this course's requirements."""
+  eligibility_result_cache.invalidate_course(instance.name)
+
+  previous_name = getattr(instance, "_previous_name", None)
+  if previous_name and previous_name != instance.name:
+    eligibility_result_cache.invalidate_course(previous_name)
+
+
+@receiver(post_save, sender=Course)
+def reindex_course(sender, instance, **kwargs):
+  catalog_index.index_courses([instance.pk])
+
+
+@receiver(post_delete, sender=Course)
+def unindex_course(sender, instance, **kwargs):
+  catalog_index.remove("course", instance.pk)
+
+
+@receiver(post_save, sender=Institution)
+def reindex_institution(sender, instance, **kwargs):
+  catalog_index.index_institution(instance)
+
+
+@receiver(post_delete, sender=Institution)
+def unindex_institution(sender, instance, **kwargs):
+  catalog_index.remove("institution", instance.pk)
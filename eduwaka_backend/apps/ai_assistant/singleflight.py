@@ -0,0 +1,310 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from typing import Any, Awaitable, Callable
+
+from django.conf import settings
+
+try:
+  import fcntl
+except ImportError:  # Windows dev machines: thread-level coalescing only
+  fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(model_name: str, contents: Any, generation_config: dict | None = None) -> str:
+  """Stable hash of everything that determines a model response."""
+  payload = json.dumps(
+    {"model": model_name, "contents": contents, "generation_config": generation_config or {}},
+    sort_keys=True,
+    default=str,
+  )
+  return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Call:
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error: BaseException | None = None
+
+
+class _AsyncCall:
+  def __init__(self, task: asyncio.Task):
+    self.task = task
+    self.waiters = 0
+
+
+class SingleFlight:
+  """
+  Coalesces concurrent identical upstream calls.
+
+  Within a process, the first thread for a key (the leader) runs the call and
+  every other thread waits for its result. Across gunicorn workers on one host,
+  leaders serialise on a per-key file lock. A worker that finds the lock taken
+  registers as a waiter; the holder writes its result to a file next to the
+  lock, tagged with a generation number, and waiters read it only if its
+  generation is newer than the one they saw when they started waiting. The
+  last one out deletes the file, so a finished call is never served to a
+  request that arrived after it: this is not a cache. Results must be
+  JSON-serialisable to be shared across processes.
+
+  do_async() is the event-loop variant for the async views: the call runs as
+  its own task that every caller awaits, so a caller that is cancelled (client
+  disconnect) leaves it running for the rest; the last one out cancels it. The
+  file lock is polled without blocking the loop.
+  """
+
+  SWEEP_EVERY = 200         # leader calls between stale-file sweeps
+  STALE_FILE_AGE = 60 * 10  # seconds; well past any in-flight call
+  POLL_INTERVAL = 0.05
+
+  def __init__(self, lock_dir: str, wait_timeout: int):
+    self.lock_dir = lock_dir
+    self.wait_timeout = wait_timeout
+    self._calls: dict[str, _Call] = {}
+    self._lock = threading.Lock()
+    self._leader_calls = 0
+    self._async_calls = weakref.WeakKeyDictionary()  # event loop -> {key: _AsyncCall}
+
+  def do(self, key: str, fn: Callable[[], Any]) -> Any:
+    with self._lock:
+      call = self._calls.get(key)
+      is_leader = call is None
+      if is_leader:
+        call = self._calls[key] = _Call()
+
+    if not is_leader:
+      if not call.done.wait(self.wait_timeout):
+        # Leader is stuck; don't let followers hang with it
+        return fn()
+      if call.error is not None:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = self._do_across_processes(key, fn)
+      return call.result
+    except BaseException as e:
+      call.error = e
+      raise
+    finally:
+      with self._lock:
+        self._calls.pop(key, None)
+      call.done.set()
+
+  async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    calls = self._async_calls.setdefault(asyncio.get_running_loop(), {})
+    call = calls.get(key)
+    if call is None:
+      call = calls[key] = _AsyncCall(asyncio.ensure_future(self._ado_across_processes(key, fn)))
+      call.task.add_done_callback(lambda task: self._async_done(calls, key, call))
+
+    call.waiters += 1
+    try:
+      return await asyncio.shield(call.task)
+    except asyncio.CancelledError:
+      if call.waiters == 1 and not call.task.done():
+        # Nobody else wants the answer; later callers start afresh
+        if calls.get(key) is call:
+          del calls[key]
+        call.task.cancel()
+      raise
+    finally:
+      call.waiters -= 1
+
+  def _async_done(self, calls: dict, key: str, call: _AsyncCall) -> None:
+    if calls.get(key) is call:
+      del calls[key]
+    if not call.task.cancelled():
+      call.task.exception()  # mark retrieved in case nobody was waiting
+
+  #  Cross-process layer
+
+  def _paths(self, key: str) -> tuple[str, str, str]:
+    base = os.path.join(self.lock_dir, key)
+    return f"{base}.lock", f"{base}.result", f"{base}.waiting"
+
+  def _open_lock(self, lock_path: str):
+    try:
+      os.makedirs(self.lock_dir, exist_ok=True)
+      return open(lock_path, "a")
+    except OSError as e:
+      logger.warning(f"Single-flight lock unavailable, calling directly: {e}")
+      return None
+
+  def _try_lock(self, lock_file) -> bool:
+    try:
+      fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      return True
+    except BlockingIOError:
+      return False
+
+  def _acquire(self, lock_file) -> bool:
+    deadline = time.monotonic() + self.wait_timeout
+    while not self._try_lock(lock_file):
+      if time.monotonic() >= deadline:
+        return False
+      time.sleep(self.POLL_INTERVAL)
+    return True
+
+  async def _aacquire(self, lock_file) -> bool:
+    deadline = time.monotonic() + self.wait_timeout
+    while not self._try_lock(lock_file):
+      if time.monotonic() >= deadline:
+        return False
+      await asyncio.sleep(self.POLL_INTERVAL)
+    return True
+
+  def _generation(self, result_path: str) -> int:
+    try:
+      with open(result_path, "r", encoding="utf-8") as f:
+        return json.load(f)["generation"]
+    except (OSError, ValueError, KeyError, TypeError):
+      return 0
+
+  def _start_waiting(self, waiting_path: str, result_path: str):
+    """
+    Join the waiters for the call in flight (a shared lock on the .waiting
+    file). Returns the file and the generation of the result already there,
+    which the call in flight will beat; (None, None) if we can't register.
+    """
+    try:
+      waiting_file = open(waiting_path, "a")
+      fcntl.flock(waiting_file, fcntl.LOCK_SH)
+      os.utime(waiting_path)  # keep the sweep away from live waiters
+    except OSError as e:
+      logger.warning(f"Single-flight could not wait for {os.path.basename(waiting_path)}: {e}")
+      return None, None
+    return waiting_file, self._generation(result_path)
+
+  def _stop_waiting(self, waiting_file, waiting_path: str, result_path: str) -> None:
+    """Leave the waiters; whoever finds none left deletes the result."""
+    try:
+      if waiting_file is None:
+        waiting_file = open(waiting_path, "a")
+      else:
+        fcntl.flock(waiting_file, fcntl.LOCK_UN)
+      try:
+        fcntl.flock(waiting_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        return  # still waited on
+      try:
+        os.remove(result_path)
+      except FileNotFoundError:
+        pass
+    except OSError as e:
+      logger.warning(f"Single-flight could not clear {os.path.basename(result_path)}: {e}")
+    finally:
+      if waiting_file is not None:
+        waiting_file.close()
+
+  def _read_result(self, result_path: str, seen: int | None) -> tuple[bool, Any]:
+    """The result of a call that finished while we waited (generation past `seen`)."""
+    if seen is None:
+      return False, None
+    try:
+      with open(result_path, "r", encoding="utf-8") as f:
+        shared = json.load(f)
+    except (OSError, ValueError):
+      return False, None
+    if shared.get("generation", 0) <= seen:
+      return False, None
+    return True, shared.get("result")
+
+  def _write_result(self, result_path: str, result: Any) -> None:
+    tmp_path = f"{result_path}.{os.getpid()}.tmp"
+    try:
+      with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"generation": self._generation(result_path) + 1, "result": result}, f)
+      os.replace(tmp_path, result_path)
+    except (OSError, TypeError, ValueError) as e:
+      logger.warning(f"Single-flight could not share result for {os.path.basename(result_path)}: {e}")
+
+  async def _ado_across_processes(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    if fcntl is None:
+      return await fn()
+
+    lock_path, result_path, waiting_path = self._paths(key)
+    lock_file = self._open_lock(lock_path)
+    if lock_file is None:
+      return await fn()
+
+    waiting_file, seen = None, None
+    try:
+      if not self._try_lock(lock_file):
+        waiting_file, seen = self._start_waiting(waiting_path, result_path)
+        if not await self._aacquire(lock_file):
+          return await fn()
+      try:
+        os.utime(lock_path)
+        found, result = self._read_result(result_path, seen)
+        if found:
+          return result
+        result = await fn()
+        self._write_result(result_path, result)
+        return result
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+      self._stop_waiting(waiting_file, waiting_path, result_path)
+      lock_file.close()
+      self._maybe_sweep()
+
+  def _do_across_processes(self, key: str, fn: Callable[[], Any]) -> Any:
+    if fcntl is None:
+      return fn()
+
+    lock_path, result_path, waiting_path = self._paths(key)
+    lock_file = self._open_lock(lock_path)
+    if lock_file is None:
+      return fn()
+
+    waiting_file, seen = None, None
+    try:
+      if not self._try_lock(lock_file):
+        # Another worker is making this call; wait for it and take its result
+        waiting_file, seen = self._start_waiting(waiting_path, result_path)
+        if not self._acquire(lock_file):
+          return fn()
+      try:
+        os.utime(lock_path)  # keep the sweep away from live locks
+        # The call we waited on may have finished meanwhile
+        found, result = self._read_result(result_path, seen)
+        if found:
+          return result
+        result = fn()
+        self._write_result(result_path, result)
+        return result
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    finally:
+      self._stop_waiting(waiting_file, waiting_path, result_path)
+      lock_file.close()
+      self._maybe_sweep()
+
+  def _maybe_sweep(self) -> None:
+    with self._lock:
+      self._leader_calls += 1
+      if self._leader_calls % self.SWEEP_EVERY:
+        return
+
+    cutoff = time.time() - self.STALE_FILE_AGE
+    try:
+      for entry in os.scandir(self.lock_dir):
+        if entry.stat().st_mtime < cutoff:
+          os.remove(entry.path)
+    except OSError:
+      pass
+
+
+llm_singleflight = SingleFlight(
+  lock_dir=settings.AI_SINGLEFLIGHT_LOCK_DIR,
+  wait_timeout=settings.AI_SINGLEFLIGHT_WAIT_TIMEOUT,
+)
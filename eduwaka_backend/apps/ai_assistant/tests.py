@@ -1,3 +1,1806 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from importlib import import_module
+from statistics import median
+from unittest import addModuleCleanup, mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, resolve, reverse
+from django.utils import timezone
+from prometheus_client.parser import text_string_to_metric_families
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from apps.courses.models import Course
+from apps.institutions.models import Institution
+
+from .models import CachedEligibilityResult, CachedInstitutionOverview, ChatHistory, Conversation, ConversationSummary, DailyUsage, EligibilityCheck, RateLimitBucket
+from .cache import InstitutionOverviewCache, institution_overview_cache, normalize_institution_name
+from .history import HistoryCompactor, HistoryWindow
+from .llm import LLMResponse, StubClient, StubLLMError, estimate_tokens, get_llm_client
+from .resilience import CircuitBreaker, CircuitOpenError, LLMTimeoutError, LLMUnavailableError, ResilientClient
+from .intents import IntentRouter
+from .limiter import ConcurrencyLimiter, HostSlots, LLMOverloadedError
+from .management.commands.bench_olevel_parser import Command as BenchOLevelParser, legacy_parse_sitting
+from .olevel import SubjectResolver, normalise_jamb_subject, normalise_subject, parse_many, parse_sitting
+from .ratelimit import CacheBucketStore, DatabaseBucketStore, RateLimiter, _stores, ai_rate_limiter, take_token
+from .retrieval import CatalogIndex, CatalogRetriever, catalog_index
+from .semantic_cache import SemanticAnswerCache, semantic_answer_cache
+from .serializers import ChatbotRequestSerializer
+from .singleflight import SingleFlight
+from .usage import usage_rollup
+from . import eligibility, metrics, urls as ai_urls, views
+from .async_views import AsyncChatbotStreamView, AsyncChatbotView, AsyncEligibilityBatchView, AsyncEligibilityCheckView, AsyncInstitutionOverviewView
+from .views import ChatbotAPIView, EligibilityCheckAPIView, history_compactor
+
+User = get_user_model()
+
+
+def setUpModule():
+  # Rate limit buckets in the database roll back with each test, whatever
+  # AI_RATE_LIMIT_STORES says; in the local-memory cache they would drain the
+  # shared client IP's bucket for later tests
+  stores = mock.patch.object(ai_rate_limiter, "stores", [DatabaseBucketStore()])
+  stores.start()
+  addModuleCleanup(stores.stop)
+
+
+def use_stub_llm(test, **options) -> StubClient:
+  """
+  Put a fresh StubClient behind views.llm for one test, whatever AI_LLM_BACKEND
+  says, so no test depends on the environment or reaches Gemini.
+  """
+  backend = StubClient(**options)
+  patch = mock.patch.object(views.llm, "backend", backend)
+  patch.start()
+  test.addCleanup(patch.stop)
+  # Injected failures must not leave the shared circuit open for the next test
+  test.addCleanup(views.llm.breaker.reset)
+  isolate_usage(test)
+  return backend
+
+
+def isolate_usage(test) -> None:
+  """
+  Count usage in a fresh rollup for one test. Counts left pending would
+  otherwise be flushed in a later test, for users that no longer exist.
+  """
+  pending = mock.patch.object(usage_rollup, "_pending", {})
+  pending.start()
+  test.addCleanup(pending.stop)
+
+
+def later(seconds: float):
+  """Move the caches' clock `seconds` ahead."""
+  return mock.patch("apps.ai_assistant.cache.timezone.now", return_value=timezone.now() + timedelta(seconds=seconds))
+
+
+class InstitutionOverviewCacheTests(TestCase):
+  """Overviews are read through an in-process LRU in front of the CachedInstitutionOverview table."""
+
+  OVERVIEW = {"name": "University of Lagos", "type": "Federal University"}
+
+  def setUp(self):
+    self.cache = InstitutionOverviewCache(ttl=60, negative_ttl=10, lru_size=8, stale_ttl=30)
+
+  def test_hits_come_from_the_lru_then_the_database(self):
+    self.assertIsNone(self.cache.get("UNILAG"))
+    self.cache.set("University of Lagos", self.OVERVIEW)
+    self.assertEqual(self.cache.get("unilag"), self.OVERVIEW)  # same normalised key
+
+    self.cache.clear()  # as in a freshly started worker
+    with self.assertNumQueries(1):
+      self.assertEqual(self.cache.get("The University of Lagos"), self.OVERVIEW)
+    with self.assertNumQueries(0):
+      self.assertEqual(self.cache.get("university of lagos"), self.OVERVIEW)
+
+    stats = self.cache.stats()
+    self.assertEqual((stats["hits"], stats["misses"], stats["lookups"], stats["hit_rate"]), (3, 1, 4, 0.75))
+
+  def test_entries_expire_after_the_ttl(self):
+    self.cache.set("UNILAG", self.OVERVIEW)
+    with later(59):
+      self.assertEqual(self.cache.get("UNILAG"), self.OVERVIEW)
+    with later(61):
+      self.assertIsNone(self.cache.get("UNILAG"))
+      self.cache.clear()
+      self.assertIsNone(self.cache.get("UNILAG"))  # the row has expired too
+
+  def test_unknown_names_are_cached_for_the_shorter_negative_ttl(self):
+    self.cache.set("UNILAG", self.OVERVIEW)
+    self.cache.set_negative("Hogwarts", {"error": "Not a Nigerian institution."})
+    self.assertEqual(self.cache.get("hogwarts"), {"error": "Not a Nigerian institution."})
+    self.assertEqual(self.cache.stats()["negative_hits"], 1)
+
+    with later(11):
+      self.assertIsNone(self.cache.get("Hogwarts"))
+      self.assertEqual(self.cache.get("UNILAG"), self.OVERVIEW)
+
+  def test_prune_keeps_expired_overviews_for_the_stale_window(self):
+    self.cache.set("UNILAG", self.OVERVIEW)
+    self.cache.set_negative("Hogwarts", {"error": "Not a Nigerian institution."})
+    with later(61):
+      self.assertEqual(self.cache.prune(), 1)  # only the negative row
+      self.assertEqual(self.cache.get_stale("UNILAG"), self.OVERVIEW)
+    with later(91):
+      self.assertIsNone(self.cache.get_stale("UNILAG"))
+      self.assertEqual(self.cache.prune(), 1)
+    self.assertFalse(CachedInstitutionOverview.objects.exists())
+
+
+class InstitutionOverviewViewTests(TestCase):
+
+  def setUp(self):
+    use_stub_llm(self, responses=[{"match": 'named "Hogwarts', "text": '{"error": "Hogwarts is not a Nigerian institution."}'}])
+    self.addCleanup(institution_overview_cache.clear)
+    self.client = APIClient()
+
+  def _overview(self, name):
+    return self.client.post(reverse("institution-overview"), {"institution_name": name}, format="json")
+
+  def test_second_request_is_served_from_the_cache(self):
+    first = self._overview("University of Lagos")
+    self.assertEqual((first.status_code, first.data["name"]), (200, "University of Lagos"))
+    self.assertTrue(CachedInstitutionOverview.objects.filter(key="university of lagos", is_negative=False).exists())
+
+    hits = institution_overview_cache.stats()["hits"]
+    with mock.patch.object(views.llm, "generate") as generate:
+      second = self._overview("unilag")
+    generate.assert_not_called()
+    self.assertEqual(second.data, first.data)
+    self.assertEqual(institution_overview_cache.stats()["hits"], hits + 1)
+
+  def test_unknown_institution_is_answered_from_the_negative_cache(self):
+    first = self._overview("Hogwarts")
+    self.assertEqual((first.status_code, first.data["detail"]), (404, "Hogwarts is not a Nigerian institution."))
+    self.assertTrue(CachedInstitutionOverview.objects.get(key="hogwarts").is_negative)
+
+    with mock.patch.object(views.llm, "generate") as generate:
+      second = self._overview("hogwarts")
+    generate.assert_not_called()
+    self.assertEqual((second.status_code, second.data), (404, first.data))
+
+  def test_cache_stats_are_admin_only(self):
+    url = reverse("institution-overview-cache-stats")
+    self.assertIn(self.client.get(url).status_code, (401, 403))
+    self.client.force_authenticate(User.objects.create_user(username="staff", email="staff@example.com", password="x", is_staff=True))
+    response = self.client.get(url)
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(set(response.data), {"hits", "negative_hits", "misses", "lookups", "hit_rate"})
+
+
+class SingleFlightTests(TestCase):
+  """Concurrent identical calls share one upstream call; finished calls are not reused."""
+
+  def setUp(self):
+    lock_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(lock_dir.cleanup)
+    self.lock_dir = lock_dir.name
+    self.calls = 0
+
+  def _flight(self):
+    return SingleFlight(lock_dir=self.lock_dir, wait_timeout=5)
+
+  def _slow_call(self, seconds=0.2):
+    def call():
+      self.calls += 1
+      time.sleep(seconds)
+      return {"calls": self.calls}
+    return call
+
+  def _run_together(self, flights, key="k"):
+    results = []
+    threads = [threading.Thread(target=lambda f=f: results.append(f.do(key, self._slow_call()))) for f in flights]
+    for thread in threads:
+      thread.start()
+      time.sleep(0.01)
+    for thread in threads:
+      thread.join()
+    return results
+
+  def test_concurrent_calls_in_a_process_share_one_upstream_call(self):
+    flight = self._flight()
+    self.assertEqual(self._run_together([flight] * 8), [{"calls": 1}] * 8)
+    self.assertEqual(self.calls, 1)
+
+  def test_workers_waiting_on_the_lock_share_the_result(self):
+    # Separate instances each open the lock file, like separate gunicorn workers
+    self.assertEqual(self._run_together([self._flight() for _ in range(4)]), [{"calls": 1}] * 4)
+    self.assertEqual(self.calls, 1)
+    self.assertFalse([name for name in os.listdir(self.lock_dir) if name.endswith(".result")])
+
+  def test_finished_calls_are_not_served_again(self):
+    first, second = self._flight(), self._flight()
+    self.assertEqual(first.do("k", self._slow_call(0)), {"calls": 1})
+    self.assertEqual(second.do("k", self._slow_call(0)), {"calls": 2})
+    self.assertEqual(first.do("k", self._slow_call(0)), {"calls": 3})
+
+  def test_followers_get_the_leaders_error(self):
+    flight = self._flight()
+    errors = []
+
+    def failing():
+      self.calls += 1
+      time.sleep(0.1)
+      raise ValueError("upstream broke")
+
+    def run():
+      try:
+        flight.do("k", failing)
+      except ValueError as e:
+        errors.append(str(e))
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual((self.calls, errors), (1, ["upstream broke"] * 3))
+
+  def test_async_callers_share_one_call(self):
+    flight = self._flight()
+
+    async def call():
+      self.calls += 1
+      await asyncio.sleep(0.05)
+      return "answer"
+
+    async def run():
+      return await asyncio.gather(*(flight.do_async("k", call) for _ in range(5)))
+
+    self.assertEqual(asyncio.run(run()), ["answer"] * 5)
+    self.assertEqual(self.calls, 1)
+
+  def test_cancelled_async_leader_does_not_cancel_its_followers(self):
+    flight = self._flight()
+
+    async def call():
+      self.calls += 1
+      await asyncio.sleep(0.1)
+      return "answer"
+
+    async def run():
+      leader = asyncio.ensure_future(flight.do_async("k", call))
+      await asyncio.sleep(0.01)
+      follower = asyncio.ensure_future(flight.do_async("k", call))
+      await asyncio.sleep(0.01)
+      leader.cancel()  # the first student disconnects
+      with self.assertRaises(asyncio.CancelledError):
+        await leader
+      return await follower
+
+    self.assertEqual(asyncio.run(run()), "answer")
+    self.assertEqual(self.calls, 1)
+
+  def test_last_async_caller_to_leave_cancels_the_call(self):
+    flight = self._flight()
+    cancelled = []
+
+    async def call():
+      try:
+        await asyncio.sleep(5)
+      except asyncio.CancelledError:
+        cancelled.append(True)
+        raise
+
+    async def run():
+      caller = asyncio.ensure_future(flight.do_async("k", call))
+      await asyncio.sleep(0.01)
+      caller.cancel()
+      with self.assertRaises(asyncio.CancelledError):
+        await caller
+      await asyncio.sleep(0.01)
+      return await flight.do_async("k", lambda: asyncio.sleep(0, result="fresh"))
+
+    self.assertEqual(asyncio.run(run()), "fresh")
+    self.assertEqual(cancelled, [True])
+
+
+def sse_events(body: bytes) -> list[tuple[str, dict]]:
+  """(event, data) pairs of a Server-Sent Events body."""
+  events = []
+  for block in body.decode().strip().split("\n\n"):
+    lines = dict(line.split(": ", 1) for line in block.splitlines())
+    events.append((lines["event"], json.loads(lines["data"])))
+  return events
+
+
+@mock.patch.object(history_compactor, "schedule")
+class ChatbotStreamTests(TestCase):
+  """The SSE chatbot stores a turn only once its stream has finished cleanly."""
+
+  QUESTION = "Tell me about studying nursing"
+
+  def setUp(self):
+    self.backend = use_stub_llm(self, stream_chunk_words=2)
+    semantic_answer_cache.clear()
+    self.user = User.objects.create_user(username="streamer", email="streamer@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def _stream(self):
+    return self.client.post(reverse("chatbot-stream"), {"message": self.QUESTION}, format="json")
+
+  def test_completed_stream_is_stored(self, schedule):
+    response = self._stream()
+    self.assertEqual(response["Content-Type"], "text/event-stream")
+    events = sse_events(b"".join(response.streaming_content))
+
+    chunks = [data["text"] for event, data in events if event == "chunk"]
+    self.assertGreater(len(chunks), 1)
+    self.assertEqual("".join(chunks), StubClient.DEFAULT_CHAT_REPLY)
+    event, data = events[-1]
+    self.assertEqual(event, "done")
+    stored = list(ChatHistory.objects.filter(conversation_id=data["conversation_id"]).values_list("role", "message"))
+    self.assertEqual(stored, [("user", self.QUESTION), ("model", StubClient.DEFAULT_CHAT_REPLY)])
+    schedule.assert_called_once_with(data["conversation_id"])
+
+  def test_blocked_stream_rolls_the_turn_back(self, schedule):
+    self.backend.finish_reasons = {"SAFETY": 1.0}
+    with mock.patch.object(ChatbotAPIView, "WRITE_BEHIND", False):
+      events = sse_events(b"".join(self._stream().streaming_content))
+    self.assertEqual(events[-1][0], "error")
+    self.assertIn("unable to respond", events[-1][1]["detail"])
+    self.assertFalse(ChatHistory.objects.exists())
+
+  def test_client_disconnect_rolls_the_turn_back(self, schedule):
+    with mock.patch.object(ChatbotAPIView, "WRITE_BEHIND", False):
+      response = self._stream()
+      self.assertEqual(ChatHistory.objects.get().message, self.QUESTION)  # saved before streaming
+      next(iter(response.streaming_content))
+      response.close()  # what the server does when the client goes away
+    self.assertFalse(ChatHistory.objects.exists())
+    schedule.assert_not_called()
+
+
+def use_async_views(test) -> None:
+  """Route the AI endpoints to async_views for one test, as AI_ASYNC_VIEWS=True does at startup."""
+  def reload_urls():
+    importlib.reload(ai_urls)
+    importlib.reload(import_module(settings.ROOT_URLCONF))
+    clear_url_caches()
+
+  with override_settings(AI_ASYNC_VIEWS=True):
+    reload_urls()
+  test.addCleanup(reload_urls)
+
+
+@mock.patch.object(history_compactor, "schedule")
+class AsyncViewTests(TestCase):
+  """Smoke tests of the Gemini-backed endpoints as served with AI_ASYNC_VIEWS=True."""
+
+  QUESTION = "Tell me about studying nursing"
+
+  def setUp(self):
+    self.backend = use_stub_llm(self, stream_chunk_words=2)
+    use_async_views(self)
+    semantic_answer_cache.clear()
+    self.addCleanup(institution_overview_cache.clear)
+    self.user = User.objects.create_user(username="asyncer", email="asyncer@example.com", password="x")
+    self.auth = {"Authorization": f"Bearer {AccessToken.for_user(self.user)}"}
+
+  def _post(self, name, payload):
+    return self.async_client.post(reverse(name), payload, content_type="application/json", headers=self.auth)
+
+  def test_setting_routes_to_the_async_views(self, schedule):
+    for name, view in [
+      ("institution-overview", AsyncInstitutionOverviewView),
+      ("eligibility-check", AsyncEligibilityCheckView),
+      ("eligibility-check-batch", AsyncEligibilityBatchView),
+      ("chatbot", AsyncChatbotView),
+      ("chatbot-stream", AsyncChatbotStreamView),
+    ]:
+      self.assertIs(resolve(reverse(name)).func.view_class, view)
+
+  async def test_overview_is_generated_once_then_cached(self, schedule):
+    with mock.patch.object(self.backend, "agenerate", wraps=self.backend.agenerate) as agenerate:
+      first = await self._post("institution-overview", {"institution_name": "University of Ibadan"})
+      second = await self._post("institution-overview", {"institution_name": "university  of ibadan"})
+    self.assertEqual((first.status_code, first.json()["name"]), (200, "University of Ibadan"))
+    self.assertEqual(second.json(), first.json())
+    agenerate.assert_called_once()
+
+  async def test_eligibility_fast_path(self, schedule):
+    response = await self._post("eligibility-check", {
+      "institution_name": "University of Lagos",
+      "desired_course": "Law",
+      "o_level_sittings": "1",
+      "o_level_sitting_1": "English C4, Maths F9",
+      "jamb_score": 150,
+      "jamb_subjects": "English, Literature, Government, Economics",
+    })
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response.json()["eligibility_status"], "fixable")
+
+  async def test_chatbot_turn_is_stored(self, schedule):
+    response = await self._post("chatbot", {"message": self.QUESTION})
+    body = response.json()
+    self.assertEqual((response.status_code, body["bot_reply"]), (200, StubClient.DEFAULT_CHAT_REPLY))
+    stored = [row async for row in ChatHistory.objects.filter(conversation_id=body["conversation_id"]).values_list("role", "message")]
+    self.assertEqual(stored, [("user", self.QUESTION), ("model", StubClient.DEFAULT_CHAT_REPLY)])
+
+  async def test_stream_is_sent_chunk_by_chunk_then_stored(self, schedule):
+    response = await self._post("chatbot-stream", {"message": self.QUESTION})
+    self.assertTrue(response.is_async)  # nothing for Django to buffer under ASGI
+    events = sse_events(b"".join([part async for part in response.streaming_content]))
+
+    chunks = [data["text"] for event, data in events if event == "chunk"]
+    self.assertGreater(len(chunks), 1)
+    self.assertEqual("".join(chunks), StubClient.DEFAULT_CHAT_REPLY)
+    event, data = events[-1]
+    self.assertEqual(event, "done")
+    self.assertEqual(await ChatHistory.objects.filter(conversation_id=data["conversation_id"]).acount(), 2)
+
+  async def test_failed_stream_rolls_the_turn_back(self, schedule):
+    self.backend.fail_first = 10
+    self.backend.failure_message = "400 invalid request"  # not retried
+    with mock.patch.object(AsyncChatbotView, "WRITE_BEHIND", False):
+      response = await self._post("chatbot-stream", {"message": self.QUESTION})
+      events = sse_events(b"".join([part async for part in response.streaming_content]))
+    self.assertEqual(events, [("error", {"detail": "Sorry, I can't process that request. Could you rephrase your question?"})])
+    self.assertFalse(await ChatHistory.objects.aexists())
+
+
+class StubClientTests(TestCase):
+  """The offline stand-in for Gemini behaves as configured, and settings select it."""
+
+  CONTENTS = [{"role": "user", "parts": [{"text": "What is the cut-off for Law at UNILAG?"}]}]
+
+  def test_templated_responses_and_schema_shaped_json(self):
+    stub = StubClient(responses=[{"match": r"cut-off for (?P<course>\w+)", "text": "$course: 250 ($last_message)"}])
+    self.assertEqual(stub.generate(self.CONTENTS).text, "Law: 250 (What is the cut-off for Law at UNILAG?)")
+
+    schema = {"response_schema": {"type": "OBJECT", "properties": {"ok": {"type": "BOOLEAN"}, "items": {"type": "ARRAY", "items": {}}}}}
+    self.assertEqual(json.loads(StubClient().generate([{"parts": [{"text": "?"}]}], schema).text), {"ok": True, "items": ["stub"]})
+
+  def test_fail_first_then_recover(self):
+    stub = StubClient(fail_first=2, failure_message="503 down")
+    for _ in range(2):
+      with self.assertRaisesMessage(StubLLMError, "503 down"):
+        stub.generate(self.CONTENTS)
+    self.assertEqual(stub.generate(self.CONTENTS).text, StubClient.DEFAULT_CHAT_REPLY)
+    with self.assertRaises(StubLLMError):
+      StubClient(failure_rate=1.0).generate(self.CONTENTS)
+
+  def test_blocked_finish_reason_has_no_text(self):
+    response = StubClient(finish_reasons={"SAFETY": 1.0}).generate(self.CONTENTS)
+    self.assertEqual((response.finish_reason, response.text), ("SAFETY", ""))
+
+  def test_seeded_latency_is_reproducible(self):
+    latency = {"distribution": "lognormal", "median_ms": 900, "sigma": 0.6}
+    first, second = StubClient(latency=latency, seed=7), StubClient(latency=latency, seed=7)
+    self.assertEqual([first._sample_latency() for _ in range(5)], [second._sample_latency() for _ in range(5)])
+    self.assertEqual(StubClient(latency={"distribution": "fixed", "ms": 250})._sample_latency(), 0.25)
+
+  def test_streams_end_with_the_finish_reason(self):
+    stub = StubClient(stream_chunk_words=3)
+
+    async def collect():
+      return [chunk async for chunk in stub.astream(self.CONTENTS)]
+
+    for chunks in (list(stub.stream(self.CONTENTS)), asyncio.run(collect())):
+      self.assertGreater(len(chunks), 1)
+      self.assertEqual("".join(c.text for c in chunks), StubClient.DEFAULT_CHAT_REPLY)
+      self.assertEqual([c.finish_reason for c in chunks], [None] * (len(chunks) - 1) + ["STOP"])
+      self.assertEqual(chunks[-1].output_tokens, estimate_tokens(StubClient.DEFAULT_CHAT_REPLY))
+
+  @override_settings(AI_LLM_BACKEND="apps.ai_assistant.llm.StubClient", AI_LLM_OPTIONS={"model_name": "stub-test"})
+  def test_settings_select_the_backend(self):
+    client = get_llm_client()
+    self.assertIsInstance(client.backend, StubClient)
+    self.assertEqual(client.model_name, "stub-test")
+    self.assertEqual(client.generate(self.CONTENTS, priority="background").text, StubClient.DEFAULT_CHAT_REPLY)
+
+
+def isolate_singleflight(test) -> None:
+  """Keep single-flight lock files away from other test runs on this host."""
+  lock_dir = tempfile.TemporaryDirectory()
+  test.addCleanup(lock_dir.cleanup)
+  isolated = mock.patch.object(views.llm_singleflight, "lock_dir", lock_dir.name)
+  isolated.start()
+  test.addCleanup(isolated.stop)
+
+
+@mock.patch.object(EligibilityCheckAPIView, "DEADLINE", 0)
+class EligibilityResultCacheTests(TestCase):
+  """Identical submissions, however they are written, reuse the final result until the course changes."""
+
+  PROFILE = {
+    "institution_name": "University of Lagos",
+    "desired_course": "Medicine and Surgery",
+    "o_level_sittings": "1",
+    "o_level_sitting_1": "Eng: A1, Maths: B2, Physics: C4, Chemistry: B3, Biology: C5",
+    "jamb_score": 290,
+    "jamb_subjects": "English, Physics, Chemistry, Biology",
+  }
+  REFORMATTED = {
+    **PROFILE,
+    "institution_name": "UNILAG",
+    "desired_course": " medicine  and SURGERY. ",
+    "o_level_sitting_1": "English Language - A1; mathematics - B2, PHY - C4, chem - B3, bio - C5",
+    "jamb_subjects": "biology,chemistry, Physics ,english",
+  }
+
+  def setUp(self):
+    use_stub_llm(self)
+    isolate_singleflight(self)
+    self.user = User.objects.create_user(username="cached", email="cached@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+    unilag = Institution.objects.create(name="University of Lagos", abbreviation="UNILAG", state="Lagos", website="unilag.edu.ng")
+    self.course = Course.objects.create(institution=unilag, name="Medicine and Surgery", duration_years=6, jamb_requirements="English, Physics, Chemistry, Biology")
+
+  def _check(self, profile):
+    return self.client.post(reverse("eligibility-check"), profile, format="json")
+
+  def test_key_ignores_formatting_but_not_results(self):
+    key = eligibility.prepare(self.PROFILE)["cache_key"]
+    self.assertEqual(eligibility.prepare(self.REFORMATTED)["cache_key"], key)
+    self.assertNotEqual(eligibility.prepare({**self.PROFILE, "jamb_score": 291})["cache_key"], key)
+    self.assertNotEqual(eligibility.prepare({**self.PROFILE, "o_level_sitting_1": self.PROFILE["o_level_sitting_1"].replace("C5", "C6")})["cache_key"], key)
+
+  def test_reformatted_resubmission_is_served_from_the_cache(self):
+    with mock.patch.object(views.llm, "generate", wraps=views.llm.generate) as generate:
+      first = self._check(self.PROFILE)
+      second = self._check(self.REFORMATTED)
+    self.assertEqual((first.status_code, second.status_code), (200, 200))
+    self.assertEqual(second.data, first.data)
+    generate.assert_called_once()
+
+  def test_course_changes_and_renames_invalidate_cached_results(self):
+    self._check(self.PROFILE)
+    self.assertEqual(CachedEligibilityResult.objects.get().course_key, "medicine and surgery")
+
+    self.course.jamb_requirements = "English, Physics, Chemistry, Biology or Agric"
+    self.course.save()
+    self.assertFalse(CachedEligibilityResult.objects.exists())
+
+    self._check(self.PROFILE)
+    self.course.name = "Medicine"
+    self.course.save()
+    self.assertFalse(CachedEligibilityResult.objects.exists())
+
+
+class EligibilityFastPathTests(TestCase):
+  """Students who fail the baseline get the full rules-built answer without a Gemini call."""
+
+  PROFILE = EligibilityResultCacheTests.PROFILE
+
+  def setUp(self):
+    use_stub_llm(self)
+    isolate_singleflight(self)
+    self.user = User.objects.create_user(username="fast", email="fast@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+    unilag = Institution.objects.create(name="University of Lagos", abbreviation="UNILAG", state="Lagos", website="unilag.edu.ng")
+    Course.objects.create(institution=unilag, name="Medicine and Surgery", duration_years=6, jamb_requirements="English, Physics, Chemistry, Biology")
+
+  def _check(self, **changes):
+    with mock.patch.object(views.llm, "generate", wraps=views.llm.generate) as generate:
+      response = self.client.post(reverse("eligibility-check"), {**self.PROFILE, **changes}, format="json")
+    self.assertEqual(response.status_code, 200)
+    return response.data, generate.call_count
+
+  def test_missing_credits_are_answered_by_the_rules(self):
+    result, llm_calls = self._check(
+      o_level_sitting_1="English C4, Physics C5, Chemistry D7, Biology C6",
+      jamb_subjects="English, Physics, Chemistry, Government",
+    )
+    self.assertEqual(llm_calls, 0)
+    self.assertEqual((result["eligibility_status"], result["is_eligible"], result["suggested_courses"]), ("fixable", False, []))
+    self.assertIn("Credit grade in: Mathematics", result["missing_requirements"])
+    self.assertTrue(any(action.startswith("Retake WAEC/NECO") for action in result["recommended_actions"]))
+    self.assertEqual(result["jamb_subject_issues"], ["Medicine and Surgery requires Biology in UTME, which is not among your JAMB subjects."])
+    self.assertIs(result["jamb_subject_match"], False)
+
+  def test_low_jamb_score_is_answered_by_the_rules(self):
+    result, llm_calls = self._check(jamb_score=170)
+    self.assertEqual(llm_calls, 0)
+    self.assertEqual(result["eligibility_status"], "fixable")
+    self.assertEqual(result["missing_requirements"], ["JAMB score of at least 180 (you scored 170)"])
+    self.assertEqual(result["jamb_subject_issues"], [])
+
+  @mock.patch.object(EligibilityCheckAPIView, "DEADLINE", 0)
+  def test_qualified_students_still_get_gemini(self):
+    result, llm_calls = self._check()
+    self.assertEqual(llm_calls, 1)
+    self.assertIs(result["is_eligible"], True)  # the stub's answer
+
+
+class OLevelParserTests(TestCase):
+  """Subject names resolve through aliases, abbreviations and misspellings; results match the old parser."""
+
+  def test_aliases_and_abbreviations(self):
+    for raw, subject in [
+      ("Eng", "english"),
+      ("Eng. Lang.", "english"),
+      ("Further Maths", "further mathematics"),
+      ("Lit in Eng", "literature in english"),
+      ("Agric Sci", "agricultural science"),
+      ("C.R.K", "christian religious knowledge"),
+      ("crk", "christian religious knowledge"),
+      ("Geog", "geography"),
+    ]:
+      self.assertEqual(normalise_subject(raw), subject, raw)
+    self.assertEqual(normalise_jamb_subject("Use of English"), "english")
+
+  def test_misspellings_are_matched_but_unknown_names_pass_through(self):
+    for raw, subject in [("Chemestry", "chemistry"), ("Biolgy", "biology"), ("Mathematicss", "mathematics")]:
+      self.assertEqual(normalise_subject(raw), subject, raw)
+    self.assertEqual(normalise_subject("Tourism"), "tourism")
+    self.assertEqual(normalise_subject("Xyz"), "xyz")  # too short to be a misspelling
+
+  def test_resolver_is_memoised(self):
+    resolver = SubjectResolver({"maths": "mathematics"}, {"mathematics"})
+    for _ in range(3):
+      self.assertEqual(resolver.resolve("Mathematic"), "mathematics")
+    self.assertEqual(resolver.resolve.cache_info().hits, 2)
+
+  def test_results_match_the_legacy_parser(self):
+    sittings = BenchOLevelParser()._generate(2000, seed=1)
+    for sitting in sittings:
+      # The old parser only knew exact aliases; resolving its keys must give the new result
+      legacy = {normalise_subject(subject): grade for subject, grade in legacy_parse_sitting(sitting).items()}
+      self.assertEqual(parse_sitting(sitting), legacy, sitting)
+
+  def test_parse_many_matches_parse_sitting_with_independent_results(self):
+    sittings = ["English: A1, Maths: B2", "Physics C4 | Chem - B3", "English: A1, Maths: B2"]
+    parsed = parse_many(sittings)
+    self.assertEqual(parsed, [parse_sitting(s) for s in sittings])
+    parsed[0]["english"] = "F9"
+    self.assertEqual(parsed[2]["english"], "A1")
+
+
+class ChatHistoryWindowBenchmark(TestCase):
+  """
+  Regression benchmark: building the chatbot context must cost the same for a
+  user with 50k stored messages as for one with a handful.
+  """
+  HEAVY_MESSAGES = 50_000
+  LIGHT_MESSAGES = 30
+  RUNS = 15
+
+  @classmethod
+  def setUpTestData(cls):
+    cls.heavy = User.objects.create_user(username="heavy", email="heavy@example.com", password="x")
+    cls.light = User.objects.create_user(username="light", email="light@example.com", password="x")
+    cls.heavy_thread = Conversation.objects.create(user=cls.heavy)
+    cls.light_thread = Conversation.objects.create(user=cls.light)
+    for thread, count in ((cls.heavy_thread, cls.HEAVY_MESSAGES), (cls.light_thread, cls.LIGHT_MESSAGES)):
+      ChatHistory.objects.bulk_create(
+        [
+          ChatHistory(user=thread.user, conversation=thread, role="user" if i % 2 == 0 else "model", message=f"message {i} " + "x" * 200)
+          for i in range(count)
+        ],
+        batch_size=5000,
+      )
+
+  def _time_build(self, thread) -> float:
+    view = ChatbotAPIView()
+    timings = []
+    for _ in range(self.RUNS):
+      start = time.perf_counter()
+      view._build_contents(thread.id)
+      timings.append(time.perf_counter() - start)
+    return median(timings)
+
+  def test_history_fetch_is_bounded_limited_queries(self):
+    with CaptureQueriesContext(connection) as ctx:
+      contents = ChatbotAPIView()._build_contents(self.heavy_thread.id)
+
+    max_batches = views.CHAT_MAX_HISTORY_MESSAGES // views.CHAT_HISTORY_BATCH_SIZE + 1
+    self.assertLessEqual(len(ctx.captured_queries), max_batches)
+    for query in ctx.captured_queries:
+      self.assertIn("LIMIT", query["sql"].upper())
+    # System instruction pair + whole turns within the budget
+    history = contents[2:]
+    self.assertGreater(len(history), 0)
+    self.assertEqual(history[0]["role"], "user")
+
+  def test_history_window_is_latest_messages_in_order(self):
+    contents = ChatbotAPIView()._build_contents(self.heavy_thread.id)[2:]
+    first_expected = self.HEAVY_MESSAGES - len(contents)
+    self.assertTrue(contents[0]["parts"][0]["text"].startswith(f"message {first_expected} "))
+    self.assertTrue(contents[-1]["parts"][0]["text"].startswith(f"message {self.HEAVY_MESSAGES - 1} "))
+
+  def test_history_fetch_time_does_not_grow_with_history(self):
+    self._time_build(self.heavy_thread)  # warm up
+    light = self._time_build(self.light_thread)
+    heavy = self._time_build(self.heavy_thread)
+    # Loading and slicing all 50k rows was ~3 orders of magnitude slower
+    self.assertLess(heavy, light * 5 + 0.005, f"heavy={heavy * 1000:.2f}ms light={light * 1000:.2f}ms")
+
+
+
+class HistoryWindowTests(TestCase):
+  """Token-budgeted selection of chat history (rows are fed newest first)."""
+
+  def _rows(self, *messages):
+    # (id, timestamp, role, message, token_count), newest first
+    return [(i, None, role, "x", tokens) for i, (role, tokens) in enumerate(messages)]
+
+  def test_keeps_whole_turns_within_budget(self):
+    window = HistoryWindow(token_budget=100, max_messages=100, batch_size=20)
+    window.feed(self._rows(("user", 10), ("model", 40), ("user", 10), ("model", 60), ("user", 10)))
+    # Newest user (10) + one turn (50) fit; the next turn (70) would exceed 100
+    self.assertEqual([role for role, _ in window.history()], ["user", "model", "user"])
+    self.assertEqual(window.tokens_used, 60)
+    self.assertFalse(window.wants_more())
+
+  def test_newest_message_is_always_kept(self):
+    window = HistoryWindow(token_budget=5, max_messages=100, batch_size=20)
+    window.feed(self._rows(("user", 50), ("model", 1), ("user", 1)))
+    self.assertEqual(window.history(), [("user", "x")])
+
+  def test_requests_another_batch_only_while_budget_remains(self):
+    window = HistoryWindow(token_budget=1000, max_messages=100, batch_size=2)
+    window.feed(self._rows(("user", 10), ("model", 10)))
+    self.assertTrue(window.wants_more())
+    self.assertEqual(window.before, (None, 1))
+    window.feed(self._rows(("user", 10)))
+    self.assertFalse(window.wants_more())
+    self.assertEqual(len(window.history()), 3)
+
+
+class HistoryCompactorTests(TestCase):
+  """Rolling summaries replace older turns in the chatbot context."""
+
+  def setUp(self):
+    self.user = User.objects.create_user(username="talker", email="talker@example.com", password="x")
+    self.thread = Conversation.objects.create(user=self.user)
+    self._chat(range(10))
+    llm = StubClient(responses=[{"match": "Existing summary", "text": "Student asked ten questions."}])
+    self.compactor = HistoryCompactor(llm, trigger_tokens=100, keep_tokens=40, summary_max_tokens=200)
+
+  def _chat(self, turns):
+    for i in turns:
+      ChatHistory.objects.create(user=self.user, conversation=self.thread, role="user", message=f"question {i}", token_count=10)
+      ChatHistory.objects.create(user=self.user, conversation=self.thread, role="model", message=f"answer {i}", token_count=10)
+
+  def test_compacts_older_turns_and_keeps_recent_ones_verbatim(self):
+    self.assertTrue(self.compactor.compact(self.thread.id))
+
+    summary = ConversationSummary.objects.get(conversation=self.thread)
+    self.assertEqual(summary.summary, "Student asked ten questions.")
+    # keep_tokens=40 keeps the last two turns (four messages) verbatim
+    kept = ChatHistory.objects.filter(conversation=self.thread, id__gt=summary.summarized_until_id)
+    self.assertEqual(list(kept.values_list("message", flat=True)), ["question 8", "answer 8", "question 9", "answer 9"])
+
+    contents = ChatbotAPIView()._build_contents(self.thread.id)
+    texts = [item["parts"][0]["text"] for item in contents]
+    self.assertIn("Student asked ten questions.", texts[2])
+    self.assertEqual(texts[4:], ["question 8", "answer 8", "question 9", "answer 9"])
+
+  def test_short_tail_is_left_alone(self):
+    self.compactor.trigger_tokens = 1000
+    self.assertFalse(self.compactor.compact(self.thread.id))
+    self.assertFalse(ConversationSummary.objects.filter(conversation=self.thread).exists())
+
+  def test_next_compaction_rolls_previous_summary_forward(self):
+    self.compactor.compact(self.thread.id)
+    first = ConversationSummary.objects.get(conversation=self.thread)
+    self.assertFalse(self.compactor.compact(self.thread.id))  # nothing new yet
+
+    self._chat(range(10, 16))
+    self.assertTrue(self.compactor.compact(self.thread.id))
+    self.assertGreater(ConversationSummary.objects.get(conversation=self.thread).summarized_until_id, first.summarized_until_id)
+
+
+@mock.patch.object(history_compactor, "schedule")
+class ConversationTests(TestCase):
+  """Chat turns land in separate threads; each thread has its own context."""
+
+  def setUp(self):
+    use_stub_llm(self)
+    self.user = User.objects.create_user(username="threads", email="threads@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def _say(self, text, **extra):
+    payload = {"message": text, **extra}
+    return self.client.post(reverse("chatbot"), payload, format="json")
+
+  def test_turns_continue_the_latest_thread_unless_one_is_named(self, schedule):
+    first = self._say("Which universities offer pharmacy?")
+    self.assertEqual(first.status_code, 200)
+    thread_id = first.data["conversation_id"]
+    self.assertEqual(self._say("And their cut-off marks?").data["conversation_id"], thread_id)
+    schedule.assert_called_with(thread_id)
+
+    other = Conversation.objects.create(user=self.user, title="Law")
+    self.assertEqual(self._say("Law at UNILAG?", conversation_id=other.id).data["conversation_id"], other.id)
+    self.assertEqual(Conversation.objects.get(pk=thread_id).title, "Which universities offer pharmacy?")
+    self.assertEqual(ChatHistory.objects.filter(conversation_id=thread_id).count(), 4)
+    self.assertEqual(ChatHistory.objects.filter(conversation=other).count(), 2)
+
+    # Each thread's context only carries its own messages
+    texts = [item["parts"][0]["text"] for item in ChatbotAPIView()._build_contents(other.id)[2:]]
+    self.assertEqual(texts[0], "Law at UNILAG?")
+    self.assertNotIn("And their cut-off marks?", texts)
+
+  def test_archived_and_foreign_threads_are_rejected(self, schedule):
+    archived = Conversation.objects.create(user=self.user, is_archived=True)
+    stranger = User.objects.create_user(username="stranger", email="stranger@example.com", password="x")
+    foreign = Conversation.objects.create(user=stranger)
+
+    self.assertEqual(self._say("hi", conversation_id=archived.id).status_code, 400)
+    self.assertEqual(self._say("hi", conversation_id=foreign.id).status_code, 404)
+    self.assertFalse(ChatHistory.objects.exists())
+    # Without an id, archived threads are not picked up again
+    self.assertNotEqual(self._say("hi").data["conversation_id"], archived.id)
+
+  def test_thread_listing_and_messages(self, schedule):
+    thread_id = self._say("hello").data["conversation_id"]
+    Conversation.objects.create(user=self.user, title="old", is_archived=True)
+
+    listed = self.client.get(reverse("conversation-list"))
+    self.assertEqual([c["id"] for c in listed.data["results"]], [thread_id])
+    archived = self.client.get(reverse("conversation-list"), {"archived": "true"})
+    self.assertEqual([c["title"] for c in archived.data["results"]], ["old"])
+
+    messages = self.client.get(reverse("conversation-messages", args=[thread_id]))
+    self.assertEqual([m["role"] for m in messages.data], ["user", "model"])
+    self.assertIn("ETag", messages)
+
+    stranger = User.objects.create_user(username="nosy", email="nosy@example.com", password="x")
+    self.client.force_authenticate(stranger)
+    self.assertEqual(self.client.get(reverse("conversation-messages", args=[thread_id])).status_code, 404)
+    self.assertEqual(self.client.get(reverse("conversation-detail", args=[thread_id])).status_code, 404)
+
+
+class ChatbotRequestSerializerTests(TestCase):
+  """The compact request shape, and the legacy full-history one."""
+
+  def _validate(self, data):
+    serializer = ChatbotRequestSerializer(data=data)
+    valid = serializer.is_valid()
+    return valid, serializer.validated_data if valid else serializer.errors
+
+  def test_compact_shape(self):
+    valid, data = self._validate({"message": "Cut-off for UNILAG law?", "conversation_id": 3})
+    self.assertTrue(valid)
+    self.assertEqual(data, {"message": "Cut-off for UNILAG law?", "conversation_id": 3})
+
+  def test_legacy_shape_uses_and_validates_only_the_last_item(self):
+    history = [{"role": "user", "bogus": True}] * 500 + [{"role": "user", "parts": [{"text": "latest"}]}]
+    valid, data = self._validate({"chat_history": history})
+    self.assertTrue(valid)
+    self.assertEqual(data, {"message": "latest"})
+
+    valid, errors = self._validate({"chat_history": [{"role": "user", "parts": []}] * 3})
+    self.assertFalse(valid)
+    self.assertIn("chat_history", errors)
+
+  def test_message_is_required(self):
+    for data in ({}, {"message": ""}, {"chat_history": []}, {"conversation_id": 1}):
+      valid, _ = self._validate(data)
+      self.assertFalse(valid, data)
+
+
+@mock.patch.object(history_compactor, "schedule")
+class ChatWriteBehindTests(TestCase):
+  """A turn's two messages are written together once the reply is known."""
+
+  def setUp(self):
+    self.user = User.objects.create_user(username="writer", email="writer@example.com", password="x")
+    self.thread = Conversation.objects.create(user=self.user)
+    ChatHistory.objects.create(user=self.user, conversation=self.thread, role="user", message="earlier question")
+    ChatHistory.objects.create(user=self.user, conversation=self.thread, role="model", message="earlier answer")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+    use_stub_llm(self)
+    # Injected failures below must not wait out retries
+    retries = mock.patch.object(views.llm, "max_retries", 0)
+    retries.start()
+    self.addCleanup(retries.stop)
+    # Restart the flush clock, so no usage is written inside the captured request
+    usage_rollup.flush()
+
+  def _say(self, text):
+    return self.client.post(reverse("chatbot"), {"message": text, "conversation_id": self.thread.id}, format="json")
+
+  def test_turn_is_stored_in_one_insert_after_the_reply(self, schedule):
+    with mock.patch.object(views.llm, "generate", wraps=views.llm.generate) as generate:
+      with CaptureQueriesContext(connection) as ctx:
+        self.assertEqual(self._say("new question").status_code, 200)
+
+    # The unsaved message still reaches Gemini, after the stored history
+    texts = [item["parts"][0]["text"] for item in generate.call_args.args[0]]
+    self.assertEqual(texts[-3:], ["earlier question", "earlier answer", "new question"])
+
+    inserts = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith("INSERT") and "chathistory" in q["sql"]]
+    self.assertEqual(len(inserts), 1)
+    stored = list(ChatHistory.objects.filter(conversation=self.thread).order_by("timestamp", "id").values_list("role", "message", "token_count"))
+    self.assertEqual([role for role, _, _ in stored], ["user", "model", "user", "model"])
+    self.assertEqual(stored[2][1:], ("new question", estimate_tokens("new question")))
+
+  def test_failed_turn_writes_nothing(self, schedule):
+    with mock.patch.object(views.llm.backend, "failure_rate", 1.0):
+      with CaptureQueriesContext(connection) as ctx:
+        self.assertEqual(self._say("new question").status_code, 503)
+    self.assertEqual(ChatHistory.objects.filter(conversation=self.thread).count(), 2)
+    writes = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith(("INSERT", "DELETE"))]
+    self.assertFalse([sql for sql in writes if "ratelimitbucket" not in sql])  # the request still spent a token
+    schedule.assert_not_called()
+
+  def test_write_through_mode_saves_first_and_rolls_back(self, schedule):
+    with mock.patch.object(ChatbotAPIView, "WRITE_BEHIND", False):
+      self.assertEqual(self._say("kept").status_code, 200)
+      with mock.patch.object(views.llm.backend, "failure_rate", 1.0):
+        self.assertEqual(self._say("dropped").status_code, 503)
+    messages = list(ChatHistory.objects.filter(conversation=self.thread).values_list("message", flat=True))
+    self.assertEqual(messages[2], "kept")
+    self.assertNotIn("dropped", messages)
+    self.assertEqual(len(messages), 4)
+
+
+class SemanticAnswerCacheTests(TestCase):
+  """Near-identical opening questions share one stored reply."""
+
+  def setUp(self):
+    self.now = 0.0
+    self.cache = SemanticAnswerCache(threshold=0.8, ttl=60, max_entries=2, clock=lambda: self.now)
+    self.cache.set("What is the JAMB cut-off mark for Medicine at UNILAG?", "medicine reply")
+
+  def test_paraphrases_hit(self):
+    for question in ("what's the jamb cut off mark for medicine in unilag", "JAMB cutoff for Medicine, UNILAG"):
+      self.assertEqual(self.cache.get(question), "medicine reply", question)
+
+  def test_different_course_institution_or_number_misses(self):
+    for question in (
+        "What is the JAMB cut-off mark for Law at UNILAG?",
+        "What is the JAMB cut-off mark for Medicine at UI?",
+        "Is 250 above the JAMB cut-off mark for Medicine at UNILAG?",
+    ):
+      self.assertIsNone(self.cache.get(question), question)
+
+  def test_entries_expire(self):
+    self.now = 61
+    self.assertIsNone(self.cache.get("What is the JAMB cut-off mark for Medicine at UNILAG?"))
+    self.assertEqual(self.cache.stats()["expired"], 1)
+    self.assertEqual(self.cache.stats()["entries"], 0)
+
+  def test_least_recently_used_entry_is_evicted(self):
+    self.cache.set("How many O'Level sittings are allowed?", "sittings reply")
+    self.cache.get("JAMB cut-off mark for Medicine at UNILAG")  # refresh the first entry
+    self.cache.set("When does post-UTME registration start?", "post-utme reply")
+
+    self.assertIsNone(self.cache.get("How many O'Level sittings are allowed?"))
+    self.assertEqual(self.cache.get("JAMB cut-off mark for Medicine at UNILAG"), "medicine reply")
+    stats = self.cache.stats()
+    self.assertEqual((stats["evictions"], stats["entries"]), (1, 2))
+    self.assertEqual((stats["hits"], stats["misses"], stats["hit_rate"]), (2, 1, 0.6667))
+
+
+@mock.patch.object(history_compactor, "schedule")
+class ChatbotSemanticCacheTests(TestCase):
+
+  def setUp(self):
+    use_stub_llm(self)
+    semantic_answer_cache.clear()
+    self.user = User.objects.create_user(username="asker", email="asker@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def _say(self, text, conversation_id=None):
+    return self.client.post(reverse("chatbot"), {"message": text, "conversation_id": conversation_id}, format="json")
+
+  def test_opening_questions_are_answered_from_the_cache(self, schedule):
+    with mock.patch.object(views.llm, "generate", wraps=views.llm.generate) as generate:
+      first = self._say("How many O'Level sittings are allowed?")
+      second = self._say("how many o level sittings allowed", Conversation.objects.create(user=self.user).id)
+      self.assertEqual(generate.call_count, 1)
+      self.assertEqual(second.data["bot_reply"], first.data["bot_reply"])
+      # The cached turn is still stored like any other
+      self.assertEqual(ChatHistory.objects.filter(conversation_id=second.data["conversation_id"]).count(), 2)
+
+      # Follow-ups depend on the conversation so far and always go to the model
+      self._say("How many O'Level sittings are allowed?", first.data["conversation_id"])
+      self.assertEqual(generate.call_count, 2)
+
+
+class CatalogRetrievalTests(TestCase):
+  """Chatbot prompts are grounded in the matching Course/Institution rows."""
+
+  def setUp(self):
+    self.unilag = Institution.objects.create(name="University of Lagos", abbreviation="UNILAG", state="Lagos", website="unilag.edu.ng")
+    self.ui = Institution.objects.create(name="University of Ibadan", abbreviation="UI", state="Oyo", website="ui.edu.ng")
+    self.medicine = Course.objects.create(
+      institution=self.unilag, name="Medicine and Surgery", duration_years=6,
+      olevel_requirements="Five credits: English, Mathematics, Physics, Chemistry, Biology",
+      jamb_requirements="English, Physics, Chemistry, Biology",
+    )
+    Course.objects.create(institution=self.ui, name="Medicine and Surgery", duration_years=6, jamb_requirements="English, Biology, Chemistry, Physics")
+    Course.objects.create(institution=self.unilag, name="Law", duration_years=5, jamb_requirements="English, Literature, Government, CRS")
+    self.index = CatalogIndex(ttl=600)
+    self.retriever = CatalogRetriever(self.index, top_k=3, max_tokens=600)
+
+  def test_best_match_comes_first(self):
+    block = self.retriever.context_block("What JAMB subjects do I need for medicine at UNILAG?")
+    lines = block.splitlines()
+    self.assertTrue(lines[1].startswith("- Medicine and Surgery at University of Lagos (UNILAG). 6 years"))
+    self.assertIn("UTME subjects: English, Physics, Chemistry, Biology", lines[1])
+    self.assertNotIn("Law", block)
+
+  def test_unrelated_messages_get_no_block(self):
+    self.assertIsNone(self.retriever.context_block("hello there"))
+
+  def test_index_follows_catalog_changes_without_a_rebuild(self):
+    self.index.rebuild()
+    with mock.patch("apps.ai_assistant.signals.catalog_index", self.index), mock.patch.object(self.index, "rebuild") as rebuild:
+      Course.objects.create(institution=self.ui, name="Pharmacy", duration_years=5)
+      self.assertEqual(self.index.search("pharmacy", 1)[0][0][0], "course")
+
+      self.unilag.name = "Unilag Akoka Campus"
+      self.unilag.save()
+      self.assertEqual(self.index.search("akoka medicine", 1)[0][0], ("course", self.medicine.pk))
+
+      self.medicine.delete()
+      self.assertNotIn(("course", self.medicine.pk), [key for key, _, _ in self.index.search("medicine", 10)])
+      rebuild.assert_not_called()
+
+  def test_stale_index_is_rebuilt_by_one_thread_while_others_search_it(self):
+    now = [0.0]
+    index = CatalogIndex(ttl=600, clock=lambda: now[0])
+    index.rebuild()
+    now[0] = 601
+    started, release = threading.Event(), threading.Event()
+
+    def slow_rebuild():
+      started.set()
+      release.wait(5)
+      index._built_at = now[0]
+
+    with mock.patch.object(index, "rebuild", side_effect=slow_rebuild) as rebuild:
+      rebuilder = threading.Thread(target=index.search, args=("law", 1))
+      rebuilder.start()
+      self.assertTrue(started.wait(5))
+      self.assertEqual(index.search("law", 1)[0][0][0], "course")  # the old index, without waiting
+      release.set()
+      rebuilder.join(5)
+    rebuild.assert_called_once()
+
+
+@mock.patch.object(history_compactor, "schedule")
+class ChatbotGroundingTests(TestCase):
+
+  def setUp(self):
+    use_stub_llm(self)
+    semantic_answer_cache.clear()
+    institution = Institution.objects.create(name="University of Lagos", abbreviation="UNILAG", website="unilag.edu.ng")
+    Course.objects.create(institution=institution, name="Law", duration_years=5, jamb_requirements="English, Literature, Government, CRS")
+    catalog_index.rebuild()
+    self.user = User.objects.create_user(username="grounded", email="grounded@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def test_catalog_rows_are_sent_with_the_question_but_not_stored(self, schedule):
+    with mock.patch.object(views.llm, "generate", wraps=views.llm.generate) as generate:
+      self.client.post(reverse("chatbot"), {"message": "Is law at unilag very competitive?"}, format="json")
+
+    parts = generate.call_args.args[0][-1]["parts"]
+    self.assertIn("UTME subjects: English, Literature, Government, CRS", parts[0]["text"])
+    self.assertEqual(parts[1]["text"], "Is law at unilag very competitive?")
+    self.assertEqual(ChatHistory.objects.filter(role="user").get().message, "Is law at unilag very competitive?")
+
+
+class IntentRouterTests(TestCase):
+  """Structured catalog questions are answered from the database, without Gemini."""
+
+  def setUp(self):
+    self.router = IntentRouter()
+    unn = Institution.objects.create(name="University of Nigeria, Nsukka", abbreviation="UNN", state="Enugu", city="Nsukka", website="unn.edu.ng")
+    Institution.objects.create(name="Enugu State University of Science and Technology", abbreviation="ESUT", state="Enugu", ownership_type="state", website="esut.edu.ng")
+    Institution.objects.create(name="Federal Polytechnic Oko", state="Anambra", institution_type="polytechnic", website="federalpolyoko.edu.ng")
+    self.unilag = Institution.objects.create(name="University of Lagos", abbreviation="UNILAG", state="Lagos", website="unilag.edu.ng")
+    Course.objects.create(institution=self.unilag, name="Law", duration_years=5, jamb_requirements="English, Literature, Government, CRS")
+    Course.objects.create(institution=self.unilag, name="Medicine and Surgery", duration_years=6, olevel_requirements="Five credits incl. English, Maths, Physics, Chemistry, Biology")
+    Course.objects.create(institution=unn, name="Law", duration_years=5)
+
+  def test_institutions_by_ownership_and_place(self):
+    reply = self.router.answer("Which federal universities are in Enugu?")
+    self.assertIn("**Federal universities in Enugu**", reply)
+    self.assertIn("- University of Nigeria, Nsukka (UNN) — Nsukka, Enugu", reply)
+    self.assertNotIn("ESUT", reply)
+    self.assertIn("ESUT", self.router.answer("list state universities in enugu state"))
+    self.assertIn("couldn't find any federal polytechnics in Enugu", self.router.answer("Which federal polytechnics are in Enugu?"))
+
+  def test_course_requirements(self):
+    reply = self.router.answer("What are the JAMB subjects for Law at UNILAG?")
+    self.assertIn("**Law at University of Lagos (UNILAG)**", reply)
+    self.assertIn("- **UTME subjects:** English, Literature, Government, CRS", reply)
+    self.assertIn("O'Level:** Five credits", self.router.answer("o-level requirements for medicine at university of lagos"))
+    self.assertIn("**Duration:** 6 years", self.router.answer("How long is Medicine and Surgery at unilag?"))
+    self.assertIn("- Law\n- Medicine and Surgery", self.router.answer("What courses does UNILAG offer?"))
+
+  def test_institution_lookup_only_compares_likely_rows(self):
+    futa = Institution.objects.create(name="Fed. Univ. of Tech., Akure", abbreviation="FUTA", state="Ondo", website="futa.edu.ng")
+    Institution.objects.bulk_create(Institution(name=f"College of Education {i}", state="Oyo", website=f"coe{i}.edu.ng") for i in range(20))
+    with mock.patch("apps.ai_assistant.intents.normalize_institution_name", wraps=normalize_institution_name) as normalize:
+      self.assertEqual(self.router._find_institution("federal university of technology akure"), futa)
+    self.assertEqual(normalize.call_count, 2)  # the question, then the one row named like it
+    self.assertEqual(self.router._find_institution("futa"), futa)
+    self.assertIsNone(self.router._find_institution("university of atlantis"))
+
+  def test_everything_else_falls_through(self):
+    for message in (
+        "Which universities are the best?",                       # no filter
+        "Which federal universities are in Atlantis?",            # unknown place
+        "What are the JAMB subjects for Law at UNIABUJA?",        # unknown institution
+        "What are the JAMB subjects for Pharmacy at UNILAG?",     # unknown course
+        "What are the JAMB subjects for Law at UNN?",             # field not in the catalog
+        "What are the JAMB subjects for Law at UNILAG and can I use Economics instead?",
+    ):
+      self.assertIsNone(self.router.answer(message), message)
+    stats = self.router.stats()
+    self.assertEqual(stats["fell_through"], 6)
+    self.assertEqual(stats["answered_locally_rate"], 0.0)
+
+  @mock.patch.object(history_compactor, "schedule")
+  def test_chatbot_answers_routed_questions_without_gemini(self, schedule):
+    isolate_usage(self)
+    user = User.objects.create_user(username="router", email="router@example.com", password="x")
+    client = APIClient()
+    client.force_authenticate(user)
+    with mock.patch.object(views.llm, "generate") as generate:
+      response = client.post(reverse("chatbot"), {"message": "JAMB subjects for law at unilag"}, format="json")
+    generate.assert_not_called()
+    self.assertIn("English, Literature, Government, CRS", response.data["bot_reply"])
+    self.assertEqual(ChatHistory.objects.filter(user=user).count(), 2)
+
+
+class SlowFirstCallStub(StubClient):
+  """The first call hangs for `first_ms`; later calls use the normal latency."""
+
+  def __init__(self, first_ms: int, **options):
+    super().__init__(**options)
+    self.first_ms = first_ms
+    self.calls = 0
+
+  def generate(self, contents, generation_config=None):
+    self.calls += 1
+    if self.calls == 1:
+      time.sleep(self.first_ms / 1000)
+    return super().generate(contents, generation_config)
+
+
+class StallingStreamStub(StubClient):
+  """Streams one chunk, then hangs for `stall_ms` before the last."""
+
+  def __init__(self, stall_ms: int, **options):
+    super().__init__(**options)
+    self.stall_ms = stall_ms
+
+  def stream(self, contents, generation_config=None):
+    yield LLMResponse(text="Hello", finish_reason=None)
+    time.sleep(self.stall_ms / 1000)
+    yield LLMResponse(text=" there")
+
+  async def astream(self, contents, generation_config=None):
+    yield LLMResponse(text="Hello", finish_reason=None)
+    await asyncio.sleep(self.stall_ms / 1000)
+    yield LLMResponse(text=" there")
+
+
+class ResilientClientTests(TestCase):
+  """Timeouts, retries, hedging and the circuit breaker, against the fault-injecting stub."""
+
+  CONTENTS = [{"role": "user", "parts": [{"text": "hello"}]}]
+
+  def _client(self, backend, **options):
+    options = {
+      "timeout": 0, "deadline": 0, "max_retries": 2, "backoff_base": 0.001, "backoff_max": 0.01, "hedge": False,
+      "breaker": CircuitBreaker(failure_rate=0.5, min_calls=100, window=60, open_seconds=30),
+      **options,
+    }
+    return ResilientClient(backend, **options)
+
+  def test_retryable_errors_are_retried(self):
+    client = self._client(StubClient(fail_first=2))
+    self.assertEqual(client.generate(self.CONTENTS).text, StubClient.DEFAULT_CHAT_REPLY)
+    self.assertEqual(client.stats()["retries"], 2)
+    self.assertEqual(asyncio.run(self._client(StubClient(fail_first=1)).agenerate(self.CONTENTS)).finish_reason, "STOP")
+
+  def test_gives_up_as_unavailable(self):
+    backend = StubClient(fail_first=5)
+    with self.assertRaises(LLMUnavailableError) as raised:
+      self._client(backend).generate(self.CONTENTS)
+    self.assertIsInstance(raised.exception.__cause__, StubLLMError)
+    self.assertEqual(backend.fail_first, 2)  # three attempts
+
+  def test_bad_requests_are_not_retried(self):
+    client = self._client(StubClient(fail_first=1, failure_message="400 Please use a valid role"))
+    with self.assertRaises(StubLLMError):
+      client.generate(self.CONTENTS)
+    self.assertEqual(client.stats()["retries"], 0)
+    self.assertEqual(client.breaker.stats()["recent_failures"], 0)
+
+  def test_hung_call_times_out(self):
+    client = self._client(StubClient(latency={"distribution": "fixed", "ms": 500}), timeout=0.05, max_retries=0)
+    started = time.monotonic()
+    with self.assertRaises(LLMTimeoutError):
+      client.generate(self.CONTENTS)
+    self.assertLess(time.monotonic() - started, 0.3)
+    with self.assertRaises(LLMTimeoutError):
+      asyncio.run(client.agenerate(self.CONTENTS))
+
+  def test_stream_that_stalls_midway_times_out(self):
+    client = self._client(StallingStreamStub(stall_ms=500), timeout=0.05)
+    received = []
+    started = time.monotonic()
+    with self.assertRaises(LLMTimeoutError):
+      for chunk in client.stream(self.CONTENTS):
+        received.append(chunk.text)
+    self.assertLess(time.monotonic() - started, 0.3)
+    self.assertEqual(received, ["Hello"])
+
+    async def consume():
+      async for chunk in client.astream(self.CONTENTS):
+        received.append(chunk.text)
+
+    with self.assertRaises(LLMTimeoutError):
+      asyncio.run(consume())
+    self.assertEqual(received, ["Hello", "Hello"])
+    self.assertEqual(client.stats()["timeouts"], 2)
+    # Under the timeout the stall is just a slow chunk
+    chunks = [chunk.text for chunk in self._client(StallingStreamStub(stall_ms=10), timeout=1).stream(self.CONTENTS)]
+    self.assertEqual(chunks, ["Hello", " there"])
+
+  def test_slow_call_is_hedged_after_the_p95(self):
+    backend = SlowFirstCallStub(first_ms=500)
+    client = self._client(backend, hedge=True)
+    for _ in range(20):
+      client.latencies.add(0.01)
+    started = time.monotonic()
+    self.assertEqual(client.generate(self.CONTENTS).text, StubClient.DEFAULT_CHAT_REPLY)
+    self.assertLess(time.monotonic() - started, 0.3)
+    self.assertEqual((backend.calls, client.stats()["hedge_wins"]), (2, 1))
+
+  def test_circuit_opens_then_probes(self):
+    now = [0.0]
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4, window=60, open_seconds=30, clock=lambda: now[0])
+    for failed in (False, True, False, True):
+      breaker.before_call()
+      breaker.record(failed)
+    self.assertEqual(breaker.state, "open")
+    with self.assertRaises(CircuitOpenError) as raised:
+      breaker.before_call()
+    self.assertEqual(raised.exception.retry_after, 30)
+
+    now[0] = 31
+    breaker.before_call()  # the probe
+    with self.assertRaises(CircuitOpenError):
+      breaker.before_call()  # everyone else still waits for it
+    breaker.record(failed=False)
+    self.assertEqual(breaker.state, "closed")
+
+  def test_cancelled_probe_lets_the_next_call_through(self):
+    now = [0.0]
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=1, window=60, open_seconds=30, clock=lambda: now[0])
+    breaker.record(failed=True)
+    now[0] = 31
+    client = self._client(StubClient(latency={"distribution": "fixed", "ms": 500}), breaker=breaker)
+
+    async def cancel_the_probe():
+      probe = asyncio.ensure_future(client.agenerate(self.CONTENTS))
+      await asyncio.sleep(0.05)
+      probe.cancel()
+      with self.assertRaises(asyncio.CancelledError):
+        await probe
+
+    asyncio.run(cancel_the_probe())
+    self.assertEqual(breaker.state, "half_open")  # no verdict either way
+    client.backend.latency = {"distribution": "fixed", "ms": 0}
+    self.assertEqual(asyncio.run(client.agenerate(self.CONTENTS)).finish_reason, "STOP")
+    self.assertEqual(breaker.state, "closed")
+
+  def test_open_circuit_fails_fast(self):
+    backend = StubClient(failure_rate=1.0)
+    client = self._client(backend, max_retries=0, breaker=CircuitBreaker(failure_rate=0.5, min_calls=2, window=60, open_seconds=30))
+    for _ in range(2):
+      with self.assertRaises(LLMUnavailableError):
+        client.generate(self.CONTENTS)
+    with mock.patch.object(backend, "generate") as generate, self.assertRaises(CircuitOpenError):
+      client.generate(self.CONTENTS)
+    generate.assert_not_called()
+
+
+class ConcurrencyLimiterTests(TestCase):
+  """Outbound slots: priority order, queue timeouts and shedding once the queue is full."""
+
+  def _queue_in_thread(self, limiter, priority, outcomes):
+    def run():
+      try:
+        with limiter.slot(priority):
+          outcomes.append(priority)
+      except LLMOverloadedError:
+        outcomes.append(f"{priority} shed")
+    queued = lambda: limiter.stats()["by_priority"][priority]["queued"]
+    before = queued()
+    thread = threading.Thread(target=run)
+    thread.start()
+    while queued() == before and thread.is_alive():
+      time.sleep(0.001)
+    return thread
+
+  def test_waiters_are_admitted_by_priority(self):
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=10, queue_timeout=2)
+    outcomes = []
+    with limiter.slot("chat"):
+      threads = [self._queue_in_thread(limiter, p, outcomes) for p in ("overview", "chat", "eligibility")]
+    for thread in threads:
+      thread.join()
+    self.assertEqual(outcomes, ["eligibility", "chat", "overview"])
+    self.assertEqual(limiter.stats()["in_flight"], 0)
+
+  def test_queue_timeout_is_an_overload(self):
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=10, queue_timeout=0.05)
+    with limiter.slot("chat"):
+      with self.assertRaises(LLMOverloadedError) as raised:
+        with limiter.slot("eligibility"):
+          pass
+    self.assertIsInstance(raised.exception, LLMUnavailableError)
+    self.assertEqual(limiter.stats()["by_priority"]["eligibility"]["timed_out"], 1)
+
+  def test_full_queue_sheds_the_lowest_priority(self):
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1, queue_timeout=2)
+    outcomes = []
+    with limiter.slot("chat"):
+      overview = self._queue_in_thread(limiter, "overview", outcomes)
+      eligibility = self._queue_in_thread(limiter, "eligibility", outcomes)
+      overview.join()
+      with self.assertRaises(LLMOverloadedError):
+        with limiter.slot("chat"):  # does not outrank the waiting eligibility check
+          pass
+    eligibility.join()
+    self.assertEqual(outcomes, ["overview shed", "eligibility"])
+
+  def test_async_waiters_share_the_slots(self):
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=10, queue_timeout=2)
+
+    async def run():
+      order = []
+
+      async def call(priority, seconds):
+        async with limiter.aslot(priority):
+          order.append(priority)
+          await asyncio.sleep(seconds)
+
+      first = asyncio.ensure_future(call("overview", 0.05))
+      await asyncio.sleep(0.01)
+      await asyncio.gather(first, call("overview", 0), call("eligibility", 0))
+      return order
+
+    self.assertEqual(asyncio.run(run()), ["overview", "eligibility", "overview"])
+
+  def test_host_slots_are_shared_through_lock_files(self):
+    with tempfile.TemporaryDirectory() as lock_dir:
+      slots = HostSlots(lock_dir, count=1)
+      held = slots.acquire(timeout=0)
+      self.assertIsNotNone(held)
+      self.assertIsNone(HostSlots(lock_dir, count=1).acquire(timeout=0.05))
+      slots.release(held)
+      slots.release(slots.acquire(timeout=0))
+
+  @mock.patch.object(history_compactor, "schedule")
+  def test_saturated_limiter_returns_503(self, schedule):
+    user = User.objects.create_user(username="overloaded", email="overloaded@example.com", password="x")
+    client = APIClient()
+    client.force_authenticate(user)
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=0, queue_timeout=0.01)
+    with mock.patch.object(views.llm, "limiter", limiter), limiter.slot("eligibility"):
+      response = client.post(reverse("chatbot"), {"message": "Is law at unilag competitive?"}, format="json")
+    self.assertEqual((response.status_code, response["Retry-After"]), (503, "1"))
+    self.assertFalse(ChatHistory.objects.filter(user=user).exists())
+
+
+@mock.patch.object(history_compactor, "schedule")
+class DegradedResponseTests(TestCase):
+  """While the circuit is open the views answer at once, from a cache when they can."""
+
+  def setUp(self):
+    isolate_usage(self)
+    self.user = User.objects.create_user(username="degraded", email="degraded@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+    open_circuit = mock.patch.object(views.llm.breaker, "before_call", side_effect=CircuitOpenError(12))
+    open_circuit.start()
+    self.addCleanup(open_circuit.stop)
+    self.addCleanup(institution_overview_cache.clear)
+    semantic_answer_cache.clear()
+    catalog_index.rebuild()
+
+  def _add_unilag_law(self):
+    unilag = Institution.objects.create(name="University of Lagos", abbreviation="UNILAG", state="Lagos", website="unilag.edu.ng")
+    Course.objects.create(institution=unilag, name="Law", duration_years=5, jamb_requirements="English, Literature, Government, CRS")
+    catalog_index.rebuild()
+
+  def test_chatbot_returns_503_with_retry_after(self, schedule):
+    response = self.client.post(reverse("chatbot"), {"message": "Is law at unilag competitive?"}, format="json")
+    self.assertEqual(response.status_code, 503)
+    self.assertEqual(response["Retry-After"], "12")
+    self.assertIn("temporarily unavailable", response.data["detail"])
+    self.assertFalse(ChatHistory.objects.filter(user=self.user).exists())
+
+  def test_chatbot_answers_from_the_catalog(self, schedule):
+    self._add_unilag_law()
+    response = self.client.post(reverse("chatbot"), {"message": "Is law at unilag competitive?"}, format="json")
+    self.assertEqual((response.status_code, response.data["degraded"]), (200, True))
+    self.assertIn("- Law at University of Lagos (UNILAG)", response.data["bot_reply"])
+    self.assertIn("temporarily unavailable", response.data["bot_reply"])
+    self.assertEqual(ChatHistory.objects.filter(user=self.user).count(), 2)
+
+    events = sse_events(b"".join(self.client.post(reverse("chatbot-stream"), {"message": "Is law at unilag competitive?"}, format="json").streaming_content))
+    self.assertEqual([event for event, _ in events], ["chunk", "done"])
+    self.assertTrue(events[1][1]["degraded"])
+    self.assertEqual(ChatHistory.objects.filter(user=self.user).count(), 4)
+
+  def test_eligibility_returns_the_rules_based_answer(self, schedule):
+    self._add_unilag_law()
+    response = self.client.post(reverse("eligibility-check"), EligibilityDeadlineTests.PROFILE, format="json")
+    self.assertEqual((response.status_code, response.data["partial"], response.data["eligibility_status"]), (200, True, "pending"))
+    self.assertNotIn("result_id", response.data)
+    self.assertEqual(response.data["jamb_subject_issues"], ["Law requires CRS in UTME, which is not among your JAMB subjects."])
+
+  async def test_async_eligibility_returns_the_rules_based_answer(self, schedule):
+    use_async_views(self)
+    response = await self.async_client.post(
+      reverse("eligibility-check"), EligibilityDeadlineTests.PROFILE, content_type="application/json",
+      headers={"Authorization": f"Bearer {AccessToken.for_user(self.user)}"},
+    )
+    self.assertEqual((response.status_code, response.json()["partial"]), (200, True))
+    self.assertIsNone(response.json()["is_eligible"])
+
+  def test_overview_serves_an_expired_entry(self, schedule):
+    CachedInstitutionOverview.objects.create(
+      key="university of ibadan", institution_name="UI", data={"name": "University of Ibadan"},
+      expires_at=timezone.now() - timedelta(days=1),
+    )
+    response = self.client.post(reverse("institution-overview"), {"institution_name": "University of Ibadan"}, format="json")
+    self.assertEqual((response.status_code, response.data), (200, {"name": "University of Ibadan", "stale": True}))
+
+    response = self.client.post(reverse("institution-overview"), {"institution_name": "University of Jos"}, format="json")
+    self.assertEqual((response.status_code, response["Retry-After"]), (503, "12"))
+
+
+class FailingBucketStore:
+  def take(self, key, capacity, per_second):
+    raise ConnectionError("cache is down")
+
+
+class RateLimitTests(TestCase):
+  """Token buckets per user and per IP, in a shared cache or the database."""
+
+  def test_bucket_drains_then_refills(self):
+    state, wait = take_token(None, capacity=2, per_second=0.5, now=100)
+    self.assertEqual((state, wait), ((1, 100), 0.0))
+    state, wait = take_token(state, 2, 0.5, now=100)
+    state, wait = take_token(state, 2, 0.5, now=100)
+    self.assertEqual(wait, 2.0)  # one token at half a token per second
+    self.assertEqual(take_token(state, 2, 0.5, now=102)[1], 0.0)
+    self.assertEqual(take_token((0, 0), 2, 0.5, now=1000)[0], (1, 1000))  # capped at the burst
+
+  def test_user_and_ip_buckets(self):
+    limiter = RateLimiter({"user": (2, 60), "ip": (3, 60)}, stores=[DatabaseBucketStore()])
+    self.assertEqual([limiter.wait_time(1, "10.0.0.1") > 0 for _ in range(3)], [False, False, True])
+    self.assertFalse(limiter.wait_time(2, "10.0.0.1"))  # the IP's third token
+    self.assertTrue(limiter.wait_time(3, "10.0.0.1"))
+    self.assertFalse(limiter.wait_time(None, "10.0.0.2"))
+    self.assertLess(RateLimitBucket.objects.get(key="ai:user:1").tokens, 1)
+
+  def test_ip_rejection_gives_the_user_token_back(self):
+    cache = caches["default"]
+    self.addCleanup(cache.clear)
+    for store in (DatabaseBucketStore(), CacheBucketStore(cache)):
+      with self.subTest(store=type(store).__name__):
+        cache.clear()
+        limiter = RateLimiter({"user": (5, 60), "ip": (1, 60)}, stores=[store])
+        self.assertFalse(limiter.wait_time(1, "10.0.0.9"))
+        for _ in range(3):
+          self.assertTrue(limiter.wait_time(1, "10.0.0.9"))  # a crowded IP
+        self.assertEqual([limiter.wait_time(1, "10.0.0.10") > 0 for _ in range(2)], [False, True])
+        # Two requests went ahead, so the user has three of five tokens left
+        self.assertEqual([limiter.wait_time(1, f"10.0.1.{i}") > 0 for i in range(4)], [False, False, False, True])
+
+  def test_cache_store_with_database_fallback(self):
+    cache = caches["default"]
+    self.addCleanup(cache.clear)
+    limiter = RateLimiter({"user": (1, 60)}, stores=[CacheBucketStore(cache), DatabaseBucketStore()])
+    self.assertEqual(limiter.wait_time(7, ""), 0.0)
+    self.assertAlmostEqual(limiter.wait_time(7, ""), 1.0, places=1)
+    self.assertFalse(RateLimitBucket.objects.exists())
+
+    limiter.stores = [FailingBucketStore(), DatabaseBucketStore()]
+    self.assertFalse(limiter.wait_time(8, ""))
+    self.assertTrue(RateLimitBucket.objects.filter(key="ai:user:8").exists())
+    limiter.stores = [FailingBucketStore()]
+    self.assertFalse(limiter.wait_time(8, ""))  # no store answered: let it through
+
+  def test_stores_follow_the_setting(self):
+    self.assertEqual(settings.AI_RATE_LIMIT_STORES, ["database"])  # no Redis: shared through the database
+    with override_settings(AI_RATE_LIMIT_STORES=["cache", "database"]), self.assertLogs("apps.ai_assistant.ratelimit", "WARNING") as logs:
+      self.assertEqual([type(store) for store in _stores()], [CacheBucketStore, DatabaseBucketStore])
+    self.assertIn("local-memory cache", logs.output[0])
+    with override_settings(AI_RATE_LIMIT_STORES=["database", "cache"]), self.assertNoLogs("apps.ai_assistant.ratelimit", "WARNING"):
+      _stores()
+    with override_settings(AI_RATE_LIMIT_STORES=["redis"]), self.assertRaises(ImproperlyConfigured):
+      _stores()
+
+  def test_client_ip_behind_trusted_proxies(self):
+    request = mock.Mock(META={"REMOTE_ADDR": "10.1.1.1", "HTTP_X_FORWARDED_FOR": "6.6.6.6, 41.58.1.2"})
+    self.assertEqual(RateLimiter({}, stores=[]).client_ip(request), "10.1.1.1")
+    self.assertEqual(RateLimiter({}, stores=[], trusted_proxies=1).client_ip(request), "41.58.1.2")
+
+
+@mock.patch.object(history_compactor, "schedule")
+class UsageAccountingTests(TestCase):
+  """Rate limited AI endpoints, and the daily per-user usage they record."""
+
+  def setUp(self):
+    use_stub_llm(self)
+    self.user = User.objects.create_user(username="heavy", email="heavy@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+    limited = mock.patch.object(ai_rate_limiter, "rules", {"user": (2, 1)})
+    limited.start()
+    self.addCleanup(limited.stop)
+
+  def _say(self, text):
+    return self.client.post(reverse("chatbot"), {"message": text}, format="json")
+
+  def test_throttled_past_the_burst_and_usage_recorded(self, schedule):
+    self.assertEqual([self._say(f"tell me about option {n}").status_code for n in range(2)], [200, 200])
+    response = self._say("and one more")
+    self.assertEqual((response.status_code, response["Retry-After"]), (429, "60"))
+    self.assertEqual(ChatHistory.objects.filter(user=self.user).count(), 4)
+
+    usage_rollup.flush()
+    usage = DailyUsage.objects.get(user=self.user, day=timezone.localdate())
+    self.assertEqual((usage.requests, usage.throttled), (2, 1))
+    self.assertGreater(usage.prompt_tokens, 0)
+    self.assertGreater(usage.output_tokens, 0)
+
+    usage_rollup.add(self.user.pk, requests=1)
+    usage_rollup.flush()
+    usage.refresh_from_db()
+    self.assertEqual(usage.requests, 3)
+
+  def test_top_consumers_is_admin_only(self, schedule):
+    light = User.objects.create_user(username="light", email="light@example.com", password="x")
+    DailyUsage.objects.create(user=self.user, day=timezone.localdate(), requests=3, prompt_tokens=900, output_tokens=300)
+    DailyUsage.objects.create(user=light, day=timezone.localdate(), requests=9, prompt_tokens=100, output_tokens=50)
+    DailyUsage.objects.create(user=light, day=timezone.localdate() - timedelta(days=3), requests=40, prompt_tokens=5000)
+
+    url = reverse("ai-usage-top-consumers")
+    self.assertEqual(self.client.get(url).status_code, 403)
+    self.client.force_authenticate(User.objects.create_user(username="admin", email="admin@example.com", password="x", is_staff=True))
+
+    consumers = self.client.get(url).data["consumers"]
+    self.assertEqual([(c["username"], c["total_tokens"]) for c in consumers], [("heavy", 1200), ("light", 150)])
+    consumers = self.client.get(url, {"order_by": "requests", "days": 7}).data["consumers"]
+    self.assertEqual([(c["username"], c["requests"]) for c in consumers], [("light", 49), ("heavy", 3)])
+    self.assertEqual(self.client.get(url, {"days": 0}).status_code, 400)
+
+
+def metric_value(name: str, **labels) -> float:
+  """A sample's current value, summed over every process, from the scrape endpoint's renderer."""
+  body, _ = metrics.render()
+  for family in text_string_to_metric_families(body.decode()):
+    for sample in family.samples:
+      if sample.name == name and all(sample.labels.get(k) == v for k, v in labels.items()):
+        return sample.value
+  return 0.0
+
+
+@mock.patch.object(history_compactor, "schedule")
+class MetricsTests(TestCase):
+  """LLM call instrumentation and the Prometheus endpoint. Samples persist across runs; compare deltas."""
+
+  def setUp(self):
+    use_stub_llm(self)
+    self.user = User.objects.create_user(username="metered", email="metered@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+
+  def test_chat_call_is_measured(self, schedule):
+    calls = metric_value("eduwaka_llm_call_duration_seconds_count", endpoint="chat", outcome="ok")
+    output_tokens = metric_value("eduwaka_llm_tokens_total", endpoint="chat", kind="output")
+    stops = metric_value("eduwaka_llm_finish_reasons_total", endpoint="chat", reason="STOP")
+    misses = metric_value("eduwaka_ai_cache_lookups_total", cache="semantic_answers", result="miss")
+
+    response = self.client.post(reverse("chatbot"), {"message": f"Is nursing at OAU hard to get into? {time.time()}"}, format="json")
+    self.assertEqual(response.status_code, 200)
+
+    self.assertEqual(metric_value("eduwaka_llm_call_duration_seconds_count", endpoint="chat", outcome="ok"), calls + 1)
+    self.assertGreater(metric_value("eduwaka_llm_tokens_total", endpoint="chat", kind="output"), output_tokens)
+    self.assertEqual(metric_value("eduwaka_llm_finish_reasons_total", endpoint="chat", reason="STOP"), stops + 1)
+    self.assertEqual(metric_value("eduwaka_ai_cache_lookups_total", cache="semantic_answers", result="miss"), misses + 1)
+    self.assertEqual(metric_value("eduwaka_llm_in_flight", endpoint="chat"), 0)
+
+  def test_streamed_chat_has_its_own_series(self, schedule):
+    chat = metric_value("eduwaka_llm_call_duration_seconds_count", endpoint="chat", outcome="ok")
+    streamed = metric_value("eduwaka_llm_call_duration_seconds_count", endpoint="chat_stream", outcome="ok")
+
+    response = self.client.post(reverse("chatbot-stream"), {"message": f"Is nursing at OAU hard to get into? {time.time()}"}, format="json")
+    b"".join(response.streaming_content)
+
+    self.assertEqual(metric_value("eduwaka_llm_call_duration_seconds_count", endpoint="chat_stream", outcome="ok"), streamed + 1)
+    self.assertEqual(metric_value("eduwaka_llm_call_duration_seconds_count", endpoint="chat", outcome="ok"), chat)
+    self.assertEqual(metric_value("eduwaka_llm_in_flight", endpoint="chat_stream"), 0)
+
+  def test_retries_and_bad_json_are_counted(self, schedule):
+    retries = metric_value("eduwaka_llm_retries_total", endpoint="overview")
+    client = ResilientClient(
+      StubClient(fail_first=1), timeout=0, deadline=0, max_retries=1, backoff_base=0.001, backoff_max=0.01, hedge=False,
+      breaker=CircuitBreaker(failure_rate=0.5, min_calls=100, window=60, open_seconds=30),
+    )
+    client.generate([{"role": "user", "parts": [{"text": "hello"}]}], priority="overview")
+    self.assertEqual(metric_value("eduwaka_llm_retries_total", endpoint="overview"), retries + 1)
+
+    failures = metric_value("eduwaka_llm_json_decode_failures_total", endpoint="eligibility")
+    with self.assertRaises(ValueError):
+      views.loads_model_json("Sure! Here is the JSON:", "eligibility")
+    self.assertEqual(metric_value("eduwaka_llm_json_decode_failures_total", endpoint="eligibility"), failures + 1)
+
+  @override_settings(METRICS_TOKEN="scrape-me")
+  def test_endpoint_needs_the_token(self, schedule):
+    self.assertEqual(self.client.get("/api/metrics").status_code, 401)
+    response = self.client.get("/api/metrics", HTTP_AUTHORIZATION="Bearer scrape-me")
+    self.assertEqual(response.status_code, 200)
+    self.assertTrue(response["Content-Type"].startswith("text/plain"))
+    self.assertIn(b"eduwaka_llm_call_duration_seconds_bucket", response.content)
+
+  @override_settings(METRICS_TOKEN="")
+  def test_endpoint_is_off_without_a_token(self, schedule):
+    self.assertEqual(self.client.get("/api/metrics").status_code, 404)
+    with override_settings(DEBUG=True):
+      self.assertEqual(self.client.get("/api/metrics").status_code, 200)
+
+  @skipUnless(settings.PROMETHEUS_MULTIPROC_DIR, "PROMETHEUS_MULTIPROC_DIR is not set")
+  def test_endpoint_sums_all_workers(self, schedule):
+    before = metric_value("eduwaka_ai_rate_limited_total", scope="ip")
+    # Another worker, writing to the same directory
+    subprocess.run(
+      [sys.executable, "-c", (
+        "from prometheus_client import Counter; "
+        "Counter('eduwaka_ai_rate_limited_total', '', ['scope']).labels('ip').inc(3)"
+      )],
+      check=True,  # inherits PROMETHEUS_MULTIPROC_DIR
+    )
+    self.assertEqual(metric_value("eduwaka_ai_rate_limited_total", scope="ip"), before + 3)
+
+
+@mock.patch.object(EligibilityCheckAPIView, "DEADLINE", 0.05)
+class EligibilityDeadlineTests(TransactionTestCase):
+  """Past the deadline the student gets the rules-based answer at once, and the full one by id."""
+
+  PROFILE = {
+    "institution_name": "University of Lagos",
+    "desired_course": "Law",
+    "o_level_sittings": "1",
+    "o_level_sitting_1": "English B3, Maths C4, Literature B2, Government B3, Economics C6",
+    "jamb_score": 250,
+    "jamb_subjects": "English, Literature, Government, Economics",
+  }
+
+  def setUp(self):
+    use_stub_llm(self)
+    self.user = User.objects.create_user(username="deadline", email="deadline@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+    unilag = Institution.objects.create(name="University of Lagos", abbreviation="UNILAG", state="Lagos", website="unilag.edu.ng")
+    Course.objects.create(institution=unilag, name="Law", duration_years=5, jamb_requirements="English, Literature, Government, CRS")
+    isolate_singleflight(self)
+
+  def _check(self, latency_ms):
+    with mock.patch.object(views.llm.backend, "latency", {"distribution": "fixed", "ms": latency_ms}):
+      return self.client.post(reverse("eligibility-check"), self.PROFILE, format="json")
+
+  def _poll(self, result_id):
+    for _ in range(50):
+      body = self.client.get(reverse("eligibility-check-result", args=[result_id])).data
+      if body["status"] != "pending":
+        return body
+      time.sleep(0.05)
+    self.fail("background evaluation never finished")
+
+  def test_slow_gemini_gets_a_partial_answer(self):
+    started = time.monotonic()
+    response = self._check(latency_ms=300)
+    self.assertLess(time.monotonic() - started, 0.25)
+
+    partial = response.data
+    self.assertEqual((response.status_code, partial["partial"], partial["eligibility_status"]), (200, True, "pending"))
+    self.assertIsNone(partial["is_eligible"])
+    self.assertEqual(partial["credit_report"]["total_credits"], 5)
+    self.assertEqual(partial["jamb_subject_issues"], ["Law requires CRS in UTME, which is not among your JAMB subjects."])
+    self.assertEqual(EligibilityCheck.objects.get().status, "pending")
+
+    body = self._poll(partial["result_id"])
+    self.assertEqual(body["status"], "complete")
+    self.assertIs(body["result"]["is_eligible"], True)  # the stub's answer
+
+    other = User.objects.create_user(username="other", email="other@example.com", password="x")
+    self.client.force_authenticate(other)
+    self.assertEqual(self.client.get(reverse("eligibility-check-result", args=[partial["result_id"]])).status_code, 404)
+
+  def test_fast_gemini_answers_in_full(self):
+    response = self._check(latency_ms=0)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotIn("partial", response.data)
+    self.assertFalse(EligibilityCheck.objects.exists())
+
+
+class EligibilityBatchTests(TransactionTestCase):
+  """Duplicates are checked once, a failing target fails alone, and stragglers come back as "timeout"."""
+
+  PROFILE = {key: value for key, value in EligibilityDeadlineTests.PROFILE.items() if key not in ("institution_name", "desired_course")}
+  LAW = {"institution_name": "University of Lagos", "desired_course": "Law"}
+  ECONOMICS = {"institution_name": "University of Lagos", "desired_course": "Economics"}
+
+  def setUp(self):
+    self.stub = use_stub_llm(self, responses=[{"match": r"Desired Course: Economics", "text": "not json"}])
+    isolate_singleflight(self)
+    self.user = User.objects.create_user(username="batch", email="batch@example.com", password="x")
+    self.client = APIClient()
+    self.client.force_authenticate(self.user)
+    unilag = Institution.objects.create(name="University of Lagos", abbreviation="UNILAG", state="Lagos", website="unilag.edu.ng")
+    Course.objects.create(institution=unilag, name="Law", duration_years=5, jamb_requirements="English, Literature, Government, CRS")
+    Course.objects.create(institution=unilag, name="Political Science", duration_years=4, jamb_requirements="English, Government, Economics, Literature")
+
+  def _batch(self, *targets):
+    response = self.client.post(reverse("eligibility-check-batch"), {**self.PROFILE, "targets": list(targets)}, format="json")
+    self.assertEqual(response.status_code, 200)
+    return response.data
+
+  def test_duplicate_targets_are_checked_once(self):
+    with mock.patch.object(views.llm, "generate", wraps=views.llm.generate) as generate:
+      body = self._batch(self.LAW, {"institution_name": "UNILAG", "desired_course": " law. "}, self.LAW)
+    self.assertEqual([(r["desired_course"], r["status"]) for r in body["results"]], [("Law", "ok")])
+    self.assertIs(body["results"][0]["result"]["is_eligible"], True)  # the stub's answer
+    self.assertIs(body["deadline_exceeded"], False)
+    generate.assert_called_once()
+
+  def test_a_failing_target_does_not_fail_the_others(self):
+    body = self._batch(self.LAW, self.ECONOMICS)
+    law, economics = body["results"]
+    self.assertEqual((law["status"], economics["status"]), ("ok", "error"))
+    self.assertTrue(economics["detail"].startswith("AI returned malformed JSON"))
+    self.assertNotIn("result", economics)
+    self.assertIs(body["deadline_exceeded"], False)
+
+  @override_settings(ELIGIBILITY_BATCH_DEADLINE=0.05)
+  def test_targets_past_the_deadline_are_reported_as_timeouts(self):
+    politics = {"institution_name": "University of Lagos", "desired_course": "Political Science"}
+    self._batch(self.LAW)  # cached; answered well inside the deadline next time
+
+    started = time.monotonic()
+    with mock.patch.object(self.stub, "latency", {"distribution": "fixed", "ms": 300}):
+      body = self._batch(self.LAW, politics)
+      self.assertLess(time.monotonic() - started, 0.25)
+      law, late = body["results"]
+      self.assertEqual((law["status"], late["status"]), ("ok", "timeout"))
+      self.assertEqual(late["detail"], "Eligibility check did not finish before the batch deadline.")
+      self.assertIs(body["deadline_exceeded"], True)
+
+      # The straggler still finishes and fills the cache for the next request
+      for _ in range(50):
+        if CachedEligibilityResult.objects.filter(course_key="political science").exists():
+          break
+        time.sleep(0.05)
+      else:
+        self.fail("straggler never stored its result")
@@ -1,19 +1,43 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from apps.ai_assistant.views import EligibilityCheckAPIView, ChatbotAPIView, ChatHistoryAPIView, InstitutionOverviewAPIView
+from apps.ai_assistant.views import EligibilityCheckAPIView, EligibilityCheckResultAPIView, EligibilityBatchAPIView, ChatbotAPIView, ChatbotCacheStatsAPIView, ChatbotStreamAPIView, ChatHistoryAPIView, ConversationMessagesAPIView, ConversationViewSet, InstitutionOverviewAPIView, InstitutionOverviewCacheStatsAPIView, AIUsageTopConsumersAPIView
+from apps.ai_assistant.async_views import AsyncEligibilityCheckView, AsyncEligibilityBatchView, AsyncChatbotView, AsyncChatbotStreamView, AsyncInstitutionOverviewView
 
 router = DefaultRouter()
 
 #router.register(r'profile', UserProfileViewSet) # User profile endpoint
+router.register(r'conversations', ConversationViewSet, basename='conversation') # Chat threads
+
+# Under ASGI (uvicorn) serve the Gemini-backed endpoints from native async views
+if settings.AI_ASYNC_VIEWS:
+  eligibility_check_view = AsyncEligibilityCheckView.as_view()
+  eligibility_batch_view = AsyncEligibilityBatchView.as_view()
+  chatbot_view = AsyncChatbotView.as_view()
+  chatbot_stream_view = AsyncChatbotStreamView.as_view()
+  institution_overview_view = AsyncInstitutionOverviewView.as_view()
+else:
+  eligibility_check_view = EligibilityCheckAPIView.as_view()
+  eligibility_batch_view = EligibilityBatchAPIView.as_view()
+  chatbot_view = ChatbotAPIView.as_view()
+  chatbot_stream_view = ChatbotStreamAPIView.as_view()
+  institution_overview_view = InstitutionOverviewAPIView.as_view()
 
 urlpatterns = [
   path('', include(router.urls)),
 
   # AI Endpoints
-  path('eligibility-check/', EligibilityCheckAPIView.as_view(), name='eligibility-check'),
-  path('chatbot/', ChatbotAPIView.as_view(), name='chatbot'),
+  path('eligibility-check/', eligibility_check_view, name='eligibility-check'),
+  path('eligibility-check/batch/', eligibility_batch_view, name='eligibility-check-batch'),
+  path('eligibility-check/<uuid:pk>/', EligibilityCheckResultAPIView.as_view(), name='eligibility-check-result'),
+  path('chatbot/', chatbot_view, name='chatbot'),
+  path('chatbot/stream/', chatbot_stream_view, name='chatbot-stream'),
+  path('chatbot/cache-stats/', ChatbotCacheStatsAPIView.as_view(), name='chatbot-cache-stats'),
   path('chat_history/', ChatHistoryAPIView.as_view(), name='chat-history-api'),
-  path('institution-overview/', InstitutionOverviewAPIView.as_view(), name='institution-overview'),
+  path('conversations/<int:pk>/messages/', ConversationMessagesAPIView.as_view(), name='conversation-messages'),
+  path('institution-overview/', institution_overview_view, name='institution-overview'),
+  path('institution-overview/cache-stats/', InstitutionOverviewCacheStatsAPIView.as_view(), name='institution-overview-cache-stats'),
+  path('usage/top-consumers/', AIUsageTopConsumersAPIView.as_view(), name='ai-usage-top-consumers'),
 ]
 
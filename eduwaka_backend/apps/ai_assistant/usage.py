@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DailyUsage
+
+logger = logging.getLogger(__name__)
+
+COUNTERS = ("requests", "throttled", "prompt_tokens", "output_tokens")
+
+# The user the current request's LLM calls are billed to; set by the rate limit check
+_usage_user_id: ContextVar[int | None] = ContextVar("ai_usage_user_id", default=None)
+
+
+def set_usage_user(user_id: int | None) -> None:
+  _usage_user_id.set(user_id)
+
+
+class UsageRollup:
+  """
+  Daily per-user counters, kept in memory and added to the DailyUsage rows at
+  most every `flush_interval` seconds, so a request costs no extra writes.
+  Counts not yet flushed are lost if the worker dies.
+
+  add() never touches the database and is safe on the event loop;
+  flush_if_due() does, and callers run it from sync code.
+  """
+
+  def __init__(self, flush_interval: float, clock=time.monotonic):
+    self.flush_interval = flush_interval
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._pending: dict[tuple, dict[str, int]] = {}
+    self._last_flush = clock()
+
+  def add(self, user_id: int | None, **counts: int) -> None:
+    if user_id is None:
+      return
+    key = (user_id, timezone.localdate())
+    with self._lock:
+      pending = self._pending.setdefault(key, dict.fromkeys(COUNTERS, 0))
+      for name, value in counts.items():
+        pending[name] += value
+
+  def record_llm_usage(self, response) -> None:
+    """Bill an LLMResponse's token counts to the current request's user."""
+    self.add(_usage_user_id.get(), prompt_tokens=response.prompt_tokens, output_tokens=response.output_tokens)
+
+  def flush_if_due(self) -> None:
+    if self._clock() - self._last_flush >= self.flush_interval:
+      self.flush()
+
+  def flush(self) -> None:
+    with self._lock:
+      pending, self._pending = self._pending, {}
+      self._last_flush = self._clock()
+    for (user_id, day), counts in pending.items():
+      try:
+        self._add_to_row(user_id, day, counts)
+      except DatabaseError as e:
+        logger.warning(f"Could not store AI usage for user {user_id} on {day}: {e}")
+
+  def _add_to_row(self, user_id: int, day, counts: dict[str, int]) -> None:
+    increments = {name: F(name) + value for name, value in counts.items() if value}
+    if not increments:
+      return
+    rows = DailyUsage.objects.filter(user_id=user_id, day=day)
+    if rows.update(**increments):
+      return
+    try:
+      with transaction.atomic():
+        DailyUsage.objects.create(user_id=user_id, day=day, **counts)
+    except IntegrityError:
+      rows.update(**increments)  # another worker created it first
+
+  def pending(self) -> dict:
+    with self._lock:
+      return {key: dict(counts) for key, counts in self._pending.items()}
+
+
+usage_rollup = UsageRollup(flush_interval=settings.AI_USAGE_FLUSH_SECONDS)
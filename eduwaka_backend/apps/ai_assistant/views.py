@@ -1,31 +1,94 @@
-from rest_framework import permissions, status
-import google.generativeai as genai
+from rest_framework import permissions, status, viewsets
 from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import F, Sum
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag, urlsafe_base64_decode, urlsafe_base64_encode
+from rest_framework.exceptions import ValidationError
+import hashlib
 import json
-import re
+import logging
+import threading
+import uuid
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from datetime import datetime, timedelta
 
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from apps.ai_assistant.serializers import EligibilityCheckRequestSerializer, ChatbotRequestSerializer, InstitutionRequestSerializer
-from .models import ChatHistory
-
-# Configure Gemini API with the key using the settings settings
-genai.configure(api_key=settings.GEMINI_API_KEY)
-# Initialize the Gemini model for content generation
-model = genai.GenerativeModel("gemini-3.1-flash-lite-preview")
-
-# Institution Overview View
-class InstitutionOverviewAPIView(APIView):
-  permission_classes = [permissions.AllowAny]
+from apps.ai_assistant.serializers import EligibilityCheckRequestSerializer, EligibilityBatchRequestSerializer, ChatbotRequestSerializer, ConversationSerializer, InstitutionRequestSerializer, TopConsumersQuerySerializer
+from .models import ChatHistory, Conversation, DailyUsage, EligibilityCheck
+from .cache import eligibility_result_cache, institution_overview_cache
+from .singleflight import llm_singleflight, request_key
+from .llm import LLMResponse, check_finish_reason, estimate_tokens, get_llm_client
+from .resilience import LLMUnavailableError
+from .semantic_cache import semantic_answer_cache
+from .retrieval import catalog_retriever
+from . import eligibility, metrics
+from .intents import intent_router
+from .ratelimit import AIRateThrottle
+from .usage import usage_rollup
+from .history import HistoryCompactor, HistoryWindow, after_position, before_position, history_page, summary_query
+
+logger = logging.getLogger(__name__)
+
+# LLM backend (Gemini by default) selected by settings.AI_LLM_BACKEND, behind
+# timeouts, retries, a circuit breaker (see resilience.py) and a prioritised
+# concurrency limit (see limiter.py)
+llm = get_llm_client()
+
+# Background summarisation of long chat histories
+history_compactor = HistoryCompactor(
+  llm.with_priority("background", endpoint="chat_summary"),
+  trigger_tokens=settings.AI_CHAT_SUMMARY_TRIGGER_TOKENS,
+  keep_tokens=settings.AI_CHAT_SUMMARY_KEEP_TOKENS,
+  summary_max_tokens=settings.AI_CHAT_SUMMARY_MAX_TOKENS,
+)
+
+
+def _generate_checked_text(contents: list, generation_config: dict, priority: str, endpoint: str | None) -> str:
+  response = llm.generate(contents, generation_config, priority=priority, endpoint=endpoint)
+  usage_rollup.record_llm_usage(response)
+  check_finish_reason(response)
+  return response.text
+
+
+def generate_text_coalesced(contents: list, generation_config: dict, priority: str, endpoint: str | None = None) -> str:
+  """
+  Call the LLM and return the response text, sharing one upstream call between
+  concurrent identical requests (same prompt + generation config). `priority`
+  is the limiter class the call queues in (see limiter.PRIORITIES); `endpoint`
+  labels its metrics, the priority if not given.
+  """
+  key = request_key(llm.model_name, contents, generation_config)
+  return llm_singleflight.do(key, lambda: _generate_checked_text(contents, generation_config, priority, endpoint))
+
+
+def loads_model_json(text: str, endpoint: str):
+  """json.loads for a reply that was asked to be JSON; failures are counted per endpoint."""
+  try:
+    return json.loads(text)
+  except json.JSONDecodeError:
+    metrics.json_decode_failures.labels(endpoint).inc()
+    raise
+
+
+def retry_after_headers(error: LLMUnavailableError) -> dict:
+  """Retry-After for a 503, when the circuit breaker knows when it will let calls through."""
+  return {"Retry-After": str(error.retry_after)} if error.retry_after else {}
+
+# Institution overviews: prompt and output contract, shared with async_views
+OVERVIEW_GENERATION_CONFIG = {
+  "response_mime_type": "application/json",
+}
+OVERVIEW_UNAVAILABLE_DETAIL = "Institution overviews are temporarily unavailable. Please try again shortly."
 
-  def post(self, request, *args, **kwargs):
-    # Validate the incoming data using the serializer
-    serializer = InstitutionRequestSerializer(data=request.data)
-    serializer.is_valid(raise_exception=True)
-    institution_name = serializer.validated_data['institution_name']
 
-    # Detailed prompt for the Gemini model, requesting JSON output
-    prompt = f"""
+def build_overview_prompt(institution_name: str) -> str:
+  # Detailed prompt for the Gemini model, requesting JSON output
+  return f"""
     Provide a concise overview of the Nigerian institution named "{institution_name}".
     The overview should be structured as a JSON object with the following fields:
     - "name": The full name of the institution.
@@ -53,579 +116,843 @@ class InstitutionOverviewAPIView(APIView):
     }}
     """
 
+
+# Institution Overview View
+class InstitutionOverviewAPIView(APIView):
+  permission_classes = [permissions.AllowAny]
+  throttle_classes = [AIRateThrottle]
+
+  def post(self, request, *args, **kwargs):
+    # Validate the incoming data using the serializer
+    serializer = InstitutionRequestSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    institution_name = serializer.validated_data['institution_name']
+
+    # Serve from cache when possible; overviews rarely change
+    cached_data = institution_overview_cache.get(institution_name)
+    if cached_data is not None:
+      if "error" in cached_data:
+        # Known-bad name: answer the 404 without another Gemini round trip
+        return Response({"detail": cached_data["error"]}, status=status.HTTP_404_NOT_FOUND)
+      return Response(cached_data, status=status.HTTP_200_OK)
+
+    prompt = build_overview_prompt(institution_name)
+
     try:
       # Call Gemini API with the prompt
-      response = model.generate_content(
+      gemini_output_text = generate_text_coalesced(
         contents=[{"parts": [{"text": prompt}]}],
-        generation_config={
-          "response_mime_type": "application/json",
-        }
+        generation_config=OVERVIEW_GENERATION_CONFIG,
+        priority="overview",
       )
 
       # Parse the JSON response from the model
-      gemini_output_text = response.text
-      institution_data = json.loads(gemini_output_text)
+      institution_data = loads_model_json(gemini_output_text, "overview")
 
       # Check for a specific error from the AI model
       if "error" in institution_data:
+        institution_overview_cache.set_negative(institution_name, {"error": institution_data["error"]})
         return Response(
           {"detail": institution_data["error"]},
           status=status.HTTP_404_NOT_FOUND
         )
 
+      institution_overview_cache.set(institution_name, institution_data)
       return Response(institution_data, status=status.HTTP_200_OK)
 
     except json.JSONDecodeError:
-        print(f"Error decoding JSON from Gemini API: {response.text}")
+        logger.warning(f"Error decoding JSON from Gemini API: {gemini_output_text}")
         return Response(
             {"detail": "An unexpected error occurred while parsing the AI response."},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
+    except LLMUnavailableError as e:
+        # Gemini is down: an expired overview beats an error page
+        logger.warning(f"Gemini unavailable for institution overview: {e}")
+        stale_data = institution_overview_cache.get_stale(institution_name)
+        if stale_data is not None:
+          return Response({**stale_data, "stale": True}, status=status.HTTP_200_OK)
+        return Response({"detail": OVERVIEW_UNAVAILABLE_DETAIL}, status=status.HTTP_503_SERVICE_UNAVAILABLE, headers=retry_after_headers(e))
     except Exception as e:
-        print(f"Error calling Gemini API for institution overview: {e}")
+        logger.exception(f"Error calling Gemini API for institution overview: {e}")
         return Response(
             {"detail": f"An unexpected error occurred: {str(e)}"},
             status=status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
-#  Subjects that MUST appear as credits 
-COMPULSORY_SUBJECTS = {"english", "mathematics"}
-
-# Patterns used to normalise subject names coming from free-text O'Level strings
-SUBJECT_ALIASES = {
-    "english language": "english",
-    "eng": "english",
-    "maths": "mathematics",
-    "math": "mathematics",
-    "further maths": "further mathematics",
-    "further math": "further mathematics",
-    "lit in english": "literature in english",
-    "literature": "literature in english",
-    "agric": "agricultural science",
-    "agric science": "agricultural science",
-    "civic": "civic education",
-    "econs": "economics",
-    "govt": "government",
-    "phy": "physics",
-    "chem": "chemistry",
-    "bio": "biology",
-    "crk": "christian religious knowledge",
-    "irk": "islamic religious knowledge",
-    "c.r.k": "christian religious knowledge",
-    "i.r.k": "islamic religious knowledge",
-    "c.r.s": "christian religious studies",
-    "i.r.s": "islamic religious studies",
-    "ict": "information technology",
-    "comp": "computer science",
-    "td": "technical drawing",
-}
+# Institution overview cache stats (admin)
+class InstitutionOverviewCacheStatsAPIView(APIView):
+  permission_classes = [permissions.IsAdminUser]
 
-GRADE_PATTERN = re.compile(r'\b(A1|B2|B3|C4|C5|C6|D7|E8|F9)\b', re.IGNORECASE)
-CREDIT_GRADES = {"a1", "b2", "b3", "c4", "c5", "c6"}
+  def get(self, request, *args, **kwargs):
+    return Response(institution_overview_cache.stats(), status=status.HTTP_200_OK)
 
+class ChatbotCacheStatsAPIView(APIView):
+  permission_classes = [permissions.IsAdminUser]
 
-class EligibilityCheckAPIView(APIView):
-  permission_classes = [permissions.IsAuthenticated]
+  def get(self, request, *args, **kwargs):
+    return Response(
+      {"semantic_cache": semantic_answer_cache.stats(), "intent_router": intent_router.stats()},
+      status=status.HTTP_200_OK,
+    )
 
-  #  Helpers ─
-
-  def _normalise_subject(self, raw: str) -> str:
-    """Lower-case and resolve common aliases."""
-    cleaned = raw.strip().lower()
-    return SUBJECT_ALIASES.get(cleaned, cleaned)
-
-  def _parse_sitting(self, sitting_text: str) -> dict[str, str]:
-      """
-      Parse a free-text O'Level sitting into {normalised_subject: grade}.
-
-      Expects formats like:
-        "English Language: A1, Mathematics: B2, Physics: C4"
-        "English - A1 | Mathematics - B2"
-      Returns {} if nothing parseable is found.
-      """
-      results: dict[str, str] = {}
-      if not sitting_text:
-        return results
-
-      # Split on common delimiters: comma, semicolon, pipe, newline
-      entries = re.split(r'[,;\|\n]+', sitting_text)
-
-      for entry in entries:
-        entry = entry.strip()
-        if not entry:
-          continue
-
-        # Try "Subject: Grade" or "Subject - Grade" or "Subject Grade"
-        match = re.match(
-          r'^(.+?)[\s:\-–]+(' + '|'.join(GRADE_PATTERN.pattern[3:-3].split('|')) + r')\s*$',
-          entry,
-          re.IGNORECASE,
-        )
-        if match:
-          subject = self._normalise_subject(match.group(1))
-          grade = match.group(2).upper()
-          # Keep best grade if subject appears in both sittings (handled at combine step)
-          results[subject] = grade
-
-      return results
-
-  def _combine_sittings(
-      self,
-      sitting1: dict[str, str],
-      sitting2: dict[str, str],
-  ) -> dict[str, str]:
-      """
-      Merge two sittings; keep the best (highest) grade per subject so that
-      the same subject is never double-counted.
-      Grade ranking: A1 > B2 > B3 > C4 > C5 > C6 > D7 > E8 > F9
-      """
-      GRADE_RANK = {"A1": 1, "B2": 2, "B3": 3, "C4": 4, "C5": 5, "C6": 6, "D7": 7, "E8": 8, "F9": 9}
-      combined = dict(sitting1)
-      for subject, grade in sitting2.items():
-          if subject not in combined:
-              combined[subject] = grade
-          else:
-              # Lower rank number = better grade
-              if GRADE_RANK.get(grade, 99) < GRADE_RANK.get(combined[subject], 99):
-                  combined[subject] = grade
-      return combined
-
-  def _analyse_credits(
-      self,
-      sitting1_text: str,
-      sitting2_text: str,
-      use_two_sittings: bool,
-  ) -> dict:
-      """
-      Returns a structured credit report:
+# Heaviest AI users over the last few days (admin)
+class AIUsageTopConsumersAPIView(APIView):
+  """
+  GET ?days=7&order_by=output_tokens&limit=20, from the DailyUsage rollup.
+  Only this worker's unflushed counts are added first; other workers' appear
+  within AI_USAGE_FLUSH_SECONDS.
+  """
+  permission_classes = [permissions.IsAdminUser]
+  COUNTERS = ("requests", "throttled", "prompt_tokens", "output_tokens", "total_tokens")
+
+  def get(self, request, *args, **kwargs):
+    query = TopConsumersQuerySerializer(data=request.query_params)
+    query.is_valid(raise_exception=True)
+    days, order_by, limit = (query.validated_data[k] for k in ("days", "order_by", "limit"))
+
+    usage_rollup.flush()
+    until = timezone.localdate()
+    since = until - timedelta(days=days - 1)
+    # Summed under other names: an annotation may not shadow a model field
+    totals = {name: Sum(name) for name in self.COUNTERS[:-1]}
+    totals["total_tokens"] = Sum(F("prompt_tokens") + F("output_tokens"))
+    rows = (
+      DailyUsage.objects.filter(day__gte=since, day__lte=until)
+      .values("user_id", "user__username", "user__email")
+      .annotate(**{f"sum_{name}": total for name, total in totals.items()})
+      .order_by(f"-sum_{order_by}", "user_id")[:limit]
+    )
+    consumers = [
       {
-        "sitting1": {subject: grade},
-        "sitting2": {subject: grade},
-        "combined": {subject: grade},
-        "credit_subjects": [subject],       # subjects with credit grades
-        "total_credits": int,
-        "has_english": bool,
-        "has_mathematics": bool,
-        "has_compulsory": bool,
-        "has_min_credits": bool,            # ≥ 5 credits incl. English & Maths
-        "missing_compulsory": [subject],
-      }
-      """
-      s1 = self._parse_sitting(sitting1_text)
-      s2 = self._parse_sitting(sitting2_text) if use_two_sittings else {}
-      combined = self._combine_sittings(s1, s2)
-
-      credit_subjects = [subj for subj, grade in combined.items() if grade.lower() in CREDIT_GRADES]
-
-      has_english = "english" in credit_subjects
-      has_mathematics = "mathematics" in credit_subjects
-      missing_compulsory = [s for s in COMPULSORY_SUBJECTS if s not in credit_subjects]
-
-      total_credits = len(credit_subjects)
-      has_min_credits = total_credits >= 5 and has_english and has_mathematics
-
-      return {
-        "sitting1": s1,
-        "sitting2": s2,
-        "combined": combined,
-        "credit_subjects": credit_subjects,
-        "total_credits": total_credits,
-        "has_english": has_english,
-        "has_mathematics": has_mathematics,
-        "has_compulsory": has_english and has_mathematics,
-        "has_min_credits": has_min_credits,
-        "missing_compulsory": missing_compulsory,
+        "user_id": row["user_id"],
+        "username": row["user__username"],
+        "email": row["user__email"],
+        **{name: row[f"sum_{name}"] for name in self.COUNTERS},
       }
+      for row in rows
+    ]
+    return Response(
+      {"since": since, "until": until, "order_by": order_by, "consumers": consumers},
+      status=status.HTTP_200_OK,
+    )
 
-  #  Prompt builder 
-  def _build_prompt(
-      self,
-      *,
-      institution_name: str,
-      desired_course: str,
-      o_level_sittings: int,
-      o_level_results_combined: str,
-      jamb_score: int,
-      jamb_subjects: str,
-      credit_report: dict,
-  ) -> str:
-      # Pre-compute human-readable summaries so the model has less to infer
-      credit_list = ", ".join(credit_report["credit_subjects"]) or "None detected"
-      missing_compulsory = (
-        ", ".join(credit_report["missing_compulsory"]).title()
-        if credit_report["missing_compulsory"]
-        else "None"
-      )
-      flags = []
-      if not credit_report["has_min_credits"]:
-        flags.append(
-          f"INSUFFICIENT O'LEVEL CREDITS: student has {credit_report['total_credits']} credit(s) "
-          f"(need ≥5 including English and Mathematics). "
-          f"Missing compulsory subjects with credit grade: {missing_compulsory}."
-        )
-      if jamb_score < 180:
-        flags.append(
-          f"INSUFFICIENT JAMB SCORE: {jamb_score} is below the 180 minimum. "
-          "Status must be 'fixable' and suggested_courses must be empty."
-        )
-      flags_block = "\n".join(f"  ⚠ {f}" for f in flags) if flags else "  ✓ O'Level credits and JAMB score meet baseline requirements."
-
-      return f"""
-        You are a Nigerian university admissions eligibility advisor (JAMB/WAEC system).
-        Your job is to evaluate whether a student can gain admission to their desired course
-        and institution, and to give actionable, specific guidance.
-
-        ================
-        ADMISSION RULES
-        ================
-        1. O'Level: minimum 5 credits (A1–C6), MUST include English Language and Mathematics.
-        2. O'Level sittings: maximum {o_level_sittings} sitting(s) are accepted by this institution.
-        3. JAMB: minimum score of 180; competitive courses (Medicine, Law, Engineering) typically
-          require 200+.
-        4. JAMB subjects must match the standard combination for the desired course.
-        5. If a subject appears in both sittings, only the BEST grade counts (no double-counting).
-
-        ================
-        PRE-COMPUTED FLAGS (treat these as ground truth)
-        ================
-        {flags_block}
-
-        Detected credit subjects: {credit_list}
-        Total unique credits: {credit_report['total_credits']}
-
-        ================
-        STUDENT PROFILE
-        ================
-        Institution  : {institution_name}
-        Desired Course: {desired_course}
-
-        O'Level Results ({o_level_sittings} sitting(s)):
-        {o_level_results_combined}
-
-        JAMB Score   : {jamb_score}
-        JAMB Subjects: {jamb_subjects}
-
-        ================
-        EVALUATION INSTRUCTIONS
-        ================
-        Step 1 — Determine eligibility_status:
-          • "eligible"   → credits ≥ 5 (incl. English & Maths) AND JAMB ≥ 180
-                          AND JAMB subjects match the course.
-          • "fixable"    → one or more issues exist but can be resolved by retaking
-                          exams or adjusting subjects.
-          • "not_viable" → issues that cannot realistically be fixed (e.g., age limit,
-                          course not offered at institution).
-
-        Step 2 — Populate reasons[]:
-          List every specific reason the student is or isn't eligible.
-          Reference actual subjects and scores. Be concrete, not generic.
-
-        Step 3 — Populate missing_requirements[]:
-          List only items the student still needs (e.g., "Credit in Mathematics",
-          "JAMB score of at least 180"). Leave empty if fully eligible.
-
-        Step 4 — Populate recommended_actions[]:
-          Give specific, numbered, actionable steps the student should take.
-          Always present even if eligible (e.g., "Apply before deadline", "Check
-          post-UTME cut-off for {institution_name}").
-
-        Step 5 — Populate suggested_courses[]:
-          ONLY populate if credits ≥ 5 AND JAMB ≥ 180.
-          Suggest 2–4 related courses at the same institution that the student's
-          current profile supports. Leave as [] otherwise.
-
-        Step 6 — JAMB subject check:
-          Compare the student's JAMB subjects against the standard Nigerian JAMB
-          combination for "{desired_course}". Flag any mismatch clearly in reasons[].
-
-        ================
-        HARD CONSTRAINTS (never violate these)
-        ================
-        - If pre-computed flags show INSUFFICIENT credits or INSUFFICIENT JAMB:
-            - eligibility_status MUST be "fixable"
-            - is_eligible MUST be false
-            - suggested_courses MUST be []
-        - Never invent grades or subjects not present in the student's data.
-        - Do not use generic advice — reference the student's actual subjects and score.
-
-        ================
-        OUTPUT — return ONLY valid JSON, no markdown, no explanation
-        ================
-        {{
-          "eligibility_status": "eligible" | "fixable" | "not_viable",
-          "is_eligible": boolean,
-          "reasons": string[],
-          "missing_requirements": string[],
-          "recommended_actions": string[],
-          "suggested_courses": string[],
-          "o_level_credits_required": 5,
-          "o_level_sittings_accepted": {o_level_sittings},
-          "jamb_subject_match": boolean,
-          "jamb_subject_issues": string[]
-        }}
-      """
+# Eligibility checks that outlive their request deadline finish here
+eligibility_background = ThreadPoolExecutor(max_workers=32, thread_name_prefix="eligibility")
+
+
+class EligibilityCheckAPIView(APIView):
+  permission_classes = [permissions.IsAuthenticated]
+  throttle_classes = [AIRateThrottle]
+
+  DEADLINE = settings.ELIGIBILITY_DEADLINE  # seconds to wait for Gemini before answering partially
+  METRICS_ENDPOINT = "eligibility"
+
+  #  Evaluation 
+  def _lookup_jamb_requirements(self, institution_name: str, desired_course: str) -> str | None:
+    return eligibility.course_requirements_query(institution_name, desired_course).first()
+
+  def _evaluate_locally(self, prepared: dict) -> dict | None:
+    """The result when it needs no Gemini call: rules-only fast path, then the result cache."""
+    # Clearly under-qualified: the outcome is fixed by rules, skip the LLM
+    if not prepared["needs_llm"]:
+      jamb_requirements = self._lookup_jamb_requirements(prepared["institution_name"], prepared["desired_course"])
+      return eligibility.build_local_result(prepared, jamb_requirements)
+
+    # Identical submissions (after normalisation) reuse the final result
+    return eligibility_result_cache.get(prepared["cache_key"])
+
+  def _evaluate(self, prepared: dict) -> dict:
+    """
+    Final result for one prepared target: rules-only fast path, then the
+    result cache, then Gemini. Raises on AI failures (see eligibility.error_detail).
+    """
+    result = self._evaluate_locally(prepared)
+    return result if result is not None else self._evaluate_with_llm(prepared)
+
+  def _evaluate_with_llm(self, prepared: dict) -> dict:
+    """Gemini's verdict, with the hard rules enforced on top; cached for identical submissions."""
+    response_text = generate_text_coalesced(
+      contents=[{"parts": [{"text": prepared["prompt"]}]}],
+      generation_config=eligibility.ELIGIBILITY_GENERATION_CONFIG,
+      priority="eligibility",
+      endpoint=self.METRICS_ENDPOINT,
+    )
+    result = loads_model_json(response_text, self.METRICS_ENDPOINT)
+
+    result = eligibility.enforce(result, prepared["credit_report"], prepared["jamb_score"])
+    eligibility_result_cache.set(prepared["cache_key"], prepared["course_key"], result)
+    return result
+
+  #  Request deadline 
+  def _evaluate_in_background(self, prepared: dict, check_id, user_id: int, handoff: dict) -> dict:
+    """
+    _evaluate_with_llm on the background pool. If the request has already
+    answered partially (handoff["missed"]), the outcome goes to the EligibilityCheck row.
+    """
+    try:
+      result, error = self._evaluate_with_llm(prepared), None
+    except Exception as e:
+      result, error = None, e
+
+    with handoff["lock"]:
+      handoff["done"] = True
+      missed = handoff["missed"]
+    try:
+      if missed:
+        eligibility.store_check(check_id, user_id, result, error)
+    finally:
+      connections.close_all()
+    if error is not None:
+      raise error
+    return result
+
+  def _evaluate_within_deadline(self, user, prepared: dict) -> dict:
+    """
+    Gemini's result if it arrives within DEADLINE seconds. Otherwise the
+    partial result, while the evaluation finishes in the background and is
+    stored for GET eligibility-check/<result_id>/.
+    """
+    if self.DEADLINE <= 0:
+      return self._evaluate_with_llm(prepared)
+
+    check_id = uuid.uuid4()
+    handoff = {"lock": threading.Lock(), "done": False, "missed": False}
+    # copy_context: the model's tokens are still billed to this request's user
+    future = eligibility_background.submit(
+      copy_context().run, self._evaluate_in_background, prepared, check_id, user.pk, handoff,
+    )
+    try:
+      return future.result(timeout=self.DEADLINE)
+    except FutureTimeoutError:
+      pass
+
+    with handoff["lock"]:
+      handoff["missed"] = not handoff["done"]
+    if not handoff["missed"]:
+      return future.result()  # finished just as the deadline passed
+
+    # The background thread may store its outcome first; its row wins
+    check, _ = EligibilityCheck.objects.get_or_create(pk=check_id, defaults={"user": user})
+    if check.status == "complete":
+      return check.result
+    jamb_requirements = self._lookup_jamb_requirements(prepared["institution_name"], prepared["desired_course"])
+    return eligibility.build_partial_result(prepared, check_id, jamb_requirements)
 
   #  Main handler 
   def post(self, request, *args, **kwargs):
-      serializer = EligibilityCheckRequestSerializer(data=request.data)
-      serializer.is_valid(raise_exception=True)
-      data = serializer.validated_data
-
-      institution_name  = data["institution_name"]
-      desired_course    = data["desired_course"]
-      o_level_sittings  = int(data["o_level_sittings"])   # normalise to int
-      sitting1_text     = data["o_level_sitting_1"]
-      sitting2_text     = data.get("o_level_sitting_2", "") or ""
-      jamb_score        = int(data["jamb_score"])
-      raw_jamb_subjects = data["jamb_subjects"]
-
-      # Normalise JAMB subjects to clean comma-separated string
-      if isinstance(raw_jamb_subjects, list):
-          jamb_subjects = ", ".join(s.strip() for s in raw_jamb_subjects if s.strip())
-      else:
-          jamb_subjects = ", ".join(s.strip() for s in raw_jamb_subjects.split(",") if s.strip())
-
-      use_two_sittings = o_level_sittings == 2 and bool(sitting2_text)
-
-      #  Deterministic credit analysis (source of truth) ─
-      credit_report = self._analyse_credits(sitting1_text, sitting2_text, use_two_sittings)
-      has_min_credits = credit_report["has_min_credits"]
-      has_valid_jamb  = jamb_score >= 180
-
-      #  Build O'Level display block for prompt 
-      o_level_display = f"1st Sitting: {sitting1_text}"
-      if use_two_sittings:
-          o_level_display += f"\n2nd Sitting: {sitting2_text}"
-
-      #  Build prompt 
-      prompt = self._build_prompt(
-          institution_name=institution_name,
-          desired_course=desired_course,
-          o_level_sittings=o_level_sittings,
-          o_level_results_combined=o_level_display,
-          jamb_score=jamb_score,
-          jamb_subjects=jamb_subjects,
-          credit_report=credit_report,
+    serializer = EligibilityCheckRequestSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    prepared = eligibility.prepare(serializer.validated_data)
+
+    try:
+      result = self._evaluate_locally(prepared)
+      if result is None:
+        result = self._evaluate_within_deadline(request.user, prepared)
+    except LLMUnavailableError as e:
+      # Gemini is down: what the rules decide beats an error page
+      logger.warning(f"Gemini unavailable for eligibility check: {e}")
+      jamb_requirements = self._lookup_jamb_requirements(prepared["institution_name"], prepared["desired_course"])
+      return Response(eligibility.build_partial_result(prepared, None, jamb_requirements), status=status.HTTP_200_OK)
+    except Exception as e:
+      return Response(
+        {"detail": eligibility.error_detail(e)},
+        status=status.HTTP_502_BAD_GATEWAY,
       )
 
-      #  Call Gemini ─
-      try:
-          response = model.generate_content(
-              contents=[{"parts": [{"text": prompt}]}],
-              generation_config={
-                  "response_mime_type": "application/json",
-                  "response_schema": {
-                      "type": "OBJECT",
-                      "properties": {
-                          "eligibility_status":       {"type": "STRING"},
-                          "is_eligible":              {"type": "BOOLEAN"},
-                          "reasons":                  {"type": "ARRAY", "items": {"type": "STRING"}},
-                          "missing_requirements":     {"type": "ARRAY", "items": {"type": "STRING"}},
-                          "recommended_actions":      {"type": "ARRAY", "items": {"type": "STRING"}},
-                          "suggested_courses":        {"type": "ARRAY", "items": {"type": "STRING"}},
-                          "o_level_credits_required": {"type": "NUMBER"},
-                          "o_level_sittings_accepted":{"type": "NUMBER"},
-                          "jamb_subject_match":       {"type": "BOOLEAN"},
-                          "jamb_subject_issues":      {"type": "ARRAY", "items": {"type": "STRING"}},
-                      },
-                      "required": [
-                          "eligibility_status", "is_eligible", "reasons",
-                          "missing_requirements", "recommended_actions",
-                          "suggested_courses", "jamb_subject_match", "jamb_subject_issues",
-                      ],
-                  },
-              },
-          )
+    return Response(result, status=status.HTTP_200_OK)
 
-          result = json.loads(response.text)
 
-      except json.JSONDecodeError as e:
-          return Response(
-              {"detail": f"AI returned malformed JSON: {e}"},
-              status=status.HTTP_502_BAD_GATEWAY,
-          )
-      except Exception as e:
-          return Response(
-              {"detail": f"AI service error: {e}"},
-              status=status.HTTP_502_BAD_GATEWAY,
-          )
+class EligibilityCheckResultAPIView(APIView):
+  """
+  GET eligibility-check/<id>/: the full result of a check that was answered
+  partially (see EligibilityCheckAPIView.DEADLINE). Poll until the status
+  is no longer "pending".
+  """
+  permission_classes = [permissions.IsAuthenticated]
 
-      #  Hard enforcement — override anything the AI got wrong ─
-      actions: list[str] = list(result.get("recommended_actions") or [])
-      missing: list[str] = list(result.get("missing_requirements") or [])
+  PENDING_TIMEOUT = timedelta(minutes=5)  # longer than any evaluation; its worker has gone away
 
-      if not has_min_credits:
-          credits_have = credit_report["total_credits"]
-          missing_comp = credit_report["missing_compulsory"]
+  def get(self, request, pk, *args, **kwargs):
+    check = get_object_or_404(EligibilityCheck, pk=pk, user=request.user)
+    body = {"id": str(check.pk), "status": check.status}
 
-          missing_items = [f"At least 5 O'Level credits including English and Mathematics (you have {credits_have})"]
-          if missing_comp:
-              missing_items.append(f"Credit grade in: {', '.join(s.title() for s in missing_comp)}")
+    if check.status == "pending" and check.created_at < timezone.now() - self.PENDING_TIMEOUT:
+      body.update(status="failed", detail="The eligibility check did not finish. Please submit it again.")
+    elif check.status == "complete":
+      body["result"] = check.result
+    elif check.status == "failed":
+      body["detail"] = check.error
 
-          missing = list(set(missing + missing_items))
-          actions.append(
-              f"Retake WAEC/NECO to obtain at least 5 credits (A1–C6) including English and Mathematics. "
-              f"You currently have {credits_have} valid credit(s)."
-              + (f" You are missing a credit in: {', '.join(s.title() for s in missing_comp)}." if missing_comp else "")
-          )
+    return Response(body, status=status.HTTP_200_OK)
 
-      if not has_valid_jamb:
-          missing.append(f"JAMB score of at least 180 (you scored {jamb_score})")
-          actions.append(
-              f"Rewrite JAMB. Your current score of {jamb_score} is below the minimum of 180. "
-              "Competitive courses like Medicine or Engineering require 200+."
-          )
 
-      if not (has_min_credits and has_valid_jamb):
-          result["eligibility_status"] = "fixable"
-          result["is_eligible"]        = False
-          result["suggested_courses"]  = []   # final hard clear — no courses if not qualified
+# Multi-target Eligibility Check View
+class EligibilityBatchAPIView(EligibilityCheckAPIView):
+  """
+  One student profile checked against several institution/course targets.
 
-      # Deduplicate & write back
-      result["recommended_actions"]  = list(dict.fromkeys(actions))   # preserves order, removes dupes
-      result["missing_requirements"] = list(dict.fromkeys(missing))
+  The credit analysis runs once; duplicate targets are checked once; the
+  remaining targets fan out over a bounded thread pool. Targets still running
+  at the batch deadline are reported as "timeout" without failing the rest.
+  """
 
-      # Guarantee all array fields exist
-      for field in ("reasons", "jamb_subject_issues"):
-          result.setdefault(field, [])
+  METRICS_ENDPOINT = "eligibility_batch"
 
-      return Response(result, status=status.HTTP_200_OK)
-        
-# Chatbot View
-class ChatbotAPIView(APIView):
-  permission_classes = [permissions.IsAuthenticated]
+  def _evaluate_in_thread(self, prepared: dict) -> dict:
+    try:
+      return self._evaluate(prepared)
+    finally:
+      # Pool threads open their own DB connections; don't leak them
+      connections.close_all()
 
-  MAX_HISTORY_TURNS = 20      # max messages sent to Gemini (keep even so pairs stay intact)
-  MAX_MESSAGE_LENGTH = 2000   # characters
+  def post(self, request, *args, **kwargs):
+    serializer = EligibilityBatchRequestSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    profile = eligibility.analyse_profile(data)
+    targets = eligibility.dedupe_targets(data["targets"])
+    prepared = [eligibility.prepare_target(profile, t["institution_name"], t["desired_course"]) for t in targets]
 
-  SYSTEM_INSTRUCTION = (
-    "You are an AI assistant specialized in Nigerian university admissions. "
-    "Your sole purpose is to provide information and guidance related to the admission processes "
-    "of universities and other tertiary institutions in Nigeria. "
-    "Do not engage in conversations outside of this topic. If a user asks about something else, "
-    "politely state that you can only assist with Nigerian admission-related questions."
-    "\n\n**IMPORTANT: Format your response using Markdown for easy readability.**"
+    executor = ThreadPoolExecutor(
+      max_workers=min(len(prepared), settings.ELIGIBILITY_BATCH_MAX_WORKERS),
+      thread_name_prefix="eligibility-batch",
+    )
+    try:
+      futures = [executor.submit(copy_context().run, self._evaluate_in_thread, p) for p in prepared]
+      done, _ = wait(futures, timeout=settings.ELIGIBILITY_BATCH_DEADLINE)
+    finally:
+      # Never block the response on stragglers; they finish (and fill the cache) in the background
+      executor.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    for target, future in zip(targets, futures):
+      if future not in done:
+        results.append(eligibility.target_result(target, "timeout", detail="Eligibility check did not finish before the batch deadline."))
+      elif future.exception() is not None:
+        results.append(eligibility.target_result(target, "error", detail=eligibility.error_detail(future.exception())))
+      else:
+        results.append(eligibility.target_result(target, "ok", result=future.result()))
+
+    return Response(
+      {
+        "results": results,
+        "deadline_exceeded": len(done) < len(futures),
+      },
+      status=status.HTTP_200_OK,
+    )
+
+# Chat turns: helpers shared by the sync and async chatbot views
+CHAT_HISTORY_BATCH_SIZE = 20     # rows per history query; most chats fit in the first
+CHAT_MAX_HISTORY_MESSAGES = 100  # hard cap on messages sent to Gemini, whatever the budget
+CHAT_MAX_MESSAGE_LENGTH = 2000   # characters
+
+CHAT_SYSTEM_INSTRUCTION = (
+  "You are an AI assistant specialized in Nigerian university admissions. "
+  "Your sole purpose is to provide information and guidance related to the admission processes "
+  "of universities and other tertiary institutions in Nigeria. "
+  "Do not engage in conversations outside of this topic. If a user asks about something else, "
+  "politely state that you can only assist with Nigerian admission-related questions."
+  "\n\n**IMPORTANT: Format your response using Markdown for easy readability.**"
+)
+
+CHAT_ERROR_MAP = {
+  "unexpected keyword argument 'system_instruction'": (
+    "We're having trouble with our AI assistant. Please try your message again."
+  ),
+  "400 please use a valid role": (
+    "There was an issue with the conversation format. Let's start fresh!"
+  ),
+  "connection refused": (
+    "It looks like the server is busy. Please give it a minute and try again."
+  ),
+  "invalid request": (
+    "Sorry, I can't process that request. Could you rephrase your question?"
+  ),
+  "response was blocked": (
+    "I'm unable to respond to that message. Please rephrase or ask something else."
+  ),
+  "temporarily unavailable": (
+    "Our AI assistant is temporarily unavailable. Please try again in a minute."
+  ),
+  "timed out": (
+    "Our AI assistant is taking too long to respond. Please try again in a minute."
+  ),
+}
+
+
+def chat_error_message(error: Exception) -> str:
+  lowered = str(error).lower()
+  for key, message in CHAT_ERROR_MAP.items():
+    if key in lowered:
+      return message
+  return "An unexpected error occurred. Please try again later."
+
+
+def extract_chat_message(data) -> tuple[str | None, int | None, str | None]:
+  """Returns (latest_user_message, conversation_id, None) or (None, None, error detail)."""
+  serializer = ChatbotRequestSerializer(data=data)
+  serializer.is_valid(raise_exception=True)
+
+  # The new message, from either the compact or the legacy payload
+  latest_user_message = serializer.validated_data['message']
+
+  # Guard: message length
+  if len(latest_user_message) > CHAT_MAX_MESSAGE_LENGTH:
+    return None, None, f"Message is too long. Please keep it under {CHAT_MAX_MESSAGE_LENGTH} characters."
+
+  return latest_user_message, serializer.validated_data.get('conversation_id'), None
+
+
+#  Threads 
+def conversation_error(conversation) -> tuple[str, int] | None:
+  """(detail, status) if the requested thread can't take a new message."""
+  if conversation is None:
+    return "Conversation not found.", status.HTTP_404_NOT_FOUND
+  if conversation.is_archived:
+    return "This conversation is archived. Unarchive it to continue.", status.HTTP_400_BAD_REQUEST
+  return None
+
+
+def new_conversation_title(message: str) -> str:
+  return " ".join(message.split())[:80]
+
+
+def finish_turn(user_message_obj, reply: str, output_tokens: int) -> None:
+  """Persist the turn, bump the thread and queue compaction."""
+  reply_obj = ChatHistory(
+    user_id=user_message_obj.user_id,
+    conversation_id=user_message_obj.conversation_id,
+    role='model',
+    message=reply,
+    token_count=output_tokens,
   )
+  # Both messages or neither; bulk_create inserts them in order in one statement
+  with transaction.atomic():
+    if user_message_obj.pk is None:
+      user_message_obj.token_count = estimate_tokens(user_message_obj.message)  # bulk_create skips save()
+      ChatHistory.objects.bulk_create([user_message_obj, reply_obj])
+    else:
+      reply_obj.save()
+    Conversation.objects.filter(pk=user_message_obj.conversation_id).update(updated_at=timezone.now())
+  history_compactor.schedule(user_message_obj.conversation_id)
+
+
+#  Gemini contents 
+def chat_history_window() -> HistoryWindow:
+  return HistoryWindow(settings.AI_CHAT_HISTORY_TOKEN_BUDGET, CHAT_MAX_HISTORY_MESSAGES, CHAT_HISTORY_BATCH_SIZE)
+
+
+def format_chat_contents(history: list[tuple[str, str]], summary: str | None = None) -> list[dict]:
+  """history: (role, message) rows from HistoryWindow.history(), newest first."""
+  # Build Gemini-format history
+  gemini_chat_history = [
+    {
+      "role": "model" if role == "bot" else role,
+      "parts": [{"text": message}],
+    }
+    for role, message in reversed(history)
+  ]
+
+  # Older turns, compacted by HistoryCompactor
+  summary_turns = [
+    {"role": "user",  "parts": [{"text": f"Summary of our conversation so far:\n{summary}"}]},
+    {"role": "model", "parts": [{"text": "Thanks, I'll keep that in mind."}]},
+  ] if summary else []
+
+  # Inject system instruction as fake user/model turn
+  return [
+    {"role": "user",  "parts": [{"text": CHAT_SYSTEM_INSTRUCTION}]},
+    {"role": "model", "parts": [{"text": "Understood. I will only assist with Nigerian university admissions."}]},
+  ] + summary_turns + gemini_chat_history
+
+
+#  Semantic answer cache 
+def _cacheable_question(full_contents: list[dict]) -> str | None:
+  """The new message if it opens the conversation; only then does the reply not depend on context."""
+  if len(full_contents) == 3:  # system instruction pair + the question
+    return full_contents[-1]["parts"][0]["text"]
+  return None
+
+
+def _cached_reply(full_contents: list[dict]) -> str | None:
+  question = _cacheable_question(full_contents)
+  return semantic_answer_cache.get(question) if question else None
+
+
+def remember_reply(full_contents: list[dict], reply: str) -> None:
+  question = _cacheable_question(full_contents)
+  if question:
+    semantic_answer_cache.set(question, reply)
+
+
+def local_reply(full_contents: list[dict]) -> str | None:
+  """A reply that needs no Gemini call: a catalog lookup, else a cached answer."""
+  return intent_router.answer(full_contents[-1]["parts"][-1]["text"]) or _cached_reply(full_contents)
+
+
+CHAT_DEGRADED_NOTE = (
+  "_Our AI assistant is temporarily unavailable, so this answer comes from saved replies "
+  "and the EduWaka catalog. Please ask again in a few minutes for a full answer._"
+)
+
+
+def degraded_reply(full_contents: list[dict]) -> str | None:
+  """
+  The best reply without Gemini, for when it is unavailable: a cached answer to
+  a similar question (even mid-conversation), else the matching catalog rows.
+  None when neither has anything.
+  """
+  question = full_contents[-1]["parts"][-1]["text"]
+  reply = semantic_answer_cache.get(question)
+  if reply is None:
+    try:
+      block = catalog_retriever.context_block(question)
+    except DatabaseError as e:
+      logger.warning(f"Catalog retrieval failed, no degraded reply: {e}")
+      return None
+    if not block:
+      return None
+    entries = block.split("\n")[1:]  # drop the model-facing intro
+    reply = "Here is what the EduWaka catalog has on that:\n" + "\n".join(entries)
+  return f"{reply}\n\n{CHAT_DEGRADED_NOTE}"
+
+
+#  Catalog grounding 
+def grounded_contents(full_contents: list[dict]) -> list[dict]:
+  """Catalog rows matching the new message, added to it as an extra leading part."""
+  message = full_contents[-1]
+  try:
+    block = catalog_retriever.context_block(message["parts"][-1]["text"])
+  except DatabaseError as e:
+    logger.warning(f"Catalog retrieval failed, answering without it: {e}")
+    return full_contents
+  if not block:
+    return full_contents
+  return full_contents[:-1] + [{"role": message["role"], "parts": [{"text": block}] + message["parts"]}]
+
+
+#  Server-Sent Events 
+def sse_event(event: str, data: dict) -> str:
+  return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events) -> StreamingHttpResponse:
+  """events: a sync or async iterator of sse_event() strings."""
+  response = StreamingHttpResponse(events, content_type="text/event-stream")
+  response["Cache-Control"] = "no-cache"
+  response["X-Accel-Buffering"] = "no"  # stop proxies buffering the stream
+  return response
 
-  ERROR_MAP = {
-    "unexpected keyword argument 'system_instruction'": (
-        "We're having trouble with our AI assistant. Please try your message again."
-    ),
-    "400 please use a valid role": (
-        "There was an issue with the conversation format. Let's start fresh!"
-    ),
-    "connection refused": (
-        "It looks like the server is busy. Please give it a minute and try again."
-    ),
-    "invalid request": (
-        "Sorry, I can't process that request. Could you rephrase your question?"
-    ),
-    "response was blocked": (
-        "I'm unable to respond to that message. Please rephrase or ask something else."
-    ),
-  }
-
-  def _get_user_friendly_error(self, error: Exception) -> str:
-    lowered = str(error).lower()
-    for key, message in self.ERROR_MAP.items():
-      if key in lowered:
-        return message
-    return "An unexpected error occurred. Please try again later."
 
-  def post(self, request, *args, **kwargs):
-    serializer = ChatbotRequestSerializer(data=request.data)
-    serializer.is_valid(raise_exception=True)
+# Chatbot View
+class ChatbotAPIView(APIView):
+  permission_classes = [permissions.IsAuthenticated]
+  throttle_classes = [AIRateThrottle]
 
-    # Extract and validate the latest user message from the frontend payload
-    latest_user_message = serializer.validated_data['chat_history'][-1]['parts'][0]['text']
+  WRITE_BEHIND = settings.AI_CHAT_WRITE_BEHIND  # store the user message with the reply, in one insert
 
-    # Guard: message length
-    if len(latest_user_message) > self.MAX_MESSAGE_LENGTH:
-      return Response(
-        {"detail": f"Message is too long. Please keep it under {self.MAX_MESSAGE_LENGTH} characters."},
-        status=status.HTTP_400_BAD_REQUEST,
-      )
+  def _resolve_conversation(self, user, conversation_id: int | None, message: str):
+    """
+    The thread this turn belongs to: the requested one, else the user's most
+    recently active thread, else a new one. Returns (conversation, None) or
+    (None, error Response).
+    """
+    if conversation_id is not None:
+      conversation = Conversation.objects.filter(pk=conversation_id, user=user).first()
+      error = conversation_error(conversation)
+      if error:
+        return None, Response({"detail": error[0]}, status=error[1])
+      return conversation, None
+
+    conversation = Conversation.objects.filter(user=user, is_archived=False).first()
+    if conversation is None:
+      conversation = Conversation.objects.create(user=user, title=new_conversation_title(message))
+    return conversation, None
+
+  def _start_turn(self, request):
+    """
+    Validate the payload and prepare the user's message. With WRITE_BEHIND the
+    message stays unsaved until finish_turn; otherwise it is saved here.
+    Returns (user_message_obj, gemini_contents) or (None, error Response).
+    """
+    latest_user_message, conversation_id, error_detail = extract_chat_message(request.data)
+    if error_detail:
+      return None, Response({"detail": error_detail}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Save the user's message to the database
-    user_message_obj = ChatHistory.objects.create(
+    conversation, error_response = self._resolve_conversation(request.user, conversation_id, latest_user_message)
+    if error_response:
+      return None, error_response
+
+    user_message_obj = ChatHistory(
       user=request.user,
+      conversation=conversation,
       role='user',
       message=latest_user_message,
     )
+    if self.WRITE_BEHIND:
+      return user_message_obj, self._build_contents(conversation.id, unsaved=user_message_obj)
 
-    # Fetch history from DB (source of truth), limited to avoid context window overflow
-    chat_objects = list(
-      ChatHistory.objects.filter(user=request.user)
-      .order_by('timestamp')
-    )
-    # Trim to last MAX_HISTORY_TURNS messages, keeping turn pairs intact
-    if len(chat_objects) > self.MAX_HISTORY_TURNS:
-      chat_objects = chat_objects[-self.MAX_HISTORY_TURNS:]
+    # Save the user's message to the database
+    user_message_obj.save()
+    return user_message_obj, self._build_contents(conversation.id)
 
-    # Build Gemini-format history
-    gemini_chat_history = [
-      {
-        "role": "model" if obj.role == "bot" else obj.role,
-        "parts": [{"text": obj.message}],
-      }
-      for obj in chat_objects
-    ]
+  def _abandon_turn(self, user_message_obj) -> None:
+    """Roll back the user message so history stays consistent (a no-op if it was never saved)."""
+    if user_message_obj.pk is not None:
+      user_message_obj.delete()
 
-    # Inject system instruction as fake user/model turn
-    system_instruction_text = (
-        "You are an AI assistant specialized in Nigerian university admissions. "
-        "Your sole purpose is to provide information and guidance related to the admission processes "
-        "of universities and other tertiary institutions in Nigeria. "
-        "Do not engage in conversations outside of this topic. If a user asks about something else, "
-        "politely state that you can only assist with Nigerian admission-related questions."
-        "\n\n**IMPORTANT: Format your response using Markdown for easy readability.**"
-    )
-    full_contents = [
-        {"role": "user",  "parts": [{"text": system_instruction_text}]},
-        {"role": "model", "parts": [{"text": "Understood. I will only assist with Nigerian university admissions."}]},
-    ] + gemini_chat_history
+  def _build_contents(self, conversation_id: int, unsaved=None) -> list[dict]:
+    """unsaved: the write-behind user message, not in the database yet."""
+    # Messages covered by the rolling summary are sent as the summary instead
+    summary = summary_query(conversation_id).first()
+    after = (summary[1], summary[2]) if summary else None
+
+    # Fetch history from DB (source of truth), newest first, until the token budget is spent
+    window = chat_history_window()
+    if unsaved is not None:
+      window.add_unsaved(unsaved.role, unsaved.message)
+    while window.wants_more():
+      window.feed(list(history_page(conversation_id, batch_size=CHAT_HISTORY_BATCH_SIZE, before=window.before, after=after)))
+    return format_chat_contents(window.history(), summary[0] if summary else None)
+
+  def _generate_reply(self, full_contents: list[dict]) -> tuple[str, int]:
+    """(reply, output tokens), answered locally or by Gemini."""
+    local = local_reply(full_contents)
+    if local is not None:
+      return local, estimate_tokens(local)
+
+    response = llm.generate(grounded_contents(full_contents), priority="chat")
+    usage_rollup.record_llm_usage(response)
+    check_finish_reason(response)
+    remember_reply(full_contents, response.text)
+    return response.text, response.output_tokens
+
+  def post(self, request, *args, **kwargs):
+    user_message_obj, full_contents = self._start_turn(request)
+    if user_message_obj is None:
+      return full_contents
 
     try:
-      response = model.generate_content(
-        contents=full_contents
+      bot_reply, output_tokens = self._generate_reply(full_contents)
+
+      # Save model reply
+      finish_turn(user_message_obj, bot_reply, output_tokens)
+
+      return Response(
+        {"bot_reply": bot_reply, "conversation_id": user_message_obj.conversation_id},
+        status=status.HTTP_200_OK,
       )
 
-      # Explicit check for blocked / incomplete responses before accessing .text
-      candidate = response.candidates[0] if response.candidates else None
-      if not candidate or candidate.finish_reason not in ("STOP", 1):
-        finish = candidate.finish_reason if candidate else "NO_CANDIDATE"
-        raise ValueError(f"response was blocked or incomplete (finish_reason={finish})")
+    except Exception as e:
+      if isinstance(e, LLMUnavailableError):
+        logger.warning(f"Gemini unavailable for chatbot: {e}")
+        fallback = degraded_reply(full_contents)
+        if fallback is not None:
+          finish_turn(user_message_obj, fallback, estimate_tokens(fallback))
+          return Response(
+            {"bot_reply": fallback, "conversation_id": user_message_obj.conversation_id, "degraded": True},
+            status=status.HTTP_200_OK,
+          )
 
-      bot_reply = response.text
+      self._abandon_turn(user_message_obj)
 
-      # Save model reply
-      ChatHistory.objects.create(
-        user=request.user,
-        role='model',
-        message=bot_reply,
+      if isinstance(e, LLMUnavailableError):
+        return Response(
+          {"detail": chat_error_message(e)},
+          status=status.HTTP_503_SERVICE_UNAVAILABLE,
+          headers=retry_after_headers(e),
+        )
+      logger.exception(f"Error calling Gemini API for chatbot: {e}")
+      return Response(
+        {"detail": chat_error_message(e)},
+        status=status.HTTP_500_INTERNAL_SERVER_ERROR,
       )
 
-      return Response({"bot_reply": bot_reply}, status=status.HTTP_200_OK)
+
+# Streaming chatbot view (Server-Sent Events)
+class ChatbotStreamAPIView(ChatbotAPIView):
+  """
+  Same request shape as ChatbotAPIView, but the reply is streamed back as SSE:
+    event: chunk  data: {"text": "..."}        (repeated)
+    event: done   data: {"conversation_id": n} (reply persisted)
+    event: error  data: {"detail": "..."}      (turn rolled back)
+  If Gemini is unavailable before anything was sent, degraded_reply() goes out
+  as the one chunk and done carries "degraded": true.
+  """
+
+  def _stream_reply(self, user_message_obj, full_contents):
+    parts: list[str] = []
+    completed = False
+    try:
+      local = local_reply(full_contents)
+      if local is not None:
+        last_chunk = LLMResponse(text=local, finish_reason="STOP", output_tokens=estimate_tokens(local))
+        chunks = [last_chunk]
+      else:
+        last_chunk = None
+        chunks = llm.stream(grounded_contents(full_contents), priority="chat", endpoint="chat_stream")
+
+      for chunk in chunks:
+        last_chunk = chunk
+        if chunk.text:
+          parts.append(chunk.text)
+          yield sse_event("chunk", {"text": chunk.text})
+
+      if local is None and last_chunk is not None:
+        usage_rollup.record_llm_usage(last_chunk)  # Gemini's usage on the last chunk covers the stream
+      check_finish_reason(last_chunk or LLMResponse(text="", finish_reason="NO_CANDIDATE"))
+      if local is None:
+        remember_reply(full_contents, "".join(parts))
+
+      # Persist the full reply only once the stream has completed cleanly
+      finish_turn(user_message_obj, "".join(parts), last_chunk.output_tokens)
+      completed = True
+      yield sse_event("done", {"conversation_id": user_message_obj.conversation_id})
+
+    except LLMUnavailableError as e:
+      logger.warning(f"Gemini unavailable for chatbot stream: {e}")
+      fallback = None if parts else degraded_reply(full_contents)
+      if fallback is None:
+        yield sse_event("error", {"detail": chat_error_message(e)})
+      else:
+        finish_turn(user_message_obj, fallback, estimate_tokens(fallback))
+        completed = True
+        yield sse_event("chunk", {"text": fallback})
+        yield sse_event("done", {"conversation_id": user_message_obj.conversation_id, "degraded": True})
 
     except Exception as e:
-      # Roll back the user message so history stays consistent
-      user_message_obj.delete()
+      logger.exception(f"Error streaming Gemini API response for chatbot: {e}")
+      yield sse_event("error", {"detail": chat_error_message(e)})
+
+    finally:
+      # Upstream failure or client disconnect (GeneratorExit): roll the turn back
+      if not completed:
+        self._abandon_turn(user_message_obj)
+
+  def post(self, request, *args, **kwargs):
+    user_message_obj, full_contents = self._start_turn(request)
+    if user_message_obj is None:
+      return full_contents
+
+    return sse_response(self._stream_reply(user_message_obj, full_contents))
+
 
-      print(f"Error calling Gemini API for chatbot: {e}")
-      return Response(
-          {"detail": self._get_user_friendly_error(e)},
-          status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-      )
-  
 class ChatHistoryAPIView(APIView):
+  """
+  The user's chat history, oldest first, one keyset page at a time.
+
+    GET /chat_history/                  latest PAGE_SIZE messages
+    GET /chat_history/?before=<cursor>  the page before that (scrolling back)
+    GET /chat_history/?since=<cursor>   only messages newer than the cursor (reopening chat)
+    &limit=<n>                          page size, up to MAX_PAGE_SIZE
+
+  The body stays a plain list of {"role", "parts"} items. Cursors travel in
+  headers: X-Next-Cursor (use as ?since=), X-Prev-Cursor (use as ?before=, only
+  when older messages exist) and X-Has-More (a ?since= page was truncated).
+  An ETag over the page lets unchanged reloads end in 304 Not Modified.
+  """
   permission_classes = [permissions.IsAuthenticated]
-  
+
+  PAGE_SIZE = 50
+  MAX_PAGE_SIZE = 200
+
+  #  Cursors: opaque, urlsafe encoding of the (timestamp, id) keyset position 
+  def _encode_cursor(self, timestamp, pk: int) -> str:
+    return urlsafe_base64_encode(f"{timestamp.isoformat()}|{pk}".encode())
+
+  def _decode_cursor(self, cursor: str):
+    try:
+      timestamp, pk = urlsafe_base64_decode(cursor).decode().split("|")
+      timestamp = datetime.fromisoformat(timestamp)
+      return timestamp, int(pk)
+    except (ValueError, UnicodeDecodeError):
+      raise ValidationError({"detail": "Invalid cursor."})
+
+  def _limit(self, request) -> int:
+    try:
+      limit = int(request.query_params.get("limit", self.PAGE_SIZE))
+    except ValueError:
+      raise ValidationError({"limit": "Must be an integer."})
+    return max(1, min(limit, self.MAX_PAGE_SIZE))
+
+  def _messages(self, request):
+    return ChatHistory.objects.filter(user=request.user)
+
+  def _page(self, request):
+    """Returns (rows oldest first, has_older, has_more)."""
+    history = self._messages(request).values_list("id", "timestamp", "role", "message")
+    limit = self._limit(request)
+    since = request.query_params.get("since")
+    before = request.query_params.get("before")
+
+    if since:
+      position = self._decode_cursor(since)
+      rows = list(history.filter(after_position(position)).order_by("timestamp", "id")[:limit + 1])
+      return rows[:limit], False, len(rows) > limit
+
+    if before:
+      history = history.filter(before_position(self._decode_cursor(before)))
+
+    rows = list(history.order_by("-timestamp", "-id")[:limit + 1])
+    return rows[:limit][::-1], len(rows) > limit, False
+
   def get(self, request, *args, **kwargs):
-    history = ChatHistory.objects.filter(user=request.user).order_by('timestamp')
-    
-    formatted_history = [
-      {"role": obj.role, "parts": [{"text": obj.message}]}
-      for obj in history
-    ]
-    
-    return Response(formatted_history, status=status.HTTP_200_OK)
\ No newline at end of file
+    rows, has_older, has_more = self._page(request)
+
+    # Messages are never edited, so the ids on the page identify its content
+    etag = quote_etag(hashlib.sha1(
+      f"{request.get_full_path()}|{[row[0] for row in rows]}|{has_older}|{has_more}".encode()
+    ).hexdigest())
+
+    if etag in parse_etags(request.headers.get("If-None-Match", "")):
+      response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+      formatted_history = [
+        {"role": role, "parts": [{"text": message}]}
+        for _, _, role, message in rows
+      ]
+      response = Response(formatted_history, status=status.HTTP_200_OK)
+
+    response["ETag"] = etag
+    if rows:
+      response["X-Next-Cursor"] = self._encode_cursor(rows[-1][1], rows[-1][0])
+    elif request.query_params.get("since"):
+      response["X-Next-Cursor"] = request.query_params["since"]
+    if has_older:
+      response["X-Prev-Cursor"] = self._encode_cursor(rows[0][1], rows[0][0])
+    response["X-Has-More"] = "true" if has_more else "false"
+    return response
+
+
+# Conversation threads
+class ConversationViewSet(viewsets.ModelViewSet):
+  """
+  The user's chat threads, most recently active first.
+
+    GET /conversations/                 active threads
+    GET /conversations/?archived=true   archived threads
+    PATCH /conversations/<id>/          rename, or archive with {"is_archived": true}
+    DELETE /conversations/<id>/         delete the thread and its messages
+  """
+  serializer_class = ConversationSerializer
+  permission_classes = [permissions.IsAuthenticated]
+
+  def get_queryset(self):
+    conversations = Conversation.objects.filter(user=self.request.user)
+    if self.action == 'list':
+      archived = self.request.query_params.get('archived', '').lower() in ('1', 'true', 'yes')
+      conversations = conversations.filter(is_archived=archived)
+    return conversations
+
+  def perform_create(self, serializer):
+    serializer.save(user=self.request.user)
+
+
+class ConversationMessagesAPIView(ChatHistoryAPIView):
+  """One thread's messages; same paging, cursors and ETags as ChatHistoryAPIView."""
+
+  def _messages(self, request):
+    conversation = get_object_or_404(Conversation, pk=self.kwargs['pk'], user=request.user)
+    return ChatHistory.objects.filter(conversation=conversation)
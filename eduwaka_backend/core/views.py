@@ -1,6 +1,11 @@
-from django.http import JsonResponse
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
 from django.db import connection
 
+from apps.ai_assistant.metrics import render as render_metrics
+
 
 def health_check(request):
     try:
@@ -10,4 +15,19 @@ def health_check(request):
 
         return JsonResponse({"status": "ok"})
     except Exception as e:
-        return JsonResponse({"status": "error", "message": str(e)}, status=500)
\ No newline at end of file
+        return JsonResponse({"status": "error", "message": str(e)}, status=500)
+
+
+def metrics(request):
+    """Prometheus scrape endpoint: every worker's AI metrics (see apps/ai_assistant/metrics.py)."""
+    if not settings.METRICS_TOKEN:
+        # Off unless a token is configured; open in local development only
+        if not settings.DEBUG:
+            return JsonResponse({"detail": "Not found."}, status=404)
+    else:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(supplied.encode(), settings.METRICS_TOKEN.encode()):
+            return JsonResponse({"detail": "Invalid metrics token."}, status=401)
+
+    body, content_type = render_metrics()
+    return HttpResponse(body, content_type=content_type)
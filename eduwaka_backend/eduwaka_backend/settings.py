@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import json
+import tempfile
 from dotenv import load_dotenv
 from datetime import timedelta
 import dj_database_url
@@ -155,6 +157,129 @@ else:
 
 # Gemini API Key
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL_NAME', 'gemini-3.1-flash-lite-preview')
+
+# LLM backend used by the AI assistant. Use 'apps.ai_assistant.llm.StubClient' for
+# offline load testing; AI_LLM_OPTIONS (JSON) is passed to the backend's constructor.
+AI_LLM_BACKEND = os.getenv('AI_LLM_BACKEND', 'apps.ai_assistant.llm.GeminiClient')
+AI_LLM_OPTIONS = json.loads(os.getenv('AI_LLM_OPTIONS', '{}'))
+
+# Resilience around every LLM call (apps/ai_assistant/resilience.py): a per-attempt timeout,
+# retries with jittered exponential backoff for 5xx/429/timeouts within DEADLINE seconds,
+# optional hedged second requests at the observed p95, and a circuit breaker that opens
+# when FAILURE_RATE of the calls in the last WINDOW seconds failed (min MIN_CALLS calls)
+AI_LLM_TIMEOUT = float(os.getenv('AI_LLM_TIMEOUT', 20))  # seconds per attempt; 0 disables
+AI_LLM_DEADLINE = float(os.getenv('AI_LLM_DEADLINE', 30))  # seconds across all attempts
+AI_LLM_MAX_RETRIES = int(os.getenv('AI_LLM_MAX_RETRIES', 2))
+AI_LLM_RETRY_BACKOFF = float(os.getenv('AI_LLM_RETRY_BACKOFF', 0.5))
+AI_LLM_RETRY_BACKOFF_MAX = float(os.getenv('AI_LLM_RETRY_BACKOFF_MAX', 4))
+AI_LLM_HEDGE = os.getenv('AI_LLM_HEDGE', 'False').lower() == 'true'
+AI_LLM_BREAKER_FAILURE_RATE = float(os.getenv('AI_LLM_BREAKER_FAILURE_RATE', 0.5))
+AI_LLM_BREAKER_MIN_CALLS = int(os.getenv('AI_LLM_BREAKER_MIN_CALLS', 10))
+AI_LLM_BREAKER_WINDOW = float(os.getenv('AI_LLM_BREAKER_WINDOW', 60))
+AI_LLM_BREAKER_OPEN_SECONDS = float(os.getenv('AI_LLM_BREAKER_OPEN_SECONDS', 30))
+
+# Outbound concurrency (apps/ai_assistant/limiter.py): at most MAX_CONCURRENCY LLM calls in
+# flight per process (0 disables); up to MAX_QUEUE more wait, eligibility first, then chat,
+# then overviews, for QUEUE_TIMEOUT seconds before a 503. HOST_MAX_CONCURRENCY additionally
+# caps all workers on the host together via lock files in HOST_SLOT_DIR (0 disables).
+AI_LLM_MAX_CONCURRENCY = int(os.getenv('AI_LLM_MAX_CONCURRENCY', 16))
+AI_LLM_MAX_QUEUE = int(os.getenv('AI_LLM_MAX_QUEUE', 64))
+AI_LLM_QUEUE_TIMEOUT = float(os.getenv('AI_LLM_QUEUE_TIMEOUT', 5))
+AI_LLM_HOST_MAX_CONCURRENCY = int(os.getenv('AI_LLM_HOST_MAX_CONCURRENCY', 0))
+AI_LLM_HOST_SLOT_DIR = os.getenv('AI_LLM_HOST_SLOT_DIR', os.path.join(tempfile.gettempdir(), 'eduwaka_llm_slots'))
+
+# Per-client rate limits on the Gemini-backed endpoints (apps/ai_assistant/ratelimit.py): token
+# buckets holding BURST requests and refilled at PER_MINUTE, one per user and one per client
+# IP; a BURST of 0 turns that bucket off. STORES lists where buckets are kept, in order, each
+# one the fallback for the last: "cache" (AI_RATE_LIMIT_CACHE) and/or "database" (a row lock
+# per bucket per request). The cache is Redis when AI_RATE_LIMIT_CACHE_URL is set (Django's
+# Redis backend, needs the redis package) and shared by all workers; otherwise the per-process
+# default cache, which the limiter warns about outside DEBUG. By default: Redis with the
+# database as its fallback, or the database alone without Redis. TRUSTED_PROXIES is the number
+# of our own proxies that append to X-Forwarded-For (1 on Render); 0 uses REMOTE_ADDR.
+AI_RATE_LIMIT_USER_BURST = int(os.getenv('AI_RATE_LIMIT_USER_BURST', 20))
+AI_RATE_LIMIT_USER_PER_MINUTE = float(os.getenv('AI_RATE_LIMIT_USER_PER_MINUTE', 6))
+AI_RATE_LIMIT_IP_BURST = int(os.getenv('AI_RATE_LIMIT_IP_BURST', 60))
+AI_RATE_LIMIT_IP_PER_MINUTE = float(os.getenv('AI_RATE_LIMIT_IP_PER_MINUTE', 30))
+AI_RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv('AI_RATE_LIMIT_TRUSTED_PROXIES', 0))
+AI_RATE_LIMIT_CACHE_URL = os.getenv('AI_RATE_LIMIT_CACHE_URL', '')
+AI_RATE_LIMIT_STORES = [
+    store.strip()
+    for store in os.getenv('AI_RATE_LIMIT_STORES', 'cache,database' if AI_RATE_LIMIT_CACHE_URL else 'database').split(',')
+    if store.strip()
+]
+AI_RATE_LIMIT_CACHE = 'ai_rate_limit' if AI_RATE_LIMIT_CACHE_URL else 'default'
+
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+if AI_RATE_LIMIT_CACHE_URL:
+    CACHES[AI_RATE_LIMIT_CACHE] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': AI_RATE_LIMIT_CACHE_URL,
+    }
+
+# Daily AI usage per user (requests, tokens) is added to the database at most this often
+AI_USAGE_FLUSH_SECONDS = float(os.getenv('AI_USAGE_FLUSH_SECONDS', 10))
+
+# Prometheus metrics at /api/metrics (apps/ai_assistant/metrics.py). Metrics are per process
+# unless PROMETHEUS_MULTIPROC_DIR is set in the environment (prometheus_client reads it from there
+# on import): then each worker writes its samples to files in that directory, which must belong
+# to this deployment alone, and a scrape adds up all of them. gunicorn.conf.py empties it when
+# gunicorn starts; under any other server, empty it before each start.
+# Scrapers must send "Authorization: Bearer <METRICS_TOKEN>"; without a token the endpoint
+# answers 404, except with DEBUG on.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR', '')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Serve the Gemini-backed endpoints from native async views.
+# Only enable when running under ASGI (uvicorn), see README "Deployment".
+AI_ASYNC_VIEWS = os.getenv('AI_ASYNC_VIEWS', 'False').lower() == 'true'
+
+# Chatbot context: history is added newest-first until this many (estimated) tokens
+AI_CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv('AI_CHAT_HISTORY_TOKEN_BUDGET', 4000))
+
+# Rolling summaries: once un-summarised history passes the trigger, older turns are
+# summarised in the background, keeping the newest KEEP tokens verbatim. 0 disables.
+AI_CHAT_SUMMARY_TRIGGER_TOKENS = int(os.getenv('AI_CHAT_SUMMARY_TRIGGER_TOKENS', AI_CHAT_HISTORY_TOKEN_BUDGET))
+AI_CHAT_SUMMARY_KEEP_TOKENS = int(os.getenv('AI_CHAT_SUMMARY_KEEP_TOKENS', AI_CHAT_HISTORY_TOKEN_BUDGET // 2))
+AI_CHAT_SUMMARY_MAX_TOKENS = int(os.getenv('AI_CHAT_SUMMARY_MAX_TOKENS', 400))
+
+# Write-behind: each turn's user message and reply are stored together after the reply,
+# in one insert. False saves the user message before calling Gemini (and deletes it on failure)
+AI_CHAT_WRITE_BEHIND = os.getenv('AI_CHAT_WRITE_BEHIND', 'True').lower() == 'true'
+
+# Semantic answer cache: replies to opening questions are reused for near-identical
+# questions (cosine similarity >= threshold) for TTL seconds. Per process; SIZE=0 disables
+AI_CHAT_SEMANTIC_CACHE_THRESHOLD = float(os.getenv('AI_CHAT_SEMANTIC_CACHE_THRESHOLD', 0.8))
+AI_CHAT_SEMANTIC_CACHE_TTL = int(os.getenv('AI_CHAT_SEMANTIC_CACHE_TTL', 60 * 60 * 24))  # 1 day
+AI_CHAT_SEMANTIC_CACHE_SIZE = int(os.getenv('AI_CHAT_SEMANTIC_CACHE_SIZE', 2000))
+
+# Catalog grounding: the best matching Course/Institution rows are added to each chatbot
+# prompt (TOP_K=0 disables). Workers rebuild their in-memory index every INDEX_TTL seconds
+AI_CHAT_CATALOG_TOP_K = int(os.getenv('AI_CHAT_CATALOG_TOP_K', 3))
+AI_CHAT_CATALOG_MAX_TOKENS = int(os.getenv('AI_CHAT_CATALOG_MAX_TOKENS', 600))
+AI_CATALOG_INDEX_TTL = int(os.getenv('AI_CATALOG_INDEX_TTL', 60 * 15))
+
+# AI assistant caching
+INSTITUTION_OVERVIEW_CACHE_TTL = int(os.getenv('INSTITUTION_OVERVIEW_CACHE_TTL', 60 * 60 * 24 * 30))  # 30 days
+INSTITUTION_OVERVIEW_NEGATIVE_CACHE_TTL = int(os.getenv('INSTITUTION_OVERVIEW_NEGATIVE_CACHE_TTL', 60 * 60 * 24))  # 1 day
+INSTITUTION_OVERVIEW_CACHE_LRU_SIZE = int(os.getenv('INSTITUTION_OVERVIEW_CACHE_LRU_SIZE', 512))
+# Expired overviews stay this long (seconds) past their TTL, served with "stale": true while Gemini is down
+INSTITUTION_OVERVIEW_STALE_TTL = int(os.getenv('INSTITUTION_OVERVIEW_STALE_TTL', 60 * 60 * 24 * 7))  # 7 days
+ELIGIBILITY_CACHE_TTL = int(os.getenv('ELIGIBILITY_CACHE_TTL', 60 * 60 * 24 * 7))  # 7 days
+
+# Eligibility check deadline (seconds): past it the rules-based part of the answer is returned
+# with partial: true, and Gemini's full result is fetched later by id. 0 waits for Gemini
+ELIGIBILITY_DEADLINE = float(os.getenv('ELIGIBILITY_DEADLINE', 8))
+
+# Multi-target eligibility checks (POST /api/ai/eligibility-check/batch/)
+ELIGIBILITY_BATCH_MAX_TARGETS = int(os.getenv('ELIGIBILITY_BATCH_MAX_TARGETS', 10))
+ELIGIBILITY_BATCH_MAX_WORKERS = int(os.getenv('ELIGIBILITY_BATCH_MAX_WORKERS', 4))  # concurrent Gemini calls per batch
+ELIGIBILITY_BATCH_DEADLINE = float(os.getenv('ELIGIBILITY_BATCH_DEADLINE', 30))  # seconds for the whole batch
+
+# Coalescing of identical in-flight Gemini calls (threads + gunicorn workers on one host)
+AI_SINGLEFLIGHT_LOCK_DIR = os.getenv('AI_SINGLEFLIGHT_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'eduwaka_singleflight'))
+AI_SINGLEFLIGHT_WAIT_TIMEOUT = int(os.getenv('AI_SINGLEFLIGHT_WAIT_TIMEOUT', 60))
 
 
 # Password validation
@@ -250,6 +375,15 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'if-none-match',
+]
+
+# Response headers the frontend may read (chat history paging + caching)
+CORS_EXPOSE_HEADERS = [
+    'etag',
+    'x-next-cursor',
+    'x-prev-cursor',
+    'x-has-more',
 ]
 
 # Check for softdelete status in backends.py
@@ -19,11 +19,12 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from django.views.generic import RedirectView
-from core.views import health_check
+from core.views import health_check, metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path("api/health/", health_check),
+    path("api/metrics", metrics),
     path('api/', include('apps.users.urls')),
     path('api/', include('apps.courses.urls')),
     path('api/', include('apps.institutions.urls')),
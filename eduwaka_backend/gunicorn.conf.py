@@ -0,0 +1,20 @@
+# Loaded by gunicorn from the working directory (see README "Deployment")
+import os
+import shutil
+
+# Multiprocess metrics are on only when this is set (see eduwaka_backend/settings.py)
+METRICS_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+
+
+def on_starting(server):
+    # Samples left by a previous run would be added to this one's
+    if METRICS_DIR:
+        shutil.rmtree(METRICS_DIR, ignore_errors=True)
+        os.makedirs(METRICS_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Drop the dead worker's in-flight gauge; its counters keep counting
+    if METRICS_DIR:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid, METRICS_DIR)
@@ -23,6 +23,7 @@ const Chatbot = () => {
   const [input, setInput] = useState('');
   const [isLoading, setIsLoading] = useState(false);
   const [hasLoaded, setHasLoaded] = useState(false);
+  const [conversationId, setConversationId] = useState<number | null>(null);
   const bottomRef = useRef<HTMLDivElement | null>(null);
   const DJANGO_API_BASE_URL = import.meta.env.VITE_DJANGO_API_BASE_URL;
   const getAuthToken = () => localStorage.getItem('access_token');
@@ -63,8 +64,7 @@ const Chatbot = () => {
   const handleSendMessage = async () => {
     if (!input.trim()) return;
     const userMessage: Message = { role: 'user', parts: [{ text: input }] };
-    const newMessages = [...messages, userMessage];
-    setMessages(newMessages);
+    setMessages((prev) => [...prev, userMessage]);
     setInput('');
     setIsLoading(true);
 
@@ -88,10 +88,15 @@ const Chatbot = () => {
           'Content-Type': 'application/json',
           Authorization: `Bearer ${authToken}`,
         },
-        body: JSON.stringify({ chat_history: newMessages }),
+        // The server keeps the history; only the new message is sent
+        body: JSON.stringify({
+          message: input,
+          conversation_id: conversationId,
+        }),
       });
       if (!res.ok) throw new Error((await res.json()).detail);
       const result = await res.json();
+      setConversationId(result.conversation_id);
       setMessages((prev) => [
         ...prev,
         { role: 'model', parts: [{ text: result.bot_reply }] },